@@ -10,7 +10,9 @@ from qiita_client import QiitaPlugin, QiitaCommand
 
 from .split_libraries import split_libraries, split_libraries_fastq
 from .pick_otus import pick_closed_reference_otus
-from .trimming import trimming
+from .trimming import (trimming, multi_length_trimming, quality_trimming,
+                       TRIMMING_LENGTHS)
+from .subsampling import subsampling
 
 # Initialize the plugin
 plugin = QiitaPlugin(
@@ -141,14 +143,15 @@ opt_params = {
         'string', '/databases/gg/13_8/taxonomy/97_otu_taxonomy.txt'],
     'similarity': ['float', '0.97'], 'sortmerna_coverage': ['float', '0.97'],
     'sortmerna_e_value': ['float', '1'],
-    'sortmerna_max_pos': ['integer', '10000'], 'threads': ['integer', '1']}
+    'sortmerna_max_pos': ['integer', '10000'], 'threads': ['integer', '1'],
+    'previous_otu_table': ['string', '']}
 outputs = {'OTU table': 'BIOM'}
 dflt_param_set = {
     'Defaults': {
         'reference-seq': '/databases/gg/13_8/rep_set/97_otus.fasta',
         'reference-tax': '/databases/gg/13_8/taxonomy/97_otu_taxonomy.txt',
         'similarity': 0.97, 'sortmerna_e_value': 1, 'sortmerna_max_pos': 10000,
-        'threads': 1, 'sortmerna_coverage': 0.97}}
+        'threads': 1, 'sortmerna_coverage': 0.97, 'previous_otu_table': ''}}
 po_cmd = QiitaCommand(
     "Pick closed-reference OTUs",
     "OTU picking using a closed reference approach",
@@ -169,3 +172,62 @@ trim_cmd = QiitaCommand(
     "Trimming", "Trimming sequences to the same length",
     trimming, req_params, opt_params, outputs, dflt_param_set)
 plugin.register_command(trim_cmd)
+
+# Define the multi-length trimming command
+req_params = {'input_data': ('artifact', ['Demultiplexed'])}
+opt_params = {'lengths': ['string', '90,100,150']}
+outputs = {'Trimmed Demultiplexed %dbp' % length: 'Demultiplexed'
+           for length in TRIMMING_LENGTHS}
+dflt_param_set = {
+    '90, 100 and 150 base pairs': {'lengths': '90,100,150'}
+}
+multi_trim_cmd = QiitaCommand(
+    "Multi-length trimming",
+    "Trimming sequences to several lengths in a single pass",
+    multi_length_trimming, req_params, opt_params, outputs, dflt_param_set)
+plugin.register_command(multi_trim_cmd)
+
+# Define the subsampling command
+req_params = {'input_data': ('artifact', ['Demultiplexed'])}
+opt_params = {
+    'depth': ['integer', '10000'],
+    'method': ['choice:["hypergeometric", "reservoir"]', 'hypergeometric'],
+    'seed': ['integer', '0']}
+outputs = {'Subsampled Demultiplexed': 'Demultiplexed'}
+dflt_param_set = {
+    '1000 sequences per sample': {
+        'depth': 1000, 'method': 'hypergeometric', 'seed': 0},
+    '10000 sequences per sample': {
+        'depth': 10000, 'method': 'hypergeometric', 'seed': 0}
+}
+subsampling_cmd = QiitaCommand(
+    "Subsampling", "Subsampling the sequences of each sample",
+    subsampling, req_params, opt_params, outputs, dflt_param_set)
+plugin.register_command(subsampling_cmd)
+
+# Define the quality trimming command
+req_params = {'input_data': ('artifact', ['Demultiplexed'])}
+opt_params = {
+    'method': ['choice:["sliding_window", "first_low_quality"]',
+               'sliding_window'],
+    'min_quality': ['integer', '20'],
+    'window': ['integer', '4'],
+    'min_length': ['integer', '75'],
+    'max_ambig': ['integer', '6'],
+    'max_homopolymer': ['integer', '6'],
+    'truncate_ambi_bases': ['boolean', 'False']}
+outputs = {'Trimmed Demultiplexed': 'Demultiplexed'}
+dflt_param_set = {
+    'Sliding window of 4 bases, quality 20': {
+        'method': 'sliding_window', 'min_quality': 20, 'window': 4,
+        'min_length': 75, 'max_ambig': 6, 'max_homopolymer': 6,
+        'truncate_ambi_bases': False},
+    'First base below quality 3': {
+        'method': 'first_low_quality', 'min_quality': 3, 'window': 4,
+        'min_length': 75, 'max_ambig': 6, 'max_homopolymer': 6,
+        'truncate_ambi_bases': False}
+}
+quality_trim_cmd = QiitaCommand(
+    "Quality trimming", "Trimming sequences at their low quality end",
+    quality_trimming, req_params, opt_params, outputs, dflt_param_set)
+plugin.register_command(quality_trim_cmd)
@@ -0,0 +1,15 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from .data import SyntheticDataset
+from .suite import (BENCHMARKS, run_benchmarks, dataset_scale, write_results,
+                    read_results, compare_results)
+
+__all__ = ['SyntheticDataset', 'BENCHMARKS', 'run_benchmarks',
+           'dataset_scale', 'write_results', 'read_results',
+           'compare_results']
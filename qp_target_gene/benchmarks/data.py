@@ -0,0 +1,337 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from os.path import join, exists
+from os import makedirs
+
+import numpy as np
+
+from qp_target_gene.split_libraries.util import generate_demux_file
+
+
+NUCLEOTIDES = np.frombuffer(b'ACGT', dtype=np.uint8)
+PRIMER = 'GTGCCAGCMGCCGCGGTAA'
+
+
+def _as_bytes(arr):
+    """Returns each row of a uint8 matrix as a byte string"""
+    arr = np.ascontiguousarray(arr, dtype=np.uint8)
+    return arr.view('|S%d' % arr.shape[1]).ravel().tolist()
+
+
+def random_sequences(rng, n, length):
+    """Generates random DNA sequences
+
+    Parameters
+    ----------
+    rng : np.random.RandomState
+        The random number generator
+    n : int
+        The number of sequences
+    length : int
+        The length of the sequences
+
+    Returns
+    -------
+    list of bytes
+        The sequences
+    """
+    return _as_bytes(NUCLEOTIDES[rng.randint(0, 4, (n, length))])
+
+
+def random_qualities(rng, n, length, offset=33):
+    """Generates random Phred quality strings, between 20 and 40
+
+    Parameters
+    ----------
+    rng : np.random.RandomState
+        The random number generator
+    n : int
+        The number of quality strings
+    length : int
+        The length of the quality strings
+    offset : int, optional
+        The Phred offset
+
+    Returns
+    -------
+    list of bytes
+        The quality strings
+    """
+    return _as_bytes(rng.randint(20, 41, (n, length)) + offset)
+
+
+def random_barcodes(rng, n, length=12):
+    """Generates unique random barcodes
+
+    Parameters
+    ----------
+    rng : np.random.RandomState
+        The random number generator
+    n : int
+        The number of barcodes
+    length : int, optional
+        The length of the barcodes
+
+    Returns
+    -------
+    list of bytes
+        The barcodes
+    """
+    barcodes = []
+    seen = set()
+    while len(barcodes) < n:
+        for bc in random_sequences(rng, n, length):
+            if bc not in seen and len(barcodes) < n:
+                seen.add(bc)
+                barcodes.append(bc)
+    return barcodes
+
+
+def sample_names(n_samples):
+    """Returns the names of the synthetic samples
+
+    Parameters
+    ----------
+    n_samples : int
+        The number of samples
+
+    Returns
+    -------
+    list of str
+        The sample names
+    """
+    return ['1.SKB%d.%06d' % (i, i) for i in range(n_samples)]
+
+
+def write_prep_file(fp, samples, barcodes, run_prefixes):
+    """Writes a Qiita prep information file
+
+    Parameters
+    ----------
+    fp : str
+        The output filepath
+    samples : list of str
+        The sample names
+    barcodes : list of bytes
+        The barcode of each sample
+    run_prefixes : list of str
+        The run prefix of each sample
+    """
+    with open(fp, 'w') as f:
+        f.write('sample_name\tbarcode\tprimer\trun_prefix\tplatform\t'
+                'center_name\texperiment_design_description\n')
+        for sample, bc, prefix in zip(samples, barcodes, run_prefixes):
+            f.write('%s\t%s\t%s\t%s\tIllumina\tANL\tsynthetic\n'
+                    % (sample, bc.decode('ascii'), PRIMER, prefix))
+
+
+class SyntheticDataset(object):
+    """Deterministic synthetic amplicon dataset
+
+    Parameters
+    ----------
+    out_dir : str
+        The directory where the files are written
+    n_samples : int
+        The number of samples
+    n_reads : int
+        The number of reads of each sample
+    length : int
+        The length of the reads
+    n_lanes : int, optional
+        The number of lanes (run prefixes) the samples are split in
+    seed : int, optional
+        The seed of the random number generator
+
+    Notes
+    -----
+    The same parameters always generate the same files. The reads are
+    generated one sample at a time, so the memory used doesn't grow with the
+    number of samples.
+    """
+    def __init__(self, out_dir, n_samples, n_reads, length, n_lanes=1,
+                 seed=0):
+        self.out_dir = out_dir
+        self.n_samples = n_samples
+        self.n_reads = n_reads
+        self.length = length
+        self.n_lanes = n_lanes
+        self.seed = seed
+
+        rng = np.random.RandomState(seed)
+        self.samples = sample_names(n_samples)
+        self.barcodes = random_barcodes(rng, n_samples)
+        self.run_prefixes = ['lane_%d' % (i % n_lanes)
+                             for i in range(n_samples)]
+
+        if not exists(out_dir):
+            makedirs(out_dir)
+
+    @property
+    def total_reads(self):
+        return self.n_samples * self.n_reads
+
+    def _reads(self):
+        """Yields the sample index, sequences and qualities of each sample"""
+        rng = np.random.RandomState(self.seed + 1)
+        for i in range(self.n_samples):
+            yield (i, random_sequences(rng, self.n_reads, self.length),
+                   random_qualities(rng, self.n_reads, self.length))
+
+    def _lanes(self):
+        return sorted(set(self.run_prefixes))
+
+    def write_prep_file(self, per_sample=False):
+        """Writes the prep information file
+
+        Parameters
+        ----------
+        per_sample : bool, optional
+            Whether each sample is its own run prefix, as in per sample FASTQ
+            artifacts
+
+        Returns
+        -------
+        str
+            The prep information filepath
+        """
+        fp = join(self.out_dir, 'prep_information.txt')
+        run_prefixes = self.samples if per_sample else self.run_prefixes
+        write_prep_file(fp, self.samples, self.barcodes, run_prefixes)
+        return fp
+
+    def write_barcoded_fastq(self):
+        """Writes the reads and barcodes of each lane as FASTQ
+
+        Returns
+        -------
+        dict of {str: list of str}
+            The filepaths keyed by artifact filepath type, i.e.
+            raw_forward_seqs and raw_barcodes
+        """
+        lanes = self._lanes()
+        seqs_fps = [join(self.out_dir, '%s_R1.fastq' % lane) for lane in lanes]
+        bc_fps = [join(self.out_dir, '%s_I1.fastq' % lane) for lane in lanes]
+        seqs_fhs = [open(fp, 'wb') for fp in seqs_fps]
+        bc_fhs = [open(fp, 'wb') for fp in bc_fps]
+        try:
+            bc_qual = b'I' * len(self.barcodes[0])
+            for i, seqs, quals in self._reads():
+                lane = lanes.index(self.run_prefixes[i])
+                bc = self.barcodes[i]
+                for j, (seq, qual) in enumerate(zip(seqs, quals)):
+                    header = b'@%d_%d' % (i, j)
+                    seqs_fhs[lane].write(
+                        b'%s\n%s\n+\n%s\n' % (header, seq, qual))
+                    bc_fhs[lane].write(
+                        b'%s\n%s\n+\n%s\n' % (header, bc, bc_qual))
+        finally:
+            for fh in seqs_fhs + bc_fhs:
+                fh.close()
+        return {'raw_forward_seqs': seqs_fps, 'raw_barcodes': bc_fps}
+
+    def write_per_sample_fastq(self):
+        """Writes the reads of each sample in a FASTQ named after the sample
+
+        Returns
+        -------
+        dict of {str: list of str}
+            The filepaths keyed by artifact filepath type, i.e.
+            raw_forward_seqs
+        """
+        fps = []
+        for i, seqs, quals in self._reads():
+            fp = join(self.out_dir, '%s_R1.fastq' % self.samples[i])
+            with open(fp, 'wb') as f:
+                for j, (seq, qual) in enumerate(zip(seqs, quals)):
+                    f.write(b'@%d_%d\n%s\n+\n%s\n' % (i, j, seq, qual))
+            fps.append(fp)
+        return {'raw_forward_seqs': fps}
+
+    def write_fasta_qual(self):
+        """Writes the reads of each lane as fasta and qual files
+
+        Returns
+        -------
+        dict of {str: list of str}
+            The filepaths keyed by artifact filepath type, i.e. raw_fasta
+            and raw_qual
+        """
+        lanes = self._lanes()
+        seqs_fps = [join(self.out_dir, '%s.fna' % lane) for lane in lanes]
+        qual_fps = [join(self.out_dir, '%s.qual' % lane) for lane in lanes]
+        seqs_fhs = [open(fp, 'wb') for fp in seqs_fps]
+        qual_fhs = [open(fp, 'wb') for fp in qual_fps]
+        try:
+            for i, seqs, quals in self._reads():
+                lane = lanes.index(self.run_prefixes[i])
+                prefix = self.barcodes[i] + PRIMER.replace(
+                    'M', 'A').encode('ascii')
+                prefix_qual = b' '.join([b'40'] * len(prefix))
+                for j, (seq, qual) in enumerate(zip(seqs, quals)):
+                    header = b'>%d_%d' % (i, j)
+                    scores = b' '.join(
+                        b'%d' % (q - 33) for q in bytearray(qual))
+                    seqs_fhs[lane].write(
+                        b'%s\n%s%s\n' % (header, prefix, seq))
+                    qual_fhs[lane].write(
+                        b'%s\n%s %s\n' % (header, prefix_qual, scores))
+        finally:
+            for fh in seqs_fhs + qual_fhs:
+                fh.close()
+        return {'raw_fasta': seqs_fps, 'raw_qual': qual_fps}
+
+    def write_demultiplexed(self, out_dir=None):
+        """Writes the reads as the output of split libraries
+
+        Parameters
+        ----------
+        out_dir : str, optional
+            The output directory. Defaults to `sl_out` inside the dataset
+            directory
+
+        Returns
+        -------
+        str
+            The output directory, containing seqs.fna and seqs.fastq
+        """
+        if out_dir is None:
+            out_dir = join(self.out_dir, 'sl_out')
+        if not exists(out_dir):
+            makedirs(out_dir)
+        id_fmt = (b'%(sample)s_%(idx)d orig_bc=%(bc)s new_bc=%(bc)s '
+                  b'bc_diffs=0')
+        idx = 0
+        with open(join(out_dir, 'seqs.fna'), 'wb') as ffh, \
+                open(join(out_dir, 'seqs.fastq'), 'wb') as qfh:
+            for i, seqs, quals in self._reads():
+                sample = self.samples[i].encode('ascii')
+                for seq, qual in zip(seqs, quals):
+                    seq_id = id_fmt % {b'sample': sample, b'idx': idx,
+                                       b'bc': self.barcodes[i]}
+                    ffh.write(b'>%s\n%s\n' % (seq_id, seq))
+                    qfh.write(b'@%s\n%s\n+\n%s\n' % (seq_id, seq, qual))
+                    idx += 1
+        return out_dir
+
+    def write_demux(self, out_dir=None):
+        """Writes the reads as a demux file
+
+        Parameters
+        ----------
+        out_dir : str, optional
+            The output directory. Defaults to `sl_out` inside the dataset
+            directory
+
+        Returns
+        -------
+        str
+            The demux filepath
+        """
+        return generate_demux_file(self.write_demultiplexed(out_dir))
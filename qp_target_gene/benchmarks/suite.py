@@ -0,0 +1,314 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from os.path import join, getsize
+from os import makedirs
+from time import time
+from json import dump, load
+from multiprocessing import Process, Pipe
+import resource
+
+from qp_target_gene.execution import MAXRSS_UNIT
+from qp_target_gene.trimming import generate_trimming
+from qp_target_gene.pick_otus import generate_pick_closed_reference_otus_cmd
+from qp_target_gene.split_libraries.util import (
+    write_qiime_mapping_file, split_mapping_file, generate_demux_file)
+from qp_target_gene.split_libraries.split_libraries import (
+    generate_split_libraries_cmd)
+from qp_target_gene.split_libraries.split_libraries_fastq import (
+    generate_split_libraries_fastq_cmd)
+
+
+SPLIT_LIBRARIES_PARAMS = {
+    'reverse_primers': 'disable', 'reverse_primer_mismatches': 0,
+    'disable_bc_correction': False, 'max_barcode_errors': 1.5,
+    'disable_primers': False, 'min_seq_len': 200,
+    'truncate_ambi_bases': False, 'max_ambig': 6, 'min_qual_score': 25,
+    'trim_seq_length': False, 'max_seq_len': 1000, 'max_primer_mismatch': 0,
+    'max_homopolymer': 6, 'qual_score_window': 0, 'barcode_type': 'golay_12'}
+
+SPLIT_LIBRARIES_FASTQ_PARAMS = {
+    'max_barcode_errors': 1.5, 'barcode_type': 'golay_12',
+    'max_bad_run_length': 3, 'phred_offset': 'auto', 'rev_comp': False,
+    'phred_quality_threshold': 3, 'rev_comp_barcode': False,
+    'rev_comp_mapping_barcodes': False,
+    'min_per_read_length_fraction': 0.75, 'sequence_max_n': 0}
+
+PICK_OTUS_PARAMS = {
+    'reference-seq': '/databases/gg/13_8/rep_set/97_otus.fasta',
+    'reference-tax': '/databases/gg/13_8/taxonomy/97_otu_taxonomy.txt',
+    'similarity': 0.97, 'sortmerna_e_value': 1, 'sortmerna_max_pos': 10000,
+    'threads': 1, 'sortmerna_coverage': 0.97, 'previous_otu_table': ''}
+
+
+def _setup_demux_file(dataset, work_dir):
+    sl_out = dataset.write_demultiplexed(join(work_dir, 'sl_out'))
+    return (lambda: generate_demux_file(sl_out),
+            getsize(join(sl_out, 'seqs.fastq')))
+
+
+def _setup_trimming(dataset, work_dir):
+    demux_fp = dataset.write_demux(join(work_dir, 'sl_out'))
+    out_dir = join(work_dir, 'trimming')
+    makedirs(out_dir)
+    params = {'length': dataset.length // 2}
+    return (lambda: generate_trimming([demux_fp], out_dir, params),
+            getsize(demux_fp))
+
+
+def _setup_mapping_file(dataset, work_dir):
+    prep_fp = dataset.write_prep_file()
+    map_fp = join(work_dir, 'qiime-mapping-file.txt')
+    return lambda: write_qiime_mapping_file(prep_fp, map_fp), getsize(prep_fp)
+
+
+def _setup_split_mapping_file(dataset, work_dir):
+    map_fp = join(work_dir, 'qiime-mapping-file.txt')
+    write_qiime_mapping_file(dataset.write_prep_file(), map_fp)
+    out_dir = join(work_dir, 'mappings')
+    return lambda: split_mapping_file(map_fp, out_dir), getsize(map_fp)
+
+
+def _setup_split_libraries_cmd(dataset, work_dir):
+    map_fp = join(work_dir, 'qiime-mapping-file.txt')
+    write_qiime_mapping_file(dataset.write_prep_file(), map_fp)
+    fps = dataset.write_fasta_qual()
+    out_dir = join(work_dir, 'sl_out')
+    return (lambda: generate_split_libraries_cmd(
+        fps['raw_fasta'], fps['raw_qual'], map_fp, out_dir,
+        SPLIT_LIBRARIES_PARAMS), getsize(map_fp))
+
+
+def _setup_split_libraries_fastq_cmd(dataset, work_dir):
+    map_fp = join(work_dir, 'qiime-mapping-file.txt')
+    write_qiime_mapping_file(dataset.write_prep_file(), map_fp)
+    fps = dataset.write_barcoded_fastq()
+    return (lambda: generate_split_libraries_fastq_cmd(
+        fps, map_fp, 'FASTQ', work_dir, SPLIT_LIBRARIES_FASTQ_PARAMS),
+        getsize(map_fp))
+
+
+def _setup_per_sample_fastq_cmd(dataset, work_dir):
+    map_fp = join(work_dir, 'qiime-mapping-file.txt')
+    write_qiime_mapping_file(dataset.write_prep_file(per_sample=True), map_fp)
+    fps = dataset.write_per_sample_fastq()
+    params = dict(SPLIT_LIBRARIES_FASTQ_PARAMS, barcode_type='not-barcoded')
+    return (lambda: generate_split_libraries_fastq_cmd(
+        fps, map_fp, 'per_sample_FASTQ', work_dir, params), getsize(map_fp))
+
+
+def _setup_pick_otus_cmd(dataset, work_dir):
+    sl_out = dataset.write_demultiplexed(join(work_dir, 'sl_out'))
+    fps = {'preprocessed_fasta': [join(sl_out, 'seqs.fna')]}
+    return (lambda: generate_pick_closed_reference_otus_cmd(
+        fps, work_dir, PICK_OTUS_PARAMS), 0)
+
+
+# The benchmarks, as (name, setup). The setup writes the inputs of the
+# benchmark and returns the function measured and the size of its input
+BENCHMARKS = [
+    ('generate_demux_file', _setup_demux_file),
+    ('generate_trimming', _setup_trimming),
+    ('write_qiime_mapping_file', _setup_mapping_file),
+    ('split_mapping_file', _setup_split_mapping_file),
+    ('generate_split_libraries_cmd', _setup_split_libraries_cmd),
+    ('generate_split_libraries_fastq_cmd', _setup_split_libraries_fastq_cmd),
+    ('generate_per_sample_fastq_command', _setup_per_sample_fastq_cmd),
+    ('generate_pick_closed_reference_otus_cmd', _setup_pick_otus_cmd)]
+
+
+def _measure(func, conn):
+    """Runs func, sending its resource usage through conn"""
+    start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start_usage = resource.getrusage(resource.RUSAGE_SELF)
+    start = time()
+    func()
+    wall_time = time() - start
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    conn.send({
+        'wall_time': wall_time,
+        'cpu_time': (usage.ru_utime + usage.ru_stime -
+                     start_usage.ru_utime - start_usage.ru_stime),
+        'peak_rss': usage.ru_maxrss * MAXRSS_UNIT,
+        'rss_increase': (usage.ru_maxrss - start_rss) * MAXRSS_UNIT})
+    conn.close()
+
+
+def measure(func):
+    """Measures the resources used by a function
+
+    Parameters
+    ----------
+    func : function
+        The function to measure, without arguments
+
+    Returns
+    -------
+    dict
+        The wall time, the CPU time, the peak resident memory and the
+        increase of the peak resident memory while running the function
+
+    Raises
+    ------
+    RuntimeError
+        If the function fails
+
+    Notes
+    -----
+    The function runs in a forked process, so its peak memory is not masked
+    by the peak of the previous benchmarks.
+    """
+    parent_conn, child_conn = Pipe(False)
+    p = Process(target=_measure, args=(func, child_conn))
+    p.start()
+    child_conn.close()
+    try:
+        result = parent_conn.recv()
+    except EOFError:
+        result = None
+    p.join()
+    if result is None or p.exitcode != 0:
+        raise RuntimeError("The benchmark failed with exit code %s"
+                           % p.exitcode)
+    return result
+
+
+def run_benchmarks(dataset, work_dir, names=None, repeat=3):
+    """Runs the benchmarks over a synthetic dataset
+
+    Parameters
+    ----------
+    dataset : qp_target_gene.benchmarks.data.SyntheticDataset
+        The input dataset
+    work_dir : str
+        The directory where the benchmarks write their files
+    names : list of str, optional
+        The benchmarks to run. Defaults to all of them
+    repeat : int, optional
+        The number of times each benchmark is run
+
+    Returns
+    -------
+    dict of {str: dict}
+        The results of each benchmark, keyed by benchmark name. The times
+        are the fastest of the runs, and the memory the largest
+
+    Raises
+    ------
+    ValueError
+        If a benchmark name is not known
+    """
+    known = dict(BENCHMARKS)
+    if names is None:
+        names = [n for n, _ in BENCHMARKS]
+    unknown = set(names) - set(known)
+    if unknown:
+        raise ValueError("Unknown benchmarks: %s" % ', '.join(sorted(unknown)))
+
+    results = {}
+    for name in names:
+        bench_dir = join(work_dir, name)
+        makedirs(bench_dir)
+        func, input_size = known[name](dataset, bench_dir)
+        runs = [measure(func) for _ in range(repeat)]
+        wall_time = min(r['wall_time'] for r in runs)
+        results[name] = {
+            'wall_time': wall_time,
+            'cpu_time': min(r['cpu_time'] for r in runs),
+            'peak_rss': max(r['peak_rss'] for r in runs),
+            'rss_increase': max(r['rss_increase'] for r in runs),
+            'reads_per_second': dataset.total_reads / wall_time
+            if wall_time else None,
+            'megabytes_per_second': input_size / 1048576.0 / wall_time
+            if wall_time and input_size else None}
+    return results
+
+
+def dataset_scale(dataset):
+    """Returns the parameters defining the size of a dataset
+
+    Parameters
+    ----------
+    dataset : qp_target_gene.benchmarks.data.SyntheticDataset
+        The dataset
+
+    Returns
+    -------
+    dict
+        The number of samples, reads per sample, read length, lanes and seed
+    """
+    return {'samples': dataset.n_samples, 'reads': dataset.n_reads,
+            'length': dataset.length, 'lanes': dataset.n_lanes,
+            'seed': dataset.seed}
+
+
+def write_results(fp, scale, results):
+    """Writes the benchmark results, so they can be used as a baseline
+
+    Parameters
+    ----------
+    fp : str
+        The output filepath
+    scale : dict
+        The dataset scale, as returned by `dataset_scale`
+    results : dict of {str: dict}
+        The benchmark results
+    """
+    with open(fp, 'w') as f:
+        dump({'scale': scale, 'results': results}, f, indent=4,
+             sort_keys=True)
+
+
+def read_results(fp):
+    """Reads the benchmark results written by `write_results`
+
+    Parameters
+    ----------
+    fp : str
+        The results filepath
+
+    Returns
+    -------
+    dict, dict of {str: dict}
+        The dataset scale
+        The benchmark results
+    """
+    with open(fp) as f:
+        info = load(f)
+    return info['scale'], info['results']
+
+
+def compare_results(results, baseline, tolerance=0.2):
+    """Finds the benchmarks slower or using more memory than a baseline
+
+    Parameters
+    ----------
+    results : dict of {str: dict}
+        The benchmark results
+    baseline : dict of {str: dict}
+        The baseline results, obtained with the same dataset scale
+    tolerance : float, optional
+        The fraction a value can grow over the baseline before it is
+        reported
+
+    Returns
+    -------
+    list of (str, str, float, float)
+        The benchmark name, the metric, the baseline value and the new value
+        of each regression
+    """
+    regressions = []
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        for metric in ('wall_time', 'peak_rss'):
+            old = baseline[name][metric]
+            new = results[name][metric]
+            if new > old * (1 + tolerance):
+                regressions.append((name, metric, old, new))
+    return regressions
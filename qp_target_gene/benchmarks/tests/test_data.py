@@ -0,0 +1,128 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from unittest import TestCase, main
+from os.path import exists, isdir, join, basename
+from os import remove
+from shutil import rmtree
+from tempfile import mkdtemp
+
+import numpy as np
+from h5py import File
+
+from qp_target_gene.benchmarks.data import (
+    random_sequences, random_qualities, random_barcodes, sample_names,
+    SyntheticDataset)
+
+
+class DataTests(TestCase):
+    def setUp(self):
+        self._clean_up_files = []
+        self.out_dir = mkdtemp()
+        self._clean_up_files.append(self.out_dir)
+
+    def tearDown(self):
+        for fp in self._clean_up_files:
+            if exists(fp):
+                if isdir(fp):
+                    rmtree(fp)
+                else:
+                    remove(fp)
+
+    def _read(self, fp):
+        with open(fp, 'rb') as f:
+            return f.read()
+
+    def test_random_sequences(self):
+        obs = random_sequences(np.random.RandomState(0), 3, 5)
+        self.assertEqual(len(obs), 3)
+        for seq in obs:
+            self.assertEqual(len(seq), 5)
+            self.assertTrue(set(seq) <= set(b'ACGT'))
+        self.assertEqual(obs, random_sequences(np.random.RandomState(0), 3, 5))
+
+    def test_random_qualities(self):
+        obs = random_qualities(np.random.RandomState(0), 2, 10)
+        for qual in obs:
+            self.assertEqual(len(qual), 10)
+            self.assertTrue(all(53 <= q <= 73 for q in bytearray(qual)))
+
+    def test_random_barcodes(self):
+        obs = random_barcodes(np.random.RandomState(0), 50, length=4)
+        self.assertEqual(len(obs), 50)
+        self.assertEqual(len(set(obs)), 50)
+
+    def test_sample_names(self):
+        self.assertEqual(sample_names(2), ['1.SKB0.000000', '1.SKB1.000001'])
+
+    def test_write_prep_file(self):
+        dataset = SyntheticDataset(self.out_dir, 3, 2, 10, n_lanes=2)
+        with open(dataset.write_prep_file()) as f:
+            lines = f.read().splitlines()
+        self.assertEqual(len(lines), 4)
+        self.assertEqual([line.split('\t')[3] for line in lines],
+                         ['run_prefix', 'lane_0', 'lane_1', 'lane_0'])
+
+        with open(dataset.write_prep_file(per_sample=True)) as f:
+            lines = f.read().splitlines()
+        self.assertEqual([line.split('\t')[3] for line in lines[1:]],
+                         dataset.samples)
+
+    def test_write_barcoded_fastq(self):
+        dataset = SyntheticDataset(self.out_dir, 3, 2, 10, n_lanes=2)
+        obs = dataset.write_barcoded_fastq()
+        self.assertEqual([basename(fp) for fp in obs['raw_forward_seqs']],
+                         ['lane_0_R1.fastq', 'lane_1_R1.fastq'])
+        self.assertEqual([basename(fp) for fp in obs['raw_barcodes']],
+                         ['lane_0_I1.fastq', 'lane_1_I1.fastq'])
+        lines = self._read(obs['raw_forward_seqs'][0]).splitlines()
+        # samples 0 and 2, 2 reads each
+        self.assertEqual(len(lines), 16)
+        self.assertEqual(lines[0], b'@0_0')
+        self.assertEqual(len(lines[1]), 10)
+        lines = self._read(obs['raw_barcodes'][1]).splitlines()
+        self.assertEqual(lines[1], dataset.barcodes[1])
+
+        # the data is deterministic
+        exp = self._read(obs['raw_forward_seqs'][0])
+        other = SyntheticDataset(join(self.out_dir, 'other'), 3, 2, 10,
+                                 n_lanes=2)
+        obs = other.write_barcoded_fastq()
+        self.assertEqual(self._read(obs['raw_forward_seqs'][0]), exp)
+
+    def test_write_per_sample_fastq(self):
+        dataset = SyntheticDataset(self.out_dir, 2, 3, 10)
+        obs = dataset.write_per_sample_fastq()
+        self.assertEqual([basename(fp) for fp in obs['raw_forward_seqs']],
+                         ['1.SKB0.000000_R1.fastq', '1.SKB1.000001_R1.fastq'])
+        lines = self._read(obs['raw_forward_seqs'][1]).splitlines()
+        self.assertEqual(len(lines), 12)
+
+    def test_write_fasta_qual(self):
+        dataset = SyntheticDataset(self.out_dir, 2, 3, 10)
+        obs = dataset.write_fasta_qual()
+        seqs = self._read(obs['raw_fasta'][0]).splitlines()
+        quals = self._read(obs['raw_qual'][0]).splitlines()
+        self.assertEqual(len(seqs), 12)
+        self.assertEqual(seqs[0], b'>0_0')
+        self.assertTrue(seqs[1].startswith(dataset.barcodes[0]))
+        # barcode, primer and read
+        self.assertEqual(len(seqs[1]), 12 + 19 + 10)
+        self.assertEqual(len(quals[1].split()), 12 + 19 + 10)
+
+    def test_write_demux(self):
+        dataset = SyntheticDataset(self.out_dir, 2, 3, 10)
+        obs = dataset.write_demux()
+        self.assertEqual(obs, join(self.out_dir, 'sl_out', 'seqs.demux'))
+        with File(obs, 'r') as f:
+            self.assertEqual(sorted(f), dataset.samples)
+            self.assertEqual(f[dataset.samples[0]].attrs['n'], 3)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from unittest import TestCase, main
+from os.path import exists, isdir, join
+from os import remove
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from qp_target_gene.benchmarks.data import SyntheticDataset
+from qp_target_gene.benchmarks.suite import (
+    BENCHMARKS, measure, run_benchmarks, dataset_scale, write_results,
+    read_results, compare_results)
+
+
+def fail():
+    raise ValueError('Failed')
+
+
+class SuiteTests(TestCase):
+    def setUp(self):
+        self._clean_up_files = []
+        self.out_dir = mkdtemp()
+        self._clean_up_files.append(self.out_dir)
+        self.dataset = SyntheticDataset(join(self.out_dir, 'data'), 2, 5,
+                                        100, n_lanes=2)
+
+    def tearDown(self):
+        for fp in self._clean_up_files:
+            if exists(fp):
+                if isdir(fp):
+                    rmtree(fp)
+                else:
+                    remove(fp)
+
+    def test_measure(self):
+        obs = measure(lambda: sum(range(1000)))
+        self.assertEqual(
+            sorted(obs), ['cpu_time', 'peak_rss', 'rss_increase', 'wall_time'])
+        self.assertGreater(obs['peak_rss'], 0)
+
+        with self.assertRaises(RuntimeError):
+            measure(fail)
+
+    def test_run_benchmarks(self):
+        obs = run_benchmarks(self.dataset, join(self.out_dir, 'runs'),
+                             repeat=1)
+        self.assertEqual(sorted(obs), sorted(n for n, _ in BENCHMARKS))
+        for result in obs.values():
+            self.assertGreaterEqual(result['wall_time'], 0)
+            self.assertGreater(result['peak_rss'], 0)
+        self.assertIsNotNone(obs['generate_trimming']['megabytes_per_second'])
+
+    def test_run_benchmarks_unknown(self):
+        with self.assertRaises(ValueError):
+            run_benchmarks(self.dataset, join(self.out_dir, 'runs'),
+                           names=['generate_trimming', 'unknown'])
+
+    def test_write_read_results(self):
+        fp = join(self.out_dir, 'results.json')
+        results = {'generate_trimming': {'wall_time': 1.5, 'peak_rss': 10}}
+        write_results(fp, dataset_scale(self.dataset), results)
+        self.assertEqual(read_results(fp), (
+            {'samples': 2, 'reads': 5, 'length': 100, 'lanes': 2, 'seed': 0},
+            results))
+
+    def test_compare_results(self):
+        baseline = {'a': {'wall_time': 1.0, 'peak_rss': 100},
+                    'b': {'wall_time': 1.0, 'peak_rss': 100}}
+        results = {'a': {'wall_time': 1.1, 'peak_rss': 200},
+                   'b': {'wall_time': 2.0, 'peak_rss': 100},
+                   'c': {'wall_time': 5.0, 'peak_rss': 100}}
+        self.assertEqual(compare_results(results, baseline),
+                         [('a', 'peak_rss', 100, 200),
+                          ('b', 'wall_time', 1.0, 2.0)])
+        self.assertEqual(compare_results(results, baseline, tolerance=1.5),
+                         [])
+
+
+if __name__ == '__main__':
+    main()
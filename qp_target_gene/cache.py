@@ -0,0 +1,328 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from os.path import join, exists, isdir, isfile, relpath, dirname, getsize
+from os import makedirs, link, rename, listdir, walk, utime, stat
+from shutil import copy2, rmtree
+from hashlib import md5
+from json import dumps, dump, load
+from tempfile import mkdtemp
+from functools import wraps
+from multiprocessing.pool import ThreadPool
+
+from qiita_client import ArtifactInfo
+
+from qp_target_gene.config import get_config_value
+from qp_target_gene.metadata import get_artifact_info, get_prep_info
+
+
+METADATA_FILENAME = 'artifacts.json'
+
+
+def compute_file_checksum(fp, buffer_size=1048576):
+    """Computes the md5 of a file
+
+    Parameters
+    ----------
+    fp : str
+        The filepath
+    buffer_size : int, optional
+        The number of bytes read at a time
+
+    Returns
+    -------
+    str
+        The md5 of the file contents
+    """
+    h = md5()
+    with open(fp, 'rb') as f:
+        for block in iter(lambda: f.read(buffer_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def generate_cache_key(command, version, parameters, checksums):
+    """Generates the key identifying the results of a job
+
+    Parameters
+    ----------
+    command : str
+        The command name
+    version : str
+        The plugin version
+    parameters : dict
+        The command's parameters, keyed by parameter name
+    checksums : list of str
+        The checksums of the input files
+
+    Returns
+    -------
+    str
+        The cache key
+    """
+    # the artifact id is not relevant, only the contents of its files
+    params = {k: str(v) for k, v in parameters.items() if k != 'input_data'}
+    # parameters pointing to files (e.g. references) are identified by their
+    # size and modification time
+    for k, v in params.items():
+        if isfile(v):
+            st = stat(v)
+            params[k] = '%s:%d:%d' % (v, st.st_size, int(st.st_mtime))
+    key = {'command': command, 'version': version, 'parameters': params,
+           'checksums': sorted(checksums)}
+    return md5(dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def _link(src, dst):
+    """Hardlinks src to dst, copying it if they are in different devices"""
+    if isdir(src):
+        for root, _, files in walk(src):
+            dst_root = join(dst, relpath(root, src))
+            if not exists(dst_root):
+                makedirs(dst_root)
+            for f in files:
+                _link(join(root, f), join(dst_root, f))
+    else:
+        if not exists(dirname(dst)):
+            makedirs(dirname(dst))
+        try:
+            link(src, dst)
+        except OSError:
+            copy2(src, dst)
+
+
+def _size(fp):
+    """Returns the size of a file or of all the files in a directory"""
+    if not isdir(fp):
+        return getsize(fp)
+    return sum(getsize(join(root, f))
+               for root, _, files in walk(fp) for f in files)
+
+
+def get_cached_result(cache_dir, key, out_dir):
+    """Links the cached results of a job into its output directory
+
+    Parameters
+    ----------
+    cache_dir : str
+        The cache directory
+    key : str
+        The cache key of the job
+    out_dir : str
+        The job output directory
+
+    Returns
+    -------
+    list of ArtifactInfo or None
+        The artifacts information, None if the results are not cached
+    """
+    entry = join(cache_dir, key)
+    metadata_fp = join(entry, METADATA_FILENAME)
+    if not exists(metadata_fp):
+        return None
+    with open(metadata_fp) as f:
+        metadata = load(f)
+
+    artifacts_info = []
+    for output_name, artifact_type, files in metadata['artifacts']:
+        filepaths = []
+        for fp, fp_type in files:
+            _link(join(entry, 'files', fp), join(out_dir, fp))
+            filepaths.append((join(out_dir, fp), fp_type))
+        artifacts_info.append(
+            ArtifactInfo(output_name, artifact_type, filepaths))
+    # the modification time is used to evict the least recently used entries
+    utime(metadata_fp, None)
+
+    return artifacts_info
+
+
+def store_result(cache_dir, key, out_dir, artifacts_info):
+    """Stores the results of a job in the cache
+
+    Parameters
+    ----------
+    cache_dir : str
+        The cache directory
+    key : str
+        The cache key of the job
+    out_dir : str
+        The job output directory
+    artifacts_info : list of ArtifactInfo
+        The artifacts generated by the job
+
+    Returns
+    -------
+    bool
+        Whether the results were stored. Results with files outside the
+        output directory are not stored
+    """
+    entry = join(cache_dir, key)
+    if exists(entry):
+        return True
+
+    artifacts = []
+    for ainfo in artifacts_info:
+        files = [(relpath(fp, out_dir), fp_type) for fp, fp_type in
+                 ainfo.files]
+        if any(fp.startswith('..') for fp, _ in files):
+            return False
+        artifacts.append((ainfo.output_name, ainfo.artifact_type, files))
+
+    if not exists(cache_dir):
+        makedirs(cache_dir)
+    # the entry is written to a temporary directory and then renamed, so
+    # other jobs never see an incomplete entry
+    tmp_dir = mkdtemp(dir=cache_dir, prefix='.')
+    try:
+        size = 0
+        for _, _, files in artifacts:
+            for fp, _ in files:
+                _link(join(out_dir, fp), join(tmp_dir, 'files', fp))
+                size += _size(join(out_dir, fp))
+        with open(join(tmp_dir, METADATA_FILENAME), 'w') as f:
+            dump({'artifacts': artifacts, 'size': size}, f)
+    except Exception:
+        rmtree(tmp_dir, ignore_errors=True)
+        raise
+    try:
+        rename(tmp_dir, entry)
+    except OSError:
+        # another job stored the same results first
+        rmtree(tmp_dir)
+
+    return True
+
+
+def evict_results(cache_dir, max_size):
+    """Removes the least recently used entries until the cache fits
+
+    Parameters
+    ----------
+    cache_dir : str
+        The cache directory
+    max_size : int
+        The maximum size of the cache, in bytes
+    """
+    entries = []
+    for key in listdir(cache_dir):
+        metadata_fp = join(cache_dir, key, METADATA_FILENAME)
+        if key.startswith('.') or not exists(metadata_fp):
+            continue
+        with open(metadata_fp) as f:
+            size = load(f)['size']
+        entries.append((stat(metadata_fp).st_mtime, size, key))
+
+    total = sum(e[1] for e in entries)
+    for _, size, key in sorted(entries):
+        if total <= max_size:
+            break
+        rmtree(join(cache_dir, key), ignore_errors=True)
+        total -= size
+
+
+def get_cache_key(qclient, command, parameters, uses_prep):
+    """Generates the cache key of a job from its input artifact
+
+    Parameters
+    ----------
+    qclient : tgp.qiita_client.QiitaClient
+        The Qiita server client
+    command : str
+        The command name
+    parameters : dict
+        The command's parameters, keyed by parameter name
+    uses_prep : bool
+        Whether the results depend on the artifact's prep information
+
+    Returns
+    -------
+    str
+        The cache key
+    """
+    # importing here to avoid a circular import, as the commands are
+    # decorated before the plugin is created
+    from qp_target_gene import plugin
+
+    a_info = get_artifact_info(qclient, parameters['input_data'])
+    fps = [vv['filepath'] for v in a_info['files'].values() for vv in v]
+    # the files are checksummed concurrently, while the prep information is
+    # requested
+    pool = ThreadPool(min(len(fps), 4) or 1)
+    try:
+        result = pool.map_async(compute_file_checksum, fps)
+        if uses_prep:
+            # Qiita writes a new, timestamped, prep file on every modification
+            prep_id = a_info['prep_information'][0]
+            prep_key = '%s:%s' % (
+                prep_id, get_prep_info(qclient, prep_id)['prep-file'])
+        checksums = result.get()
+    finally:
+        pool.close()
+    if uses_prep:
+        checksums.append(prep_key)
+
+    return generate_cache_key(command, '%s %s' % (plugin.name, plugin.version),
+                              parameters, checksums)
+
+
+def cached_command(command, uses_prep=False):
+    """Decorates a command so its results are cached
+
+    Parameters
+    ----------
+    command : str
+        The command name, part of the cache key
+    uses_prep : bool, optional
+        Whether the results depend on the artifact's prep information
+
+    Returns
+    -------
+    function
+        The decorator
+
+    Notes
+    -----
+    The cache is only used if CACHE_DIR is set in the plugin configuration
+    file. The cache is a best effort: a failure while retrieving or storing
+    the results doesn't fail the job.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(qclient, job_id, parameters, out_dir):
+            cache_dir = get_config_value('cache', 'CACHE_DIR')
+            if not cache_dir:
+                return func(qclient, job_id, parameters, out_dir)
+
+            try:
+                key = get_cache_key(qclient, command, parameters, uses_prep)
+            except Exception:
+                # e.g. the artifact or prep information can't be retrieved;
+                # the command reports the error if it needs them
+                return func(qclient, job_id, parameters, out_dir)
+            try:
+                artifacts_info = get_cached_result(cache_dir, key, out_dir)
+            except (OSError, IOError):
+                # the entry was evicted while being used
+                artifacts_info = None
+            if artifacts_info is not None:
+                qclient.update_job_step(job_id, "Reusing cached results")
+                return True, artifacts_info, ""
+
+            success, artifacts_info, error_msg = func(
+                qclient, job_id, parameters, out_dir)
+            if success:
+                max_size = float(get_config_value('cache', 'CACHE_SIZE', '50'))
+                try:
+                    store_result(cache_dir, key, out_dir, artifacts_info)
+                    evict_results(cache_dir, max_size * 1024 ** 3)
+                except (OSError, IOError):
+                    pass
+            return success, artifacts_info, error_msg
+        return wrapper
+    return decorator
@@ -0,0 +1,144 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from os.path import join, exists, isdir, getmtime, getsize
+from os import makedirs, remove, rename, walk
+from json import dump, load
+
+from qp_target_gene.cache import compute_file_checksum
+
+
+CHECKPOINTS_DIR = '.checkpoints'
+
+
+def _expand(fps):
+    """Returns the files in fps, replacing the directories by their files"""
+    files = []
+    for fp in fps:
+        if isdir(fp):
+            for root, _, fnames in walk(fp):
+                files.extend(join(root, f) for f in fnames)
+        else:
+            files.append(fp)
+    return sorted(files)
+
+
+class Checkpoints(object):
+    """Records the stages of a job completed in its output directory
+
+    Parameters
+    ----------
+    out_dir : str
+        The job output directory
+
+    Notes
+    -----
+    A stage is complete if its marker exists, its inputs have the same
+    checksums as when it was completed, and its outputs are still present
+    with the same checksums. As the outputs of a stage are the inputs of the
+    next ones, re-running a stage invalidates the stages that depend on it.
+    """
+    def __init__(self, out_dir):
+        self.checkpoints_dir = join(out_dir, CHECKPOINTS_DIR)
+        self._checksums = {}
+
+    def _marker_fp(self, stage):
+        return join(self.checkpoints_dir, '%s.json' % stage)
+
+    def checksum(self, fp):
+        """Returns the md5 of a file, computing it once per file version
+
+        Parameters
+        ----------
+        fp : str
+            The filepath
+
+        Returns
+        -------
+        str or None
+            The md5 of the file, None if it doesn't exist
+        """
+        if not exists(fp):
+            return None
+        version = (fp, getsize(fp), getmtime(fp))
+        if version not in self._checksums:
+            self._checksums[version] = compute_file_checksum(fp)
+        return self._checksums[version]
+
+    def _checksums_of(self, fps):
+        return {fp: self.checksum(fp) for fp in _expand(fps)}
+
+    def is_complete(self, stage, inputs, key=''):
+        """Checks if a stage was completed with the same inputs
+
+        Parameters
+        ----------
+        stage : str
+            The stage name
+        inputs : list of str
+            The input files or directories of the stage
+        key : str, optional
+            Any other value the stage outputs depend on, e.g. its command
+
+        Returns
+        -------
+        bool
+            Whether the stage outputs can be reused
+        """
+        marker_fp = self._marker_fp(stage)
+        if not exists(marker_fp):
+            return False
+        try:
+            with open(marker_fp) as f:
+                marker = load(f)
+        except ValueError:
+            # an incomplete marker
+            return False
+        if marker['key'] != key:
+            return False
+        if marker['inputs'] != self._checksums_of(inputs):
+            return False
+        return all(self.checksum(fp) == checksum
+                   for fp, checksum in marker['outputs'].items())
+
+    def start(self, stage):
+        """Removes the marker of a stage, before its outputs are modified
+
+        Parameters
+        ----------
+        stage : str
+            The stage name
+        """
+        marker_fp = self._marker_fp(stage)
+        if exists(marker_fp):
+            remove(marker_fp)
+
+    def complete(self, stage, inputs, outputs, key=''):
+        """Marks a stage as completed
+
+        Parameters
+        ----------
+        stage : str
+            The stage name
+        inputs : list of str
+            The input files or directories of the stage
+        outputs : list of str
+            The output files or directories of the stage
+        key : str, optional
+            Any other value the stage outputs depend on, e.g. its command
+        """
+        if not exists(self.checkpoints_dir):
+            makedirs(self.checkpoints_dir)
+        marker = {'key': key, 'inputs': self._checksums_of(inputs),
+                  'outputs': self._checksums_of(outputs)}
+        # writing and renaming, so an interrupted job never leaves an
+        # incomplete marker
+        marker_fp = self._marker_fp(stage)
+        with open(marker_fp + '.tmp', 'w') as f:
+            dump(marker, f, indent=4, sort_keys=True)
+        rename(marker_fp + '.tmp', marker_fp)
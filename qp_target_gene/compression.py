@@ -0,0 +1,386 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from os import rename, makedirs
+from os.path import getsize, join, basename, exists
+from io import RawIOBase, BufferedReader, BytesIO
+from mmap import mmap, ACCESS_READ
+from multiprocessing.pool import ThreadPool
+from collections import deque
+from contextlib import contextmanager
+from struct import Struct
+from shutil import copyfileobj
+import zlib
+import gzip
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+GZIP = 'gzip'
+BGZF = 'bgzf'
+ZSTD = 'zstd'
+
+# the extensions of the compressed files, as removed from the output names
+COMPRESSION_EXTENSIONS = ('.gz', '.bgz', '.zst')
+
+# the compressions QIIME 1 reads by itself; BGZF files are valid gzip files
+QIIME_COMPRESSIONS = (None, GZIP, BGZF)
+
+# the threads decompressing the blocks of a BGZF file
+DECOMPRESSION_THREADS = 4
+
+# the BGZF blocks decompressed by each task; the blocks hold up to 64KB, so
+# grouping them keeps the overhead of the tasks low
+BGZF_BLOCKS_PER_TASK = 16
+
+# the bytes read at a time by `iter_chunks`
+CHUNK_SIZE = 2 ** 24
+
+_ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+_GZIP_MAGIC = b'\x1f\x8b'
+# the gzip header of a BGZF block: magic, method, flags, mtime, extra flags,
+# os and the length of the extra field
+_GZIP_HEADER = Struct('<2sBBIBBH')
+_BGZF_FEXTRA = 4
+_SUBFIELD = Struct('<2sH')
+_BSIZE = Struct('<H')
+_TRAILER = Struct('<II')
+
+
+def detect_compression(fp):
+    """Detects the compression of a file from its first bytes
+
+    Parameters
+    ----------
+    fp : str
+        The filepath
+
+    Returns
+    -------
+    str or None
+        GZIP, BGZF or ZSTD, or None if the file is not compressed
+    """
+    with open(fp, 'rb') as f:
+        header = f.read(_GZIP_HEADER.size)
+        if header[:4] == _ZSTD_MAGIC:
+            return ZSTD
+        if header[:2] != _GZIP_MAGIC:
+            return None
+        if len(header) == _GZIP_HEADER.size:
+            fields = _GZIP_HEADER.unpack(header)
+            if fields[2] & _BGZF_FEXTRA and \
+                    _bgzf_block_size(f.read(fields[-1])) is not None:
+                return BGZF
+        return GZIP
+
+
+def strip_compression_extension(name):
+    """Removes the compression extension of a filename, if any
+
+    Parameters
+    ----------
+    name : str
+        The filename
+
+    Returns
+    -------
+    str
+        The filename without its compression extension
+    """
+    for ext in COMPRESSION_EXTENSIONS:
+        if name.endswith(ext):
+            return name[:-len(ext)]
+    return name
+
+
+def _bgzf_block_size(extra):
+    """Returns the size of a BGZF block, or None if it is not a BGZF block"""
+    pos = 0
+    while pos + _SUBFIELD.size <= len(extra):
+        sub_id, length = _SUBFIELD.unpack_from(extra, pos)
+        pos += _SUBFIELD.size
+        if sub_id == b'BC' and length == 2:
+            return _BSIZE.unpack_from(extra, pos)[0] + 1
+        pos += length
+    return None
+
+
+def _inflate_blocks(blocks):
+    """Decompresses a list of BGZF blocks, checking their CRC"""
+    result = []
+    for cdata, crc, size in blocks:
+        data = zlib.decompress(cdata, -zlib.MAX_WBITS)
+        if len(data) != size or zlib.crc32(data) & 0xFFFFFFFF != crc:
+            raise ValueError("Corrupted BGZF block")
+        result.append(data)
+    return b''.join(result)
+
+
+class _BGZFReader(RawIOBase):
+    """Reads a BGZF file, decompressing its blocks in parallel
+
+    BGZF files are a series of gzip members of up to 64KB with their size in
+    the header, so the blocks are split without decompressing them and
+    decompressed concurrently; zlib releases the GIL while decompressing. At
+    most twice as many tasks as threads are in flight, so the memory used
+    doesn't depend on the size of the file.
+    """
+    def __init__(self, fp, threads):
+        self._fh = open(fp, 'rb')
+        self._threads = threads
+        self._pool = ThreadPool(max(threads, 1))
+        self._data = self._decompressed()
+        self._buffer = b''
+        self._offset = 0
+
+    def readable(self):
+        return True
+
+    def _blocks(self):
+        """Yields the compressed data, CRC and size of each block"""
+        while True:
+            header = self._fh.read(_GZIP_HEADER.size)
+            if not header:
+                return
+            if len(header) < _GZIP_HEADER.size:
+                raise ValueError("Truncated BGZF file")
+            xlen = _GZIP_HEADER.unpack(header)[-1]
+            extra = self._fh.read(xlen)
+            size = _bgzf_block_size(extra)
+            if header[:2] != _GZIP_MAGIC or size is None:
+                raise ValueError("Not a BGZF block")
+            body = self._fh.read(size - _GZIP_HEADER.size - xlen)
+            if len(body) != size - _GZIP_HEADER.size - xlen:
+                raise ValueError("Truncated BGZF file")
+            crc, isize = _TRAILER.unpack(body[-_TRAILER.size:])
+            yield body[:-_TRAILER.size], crc, isize
+
+    def _decompressed(self):
+        """Yields the decompressed data, in the file order"""
+        pending = deque()
+        tasks = []
+        for block in self._blocks():
+            tasks.append(block)
+            if len(tasks) == BGZF_BLOCKS_PER_TASK:
+                pending.append(self._pool.apply_async(_inflate_blocks,
+                                                      (tasks,)))
+                tasks = []
+                if len(pending) >= 2 * self._threads:
+                    yield pending.popleft().get()
+        if tasks:
+            pending.append(self._pool.apply_async(_inflate_blocks, (tasks,)))
+        while pending:
+            yield pending.popleft().get()
+
+    def readinto(self, b):
+        while self._offset == len(self._buffer):
+            try:
+                self._buffer = next(self._data)
+            except StopIteration:
+                return 0
+            self._offset = 0
+        n = min(len(b), len(self._buffer) - self._offset)
+        b[:n] = self._buffer[self._offset:self._offset + n]
+        self._offset += n
+        return n
+
+    def close(self):
+        if not self.closed:
+            self._pool.terminate()
+            self._fh.close()
+        super(_BGZFReader, self).close()
+
+
+class _MappedFile(object):
+    """Reads a memory map as a file
+
+    Parameters
+    ----------
+    mm : mmap
+        The memory map
+
+    Notes
+    -----
+    In python 2, `mmap.read` needs the number of bytes to read; here it
+    defaults to the rest of the map, as in file objects.
+    """
+    def __init__(self, mm):
+        self._mm = mm
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = len(self._mm) - self._mm.tell()
+        return self._mm.read(size)
+
+
+def open_input(fp, threads=DECOMPRESSION_THREADS):
+    """Opens a file for reading, decompressing it if needed
+
+    Parameters
+    ----------
+    fp : str
+        The filepath
+    threads : int, optional
+        The threads decompressing the blocks of BGZF files
+
+    Returns
+    -------
+    file object
+        The buffered binary stream of the decompressed contents
+
+    Raises
+    ------
+    ValueError
+        If the file is zstd compressed and the zstandard package is not
+        installed
+
+    Notes
+    -----
+    The compression is detected from the first bytes of the file, not from
+    its name. The blocks of BGZF files are decompressed in parallel; gzip
+    and zstd files are decompressed as a single stream.
+    """
+    compression = detect_compression(fp)
+    if compression == BGZF:
+        return BufferedReader(_BGZFReader(fp, threads))
+    if compression == GZIP:
+        return gzip.open(fp, 'rb')
+    if compression == ZSTD:
+        if zstandard is None:
+            raise ValueError("%s is zstd compressed, which needs the "
+                             "zstandard package" % fp)
+        fh = open(fp, 'rb')
+        return BufferedReader(
+            zstandard.ZstdDecompressor().stream_reader(fh, closefd=True))
+    return open(fp, 'rb')
+
+
+@contextmanager
+def map_input(fp, threads=DECOMPRESSION_THREADS):
+    """Opens a file for reading, memory mapping it if not compressed
+
+    Parameters
+    ----------
+    fp : str
+        The filepath
+    threads : int, optional
+        The threads decompressing the blocks of BGZF files
+
+    Returns
+    -------
+    file-like object
+        The memory map of the file, or the stream of its decompressed
+        contents if it is compressed. Both support `read`, with or without
+        a size
+
+    Notes
+    -----
+    The memory map reads the file from the page cache, without copying it
+    to the process.
+    """
+    if detect_compression(fp) is not None:
+        with open_input(fp, threads) as f:
+            yield f
+    elif not getsize(fp):
+        # empty files can't be mapped
+        yield BytesIO()
+    else:
+        with open(fp, 'rb') as f:
+            mm = mmap(f.fileno(), 0, access=ACCESS_READ)
+            try:
+                yield _MappedFile(mm)
+            finally:
+                mm.close()
+
+
+def iter_chunks(fp, chunk_size=CHUNK_SIZE, threads=DECOMPRESSION_THREADS):
+    """Yields the decompressed contents of a file, a chunk at a time
+
+    Parameters
+    ----------
+    fp : str
+        The filepath
+    chunk_size : int, optional
+        The bytes of each chunk
+    threads : int, optional
+        The threads decompressing the blocks of BGZF files
+
+    Returns
+    -------
+    generator of bytes
+        The chunks of the file
+    """
+    with map_input(fp, threads) as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+
+def decompress_file(fp, out_fp, threads=DECOMPRESSION_THREADS):
+    """Writes the decompressed contents of a file
+
+    Parameters
+    ----------
+    fp : str
+        The compressed filepath
+    out_fp : str
+        The output filepath
+    threads : int, optional
+        The threads decompressing the blocks of BGZF files
+
+    Returns
+    -------
+    str
+        The output filepath
+
+    Notes
+    -----
+    The output is written to a temporary file and renamed once complete, so
+    an interrupted decompression doesn't leave a partial output behind.
+    """
+    tmp_fp = '%s.tmp' % out_fp
+    with open_input(fp, threads) as f, open(tmp_fp, 'wb') as out:
+        copyfileobj(f, out, CHUNK_SIZE)
+    rename(tmp_fp, out_fp)
+    return out_fp
+
+
+def decompress_unsupported(fps, out_dir, supported=QIIME_COMPRESSIONS,
+                           threads=DECOMPRESSION_THREADS):
+    """Decompresses the files whose compression an external tool can't read
+
+    Parameters
+    ----------
+    fps : list of str
+        The filepaths
+    out_dir : str
+        The directory of the decompressed files
+    supported : tuple, optional
+        The compressions the tool reads, None meaning uncompressed files
+    threads : int, optional
+        The threads decompressing the blocks of BGZF files
+
+    Returns
+    -------
+    list of str
+        The filepaths, with the decompressed filepath in place of the files
+        whose compression is not supported
+    """
+    result = []
+    for fp in fps:
+        if detect_compression(fp) not in supported:
+            if not exists(out_dir):
+                makedirs(out_dir)
+            fp = decompress_file(fp, join(
+                out_dir, strip_compression_extension(basename(fp))), threads)
+        result.append(fp)
+    return result
@@ -0,0 +1,97 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from os import environ
+from os.path import join, dirname, abspath, exists
+
+from future.moves.configparser import ConfigParser
+
+
+# the configuration file with the default value of each option
+DEFAULT_CONFIG_FP = join(dirname(abspath(__file__)), 'support_files',
+                         'config_file.cfg')
+
+
+def get_plugin_config_fp():
+    """Returns the path to the plugin configuration file written by Qiita
+
+    Returns
+    -------
+    str
+        The configuration file written by `configure_target_gene`, in the
+        ~/.qiita_plugins directory
+    """
+    # importing here to avoid a circular import, as the commands read their
+    # options from this module
+    from qp_target_gene import plugin
+    return plugin.conf_fp
+
+
+def get_config_fps():
+    """Returns the paths to the configuration files the options are read from
+
+    Returns
+    -------
+    list of str
+        The default configuration file, the plugin configuration file and
+        the file in the QP_TARGET_GENE_CONFIG_FP environment variable, if
+        they exist. The options of each file override those of the previous
+        ones
+    """
+    fps = [DEFAULT_CONFIG_FP, get_plugin_config_fp(),
+           environ.get('QP_TARGET_GENE_CONFIG_FP')]
+    return [fp for fp in fps if fp and exists(fp)]
+
+
+def get_config_value(section, option, default=''):
+    """Returns a value from the plugin configuration
+
+    Parameters
+    ----------
+    section : str
+        The configuration section
+    option : str
+        The option name
+    default : str, optional
+        The value to return if the option is not set
+
+    Returns
+    -------
+    str
+        The option value
+    """
+    config = ConfigParser()
+    config.read(get_config_fps())
+    if not config.has_option(section, option):
+        return default
+    value = config.get(section, option).strip()
+    return value if value else default
+
+
+def write_plugin_options(conf_fp):
+    """Adds the plugin options, with their defaults, to a configuration file
+
+    Parameters
+    ----------
+    conf_fp : str
+        The configuration file, e.g. the one written by Qiita's
+        `generate_config`
+
+    Notes
+    -----
+    All the sections of the default configuration file but [main], whose
+    options are written by Qiita, are appended with their comments, so the
+    options can be set without modifying the installed package.
+    """
+    with open(DEFAULT_CONFIG_FP) as f:
+        lines = f.readlines()
+    start = [i for i, line in enumerate(lines)
+             if line.startswith('[') and line.strip() != '[main]'][0]
+    with open(conf_fp, 'a') as f:
+        f.write('\n')
+        f.writelines(lines[start:])
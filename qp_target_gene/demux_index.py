@@ -0,0 +1,362 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from os.path import exists, getsize, getmtime
+from os import rename
+from json import dumps, load
+from bisect import bisect_right
+from collections import namedtuple
+
+from h5py import File
+
+from qp_target_gene.manifest import ChecksumWriter
+
+
+INDEX_SUFFIX = '.index.json'
+
+# the reads of a chunk of a sample; start is the index of the first read
+# within the sample
+DemuxBatch = namedtuple('DemuxBatch', [
+    'sample', 'start', 'sequence', 'qual', 'bc_original', 'bc_corrected',
+    'bc_error'])
+
+# the number of reads read from the demux file at a time
+CHUNK_SIZE = 50000
+
+# the length statistics of each sample, as stored by qiita_files
+_STATS = ('min', 'max', 'mean', 'median', 'std')
+
+
+def _stats(attrs):
+    """Returns the read length statistics in the attributes of a group"""
+    stats = {}
+    for s in _STATS:
+        if s in attrs:
+            v = attrs[s]
+            stats[s] = float(v) if s in ('mean', 'median', 'std') else int(v)
+    return stats
+
+
+def index_fp(demux_fp):
+    """Returns the filepath of the index of a demux file
+
+    Parameters
+    ----------
+    demux_fp : str
+        The demux filepath
+
+    Returns
+    -------
+    str
+        The index filepath
+    """
+    return demux_fp + INDEX_SUFFIX
+
+
+class DemuxIndex(object):
+    """The position and length statistics of the samples of a demux file
+
+    Parameters
+    ----------
+    samples : list of dict
+        The name, number of reads and length statistics of each sample, in
+        the order of the demux file
+    has_qual : bool
+        Whether the demux file has quality scores
+    stats : dict, optional
+        The length statistics of all the reads
+
+    Notes
+    -----
+    Each sample gets the offset of its first read, i.e. the position of the
+    read if all the samples were concatenated in the order of the demux
+    file, so a range of reads can be read without going through the
+    previous samples.
+    """
+    def __init__(self, samples, has_qual, stats=None):
+        self.has_qual = has_qual
+        self.stats = stats or {}
+        self.samples = []
+        self._by_name = {}
+        offset = 0
+        for sample in samples:
+            sample = dict(sample, offset=offset)
+            offset += sample['count']
+            self._by_name[sample['name']] = sample
+            self.samples.append(sample)
+        self.total = offset
+        self._offsets = [s['offset'] for s in self.samples]
+
+    @classmethod
+    def build(cls, demux_fp):
+        """Builds the index of a demux file
+
+        Parameters
+        ----------
+        demux_fp : str
+            The demux filepath
+
+        Returns
+        -------
+        DemuxIndex
+            The index
+
+        Notes
+        -----
+        Only the attributes of the samples are read, not their reads.
+        """
+        with File(demux_fp, 'r') as fh:
+            samples = []
+            for name in fh:
+                attrs = fh[name].attrs
+                sample = {'name': name, 'count': int(attrs['n'])}
+                sample.update(_stats(attrs))
+                samples.append(sample)
+            return cls(samples, bool(fh.attrs['has-qual']), _stats(fh.attrs))
+
+    @classmethod
+    def load(cls, demux_fp):
+        """Loads the index of a demux file, building it if needed
+
+        Parameters
+        ----------
+        demux_fp : str
+            The demux filepath
+
+        Returns
+        -------
+        DemuxIndex
+            The index
+
+        Notes
+        -----
+        The index written by `write` is used if the demux file hasn't changed
+        since, i.e. it has the same size and modification time, in seconds as
+        file copies may not keep fractions of a second. Otherwise, e.g. for
+        demux files not generated by the plugin, the index is built again.
+        """
+        fp = index_fp(demux_fp)
+        if exists(fp):
+            try:
+                with open(fp) as f:
+                    info = load(f)
+            except ValueError:
+                info = None
+            if info is not None and \
+                    info['demux_size'] == getsize(demux_fp) and \
+                    int(info['demux_mtime']) == int(getmtime(demux_fp)):
+                return cls(info['samples'], info['has_qual'], info['stats'])
+        return cls.build(demux_fp)
+
+    def write(self, demux_fp, manifest=None):
+        """Writes the index next to its demux file
+
+        Parameters
+        ----------
+        demux_fp : str
+            The demux filepath
+        manifest : qp_target_gene.manifest.Manifest, optional
+            The manifest where the checksum of the index is recorded
+
+        Returns
+        -------
+        str
+            The index filepath
+        """
+        fp = index_fp(demux_fp)
+        info = {'demux_size': getsize(demux_fp),
+                'demux_mtime': int(getmtime(demux_fp)),
+                'has_qual': self.has_qual, 'stats': self.stats,
+                'total': self.total, 'samples': self.samples}
+        with ChecksumWriter(open(fp + '.tmp', 'wb')) as f:
+            f.write(dumps(info, indent=4, sort_keys=True).encode('utf-8'))
+        rename(fp + '.tmp', fp)
+        if manifest is not None:
+            manifest.add(fp, f.checksum, f.size)
+        return fp
+
+    @property
+    def names(self):
+        """The sample names, in the order of the demux file"""
+        return [s['name'] for s in self.samples]
+
+    def __contains__(self, name):
+        return name in self._by_name
+
+    def __getitem__(self, name):
+        return self._by_name[name]
+
+    def count(self, samples=None):
+        """Returns the number of reads of a set of samples
+
+        Parameters
+        ----------
+        samples : list of str, optional
+            The sample names. Defaults to all the samples
+
+        Returns
+        -------
+        int
+            The number of reads
+
+        Raises
+        ------
+        KeyError
+            If a sample is not in the demux file
+        """
+        if samples is None:
+            return self.total
+        return sum(self._by_name[s]['count'] for s in samples)
+
+    def locate(self, position):
+        """Returns the sample and index within the sample of a read
+
+        Parameters
+        ----------
+        position : int
+            The position of the read in the demux file
+
+        Returns
+        -------
+        str, int
+            The sample name and the index of the read within the sample
+
+        Raises
+        ------
+        IndexError
+            If the position is out of range
+        """
+        if not 0 <= position < self.total:
+            raise IndexError("Read %d out of range, the demux file has %d "
+                             "reads" % (position, self.total))
+        # empty samples share the offset of the next one, so the last sample
+        # starting before the position is the one containing it
+        sample = self.samples[bisect_right(self._offsets, position) - 1]
+        return sample['name'], position - sample['offset']
+
+    def fetch_batches(self, fh, samples=None, start=0, stop=None,
+                      chunk_size=CHUNK_SIZE):
+        """Yields the reads of a set of samples, a chunk at a time
+
+        Parameters
+        ----------
+        fh : h5py.File
+            The open demux file
+        samples : list of str, optional
+            The samples, in the order their reads are yielded. Defaults to all
+            the samples, in the order of the demux file
+        start, stop : int, optional
+            The first and last (excluded) positions of the reads yielded,
+            counted over all the samples. Only used if `samples` is not given
+        chunk_size : int, optional
+            The maximum number of reads of each batch
+
+        Returns
+        -------
+        generator of DemuxBatch
+            The reads of each chunk, as stored in the demux file: the
+            sequences, the quality scores padded to the longest read (None if
+            the file has no qualities), and the barcodes. A batch only
+            contains reads of one sample
+
+        Raises
+        ------
+        KeyError
+            If a sample is not in the demux file
+
+        Notes
+        -----
+        Only the requested reads are read, so the time and memory used depend
+        on the size of the subset, not of the file.
+        """
+        if samples is not None:
+            ranges = [(self._by_name[s], 0, self._by_name[s]['count'])
+                      for s in samples]
+        else:
+            stop = self.total if stop is None else min(stop, self.total)
+            ranges = []
+            for s in self.samples:
+                s_start = max(start - s['offset'], 0)
+                s_stop = min(stop - s['offset'], s['count'])
+                if s_start < s_stop:
+                    ranges.append((s, s_start, s_stop))
+
+        for sample, s_start, s_stop in ranges:
+            grp = fh[sample['name']]
+            name = sample['name'].encode('utf-8')
+            for c_start in range(s_start, s_stop, chunk_size):
+                c_stop = min(c_start + chunk_size, s_stop)
+                yield DemuxBatch(
+                    name, c_start, grp['sequence'][c_start:c_stop],
+                    grp['qual'][c_start:c_stop] if self.has_qual else None,
+                    grp['barcode/original'][c_start:c_stop],
+                    grp['barcode/corrected'][c_start:c_stop],
+                    grp['barcode/error'][c_start:c_stop])
+
+    def fetch(self, fh, samples=None, start=0, stop=None,
+              chunk_size=CHUNK_SIZE):
+        """Yields the reads of a set of samples
+
+        Parameters
+        ----------
+        fh : h5py.File
+            The open demux file
+        samples : list of str, optional
+            The samples, in the order their reads are yielded. Defaults to all
+            the samples, in the order of the demux file
+        start, stop : int, optional
+            The first and last (excluded) positions of the reads yielded,
+            counted over all the samples. Only used if `samples` is not given
+        chunk_size : int, optional
+            The number of reads read from the file at a time
+
+        Returns
+        -------
+        generator of (bytes, int, bytes, np.array or None, bytes, bytes, int)
+            The sample name, the index of the read within the sample, the
+            sequence, the quality scores, the original and corrected barcodes
+            and the barcode errors, as yielded by `qiita_files.demux.fetch`
+
+        Raises
+        ------
+        KeyError
+            If a sample is not in the demux file
+
+        Notes
+        -----
+        Only the requested reads are read, in chunks, so the time and memory
+        used depend on the size of the subset, not of the file.
+        """
+        for batch in self.fetch_batches(fh, samples, start, stop, chunk_size):
+            for i, seq in enumerate(batch.sequence):
+                qual = None
+                if batch.qual is not None:
+                    qual = batch.qual[i][:len(seq)]
+                yield (batch.sample, batch.start + i, seq, qual,
+                       batch.bc_original[i], batch.bc_corrected[i],
+                       batch.bc_error[i])
+
+
+def write_demux_index(demux_fp, manifest=None):
+    """Builds and writes the index of a demux file
+
+    Parameters
+    ----------
+    demux_fp : str
+        The demux filepath
+    manifest : qp_target_gene.manifest.Manifest, optional
+        The manifest where the checksum of the index is recorded
+
+    Returns
+    -------
+    DemuxIndex
+        The index
+    """
+    index = DemuxIndex.build(demux_fp)
+    index.write(demux_fp, manifest)
+    return index
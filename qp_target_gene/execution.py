@@ -0,0 +1,308 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from os.path import join, exists, basename
+from os import makedirs, rename, wait4, WIFSIGNALED, WTERMSIG, WEXITSTATUS
+from collections import namedtuple, deque
+from subprocess import Popen, PIPE
+from threading import Thread
+from functools import partial
+from time import time
+from sys import platform
+import re
+try:
+    from shutil import which
+except ImportError:
+    from distutils.spawn import find_executable as which
+
+from qp_target_gene.config import get_config_value
+
+
+# ru_maxrss is reported in bytes in OS X and in kilobytes everywhere else
+MAXRSS_UNIT = 1 if platform == 'darwin' else 1024
+
+# ru_inblock and ru_oublock are counted in 512 bytes blocks
+BLOCK_SIZE = 512
+
+IO_CLASSES = {'realtime': '1', 'best-effort': '2', 'idle': '3'}
+
+# the output files are rotated when they reach LOG_MAX_BYTES, keeping the
+# LOG_BACKUP_COUNT previous files
+LOG_MAX_BYTES = 50 * 1024 ** 2
+LOG_BACKUP_COUNT = 2
+
+# the end of the output kept in memory, used in the error messages
+TAIL_BYTES = 64 * 1024
+
+# lines longer than this are split
+LINE_MAX_BYTES = 64 * 1024
+
+# the lines reporting the progress of a command, e.g. "45% done"
+PROGRESS_RE = r'\d+(\.\d+)?\s*%'
+
+CommandResult = namedtuple(
+    'CommandResult', ['return_value', 'stdout_fp', 'stderr_fp',
+                      'stdout_tail', 'stderr_tail', 'usage'])
+
+
+class ResourceLimits(object):
+    """The resources the external commands are allowed to use
+
+    Parameters
+    ----------
+    cpu_affinity : str, optional
+        The CPUs the commands can run on, in taskset's list format, e.g.
+        '0-3,8'. None to use all of them
+    memory_limit : float, optional
+        The maximum virtual memory of each process, in GB. None for no limit
+    nice : int, optional
+        The niceness added to the commands
+    io_class : str, optional
+        The I/O scheduling class: 'realtime', 'best-effort' or 'idle'. None
+        to keep the default
+    io_priority : int, optional
+        The priority within the I/O scheduling class, from 0 (highest) to 7
+
+    Notes
+    -----
+    The CPU affinity and I/O priority are set with taskset and ionice, so
+    they are only applied where these tools are available, i.e. Linux. The
+    niceness is set with nice and the memory limit with the shell's ulimit,
+    so no Python code runs in the child process before the command starts.
+    The limits are inherited by all the processes started by the command.
+    """
+    def __init__(self, cpu_affinity=None, memory_limit=None, nice=0,
+                 io_class=None, io_priority=None):
+        if io_class is not None and io_class not in IO_CLASSES:
+            raise ValueError("Unknown I/O class: %s. Please, choose a value "
+                             "from %s" % (io_class, ', '.join(IO_CLASSES)))
+        self.cpu_affinity = cpu_affinity
+        self.memory_limit = memory_limit
+        self.nice = nice
+        self.io_class = io_class
+        self.io_priority = io_priority
+
+    @classmethod
+    def from_config(cls):
+        """Creates the limits set in the plugin configuration file
+
+        Returns
+        -------
+        ResourceLimits
+            The limits in the [resources] section
+        """
+        def value(option, type_):
+            v = get_config_value('resources', option)
+            return type_(v) if v else None
+
+        return cls(cpu_affinity=value('CPU_AFFINITY', str),
+                   memory_limit=value('MEMORY_LIMIT', float),
+                   nice=value('NICE', int) or 0,
+                   io_class=value('IO_CLASS', str),
+                   io_priority=value('IO_PRIORITY', int))
+
+    def wrap(self, cmd):
+        """Returns the arguments running a shell command within the limits
+
+        Parameters
+        ----------
+        cmd : str
+            The shell command
+
+        Returns
+        -------
+        list of str
+            The program arguments
+        """
+        args = []
+        if self.cpu_affinity and which('taskset'):
+            args.extend(['taskset', '-c', self.cpu_affinity])
+        if self.io_class and which('ionice'):
+            args.extend(['ionice', '-c', IO_CLASSES[self.io_class]])
+            if self.io_priority is not None and self.io_class != 'idle':
+                args.extend(['-n', str(self.io_priority)])
+        if self.nice:
+            args.extend(['nice', '-n', str(self.nice)])
+        if self.memory_limit:
+            # ulimit -v is in KB; the command doesn't run if it can't be set
+            cmd = 'ulimit -v %d || exit 1\n%s' % (
+                int(self.memory_limit * 1024 ** 2), cmd)
+        args.extend(['/bin/sh', '-c', cmd])
+        return args
+
+
+class _OutputStream(object):
+    """Copies the output of a command to a rotating file, keeping its tail
+
+    Parameters
+    ----------
+    fp : str
+        The filepath
+    max_bytes : int
+        The size at which the file is rotated
+    backup_count : int
+        The number of rotated files kept, as fp.1, fp.2...
+    tail_bytes : int
+        The maximum size of the tail kept in memory
+    on_line : function or None
+        Called with each decoded line
+    """
+    def __init__(self, fp, max_bytes, backup_count, tail_bytes, on_line):
+        self.fp = fp
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.tail_bytes = tail_bytes
+        self.on_line = on_line
+        self.size = 0
+        self.discarded = 0
+        self._tail = deque()
+        self._tail_size = 0
+        self._fh = open(fp, 'wb')
+
+    def _rotate(self):
+        self._fh.close()
+        for i in range(self.backup_count - 1, 0, -1):
+            src = '%s.%d' % (self.fp, i)
+            if exists(src):
+                rename(src, '%s.%d' % (self.fp, i + 1))
+        if self.backup_count > 0:
+            rename(self.fp, '%s.1' % self.fp)
+        self._fh = open(self.fp, 'wb')
+        self.size = 0
+
+    def write(self, line):
+        if self.size and self.size + len(line) > self.max_bytes:
+            self._rotate()
+        self._fh.write(line)
+        self.size += len(line)
+
+        self._tail.append(line)
+        self._tail_size += len(line)
+        while self._tail_size > self.tail_bytes and len(self._tail) > 1:
+            removed = self._tail.popleft()
+            self._tail_size -= len(removed)
+            self.discarded += len(removed)
+
+        if self.on_line is not None:
+            self.on_line(line.decode('utf-8', 'replace').rstrip())
+
+    def copy(self, pipe):
+        """Copies the pipe until it is closed"""
+        try:
+            for line in iter(lambda: pipe.readline(LINE_MAX_BYTES), b''):
+                self.write(line)
+        finally:
+            pipe.close()
+            self._fh.close()
+
+    def tail(self):
+        """Returns the last lines written"""
+        tail = b''.join(self._tail).decode('utf-8', 'replace')
+        if self.discarded:
+            tail = '[... %d bytes omitted]\n%s' % (self.discarded, tail)
+        return tail
+
+
+def _forward_progress(pattern, progress, line):
+    """Calls progress with line if it matches pattern"""
+    if pattern.search(line):
+        progress(line)
+
+
+def _log_fps(log_dir, cmd):
+    """Returns the stdout and stderr filepaths of a new command"""
+    if not exists(log_dir):
+        makedirs(log_dir)
+    program = basename(cmd.split()[0]) if cmd.split() else 'command'
+    i = 1
+    while exists(join(log_dir, '%d_%s.stdout.txt' % (i, program))):
+        i += 1
+    prefix = join(log_dir, '%d_%s' % (i, program))
+    return prefix + '.stdout.txt', prefix + '.stderr.txt'
+
+
+def run_command(cmd, log_dir, limits=None, progress=None,
+                progress_re=PROGRESS_RE, max_bytes=LOG_MAX_BYTES,
+                backup_count=LOG_BACKUP_COUNT, tail_bytes=TAIL_BYTES):
+    """Runs a shell command, streaming its output to files
+
+    Parameters
+    ----------
+    cmd : str
+        The shell command
+    log_dir : str
+        The directory where the standard output and error are written
+    limits : ResourceLimits, optional
+        The resource limits. Defaults to the limits in the plugin
+        configuration file
+    progress : function, optional
+        Called with each output line matching `progress_re`, as it is
+        written by the command
+    progress_re : str, optional
+        The regular expression identifying the progress lines. Defaults to
+        the lines containing a percentage
+    max_bytes : int, optional
+        The size at which the output files are rotated
+    backup_count : int, optional
+        The number of rotated output files kept
+    tail_bytes : int, optional
+        The maximum size of the end of the output kept in memory
+
+    Returns
+    -------
+    CommandResult
+        The return value, the standard output and error filepaths, their
+        last `tail_bytes`, and the resources used by the command: wall
+        time, CPU time, peak resident memory and bytes read and written to
+        disk
+
+    Notes
+    -----
+    The output is never held in memory in full, so chatty commands don't
+    increase the memory of the plugin or the size of the error messages.
+    """
+    if limits is None:
+        limits = ResourceLimits.from_config()
+    stdout_fp, stderr_fp = _log_fps(log_dir, cmd)
+
+    on_line = None
+    if progress is not None:
+        on_line = partial(_forward_progress, re.compile(progress_re), progress)
+
+    out = _OutputStream(stdout_fp, max_bytes, backup_count, tail_bytes,
+                        on_line)
+    err = _OutputStream(stderr_fp, max_bytes, backup_count, tail_bytes,
+                        on_line)
+
+    start = time()
+    # the limits are applied by the wrapping programs, as running Python
+    # code between fork and exec can deadlock in a threaded process
+    proc = Popen(limits.wrap(cmd), stdout=PIPE, stderr=PIPE, close_fds=True)
+    threads = [Thread(target=out.copy, args=(proc.stdout,)),
+               Thread(target=err.copy, args=(proc.stderr,))]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    # waiting with wait4 provides the resources used by the command
+    _, status, rusage = wait4(proc.pid, 0)
+    for t in threads:
+        t.join()
+    wall_time = time() - start
+
+    return_value = (-WTERMSIG(status) if WIFSIGNALED(status)
+                    else WEXITSTATUS(status))
+    # the process is already reaped, let Popen know
+    proc.returncode = return_value
+
+    usage = {'wall_time': wall_time,
+             'cpu_time': rusage.ru_utime + rusage.ru_stime,
+             'peak_rss': rusage.ru_maxrss * MAXRSS_UNIT,
+             'read_bytes': rusage.ru_inblock * BLOCK_SIZE,
+             'write_bytes': rusage.ru_oublock * BLOCK_SIZE}
+    return CommandResult(return_value, stdout_fp, stderr_fp, out.tail(),
+                         err.tail(), usage)
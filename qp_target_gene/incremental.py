@@ -0,0 +1,193 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from hashlib import md5
+from json import dumps, load, dump
+
+import numpy as np
+from h5py import File
+from biom import load_table
+from biom.util import biom_open
+
+from qiita_files.format.fasta import format_fasta_record
+
+from qp_target_gene.demux_index import DemuxIndex
+
+
+CHECKSUMS_FILENAME = 'sample_checksums.json'
+
+# the parameters that change the result of the OTU picking
+HASHED_PARAMETERS = ['reference-seq', 'reference-tax', 'similarity',
+                     'sortmerna_coverage', 'sortmerna_e_value',
+                     'sortmerna_max_pos']
+
+
+def parameters_hash(parameters):
+    """Hashes the parameters that define the OTU picking results
+
+    Parameters
+    ----------
+    parameters : dict
+        The command's parameters, keyed by parameter name
+
+    Returns
+    -------
+    str
+        The md5 of the parameters
+    """
+    values = {p: str(parameters[p]) for p in HASHED_PARAMETERS}
+    return md5(dumps(values, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def compute_sample_checksums(demux_fp, chunk_size=50000):
+    """Computes the checksum of the reads of each sample
+
+    Parameters
+    ----------
+    demux_fp : str
+        The demux filepath
+    chunk_size : int, optional
+        The number of reads read from the file at a time
+
+    Returns
+    -------
+    dict of {str: str}
+        The md5 of the sequences and qualities, keyed by sample name
+
+    Notes
+    -----
+    The checksums only depend on the sequences and qualities, not on how
+    they are padded inside the demux file, so the same sample gets the same
+    checksum in demux files with different sets of samples.
+    """
+    checksums = {}
+    with File(demux_fp, 'r') as fh:
+        has_qual = fh.attrs['has-qual']
+        for sample in fh:
+            grp = fh[sample]
+            seqs_ds = grp['sequence']
+            seqs_md5 = md5()
+            qual_md5 = md5()
+            for start in range(0, seqs_ds.shape[0], chunk_size):
+                seqs = seqs_ds[start:start + chunk_size].tolist()
+                seqs_md5.update(b''.join(s + b'\n' for s in seqs))
+                if has_qual:
+                    qual = grp['qual'][start:start + chunk_size]
+                    lengths = np.array([len(s) for s in seqs])
+                    mask = np.arange(qual.shape[1]) < lengths[:, None]
+                    qual_md5.update(qual[mask].astype(np.uint8).tobytes())
+            digests = seqs_md5.hexdigest() + qual_md5.hexdigest()
+            checksums[sample] = md5(digests.encode('ascii')).hexdigest()
+    return checksums
+
+
+def write_checksums_file(fp, params_hash, checksums):
+    """Writes the file used to identify the samples of an OTU table
+
+    Parameters
+    ----------
+    fp : str
+        The output filepath
+    params_hash : str
+        The hash of the OTU picking parameters
+    checksums : dict of {str: str}
+        The checksum of each sample of the OTU table
+    """
+    with open(fp, 'w') as f:
+        dump({'parameters_hash': params_hash, 'samples': checksums}, f,
+             sort_keys=True, indent=4)
+
+
+def read_checksums_file(fp):
+    """Reads a file written by `write_checksums_file`
+
+    Parameters
+    ----------
+    fp : str
+        The checksums filepath
+
+    Returns
+    -------
+    str, dict of {str: str}
+        The hash of the OTU picking parameters
+        The checksum of each sample
+    """
+    with open(fp) as f:
+        info = load(f)
+    return info['parameters_hash'], info['samples']
+
+
+def find_changed_samples(previous, current):
+    """Splits the current samples in reusable and to be picked
+
+    Parameters
+    ----------
+    previous : dict of {str: str}
+        The sample checksums of the previous OTU table
+    current : dict of {str: str}
+        The sample checksums of the demux file
+
+    Returns
+    -------
+    list of str, list of str
+        The samples whose OTU counts can be reused
+        The samples that are new or have changed
+    """
+    reused = []
+    to_pick = []
+    for sample in sorted(current):
+        if previous.get(sample) == current[sample]:
+            reused.append(sample)
+        else:
+            to_pick.append(sample)
+    return reused, to_pick
+
+
+def write_samples_fasta(demux_fp, samples, fasta_fp):
+    """Writes the reads of the given samples as fasta
+
+    Parameters
+    ----------
+    demux_fp : str
+        The demux filepath
+    samples : list of str
+        The samples to write
+    fasta_fp : str
+        The output fasta filepath
+    """
+    id_fmt = b"%(sample)s_%(idx)d"
+    # only the reads of the given samples are read
+    index = DemuxIndex.load(demux_fp)
+    with open(fasta_fp, 'w') as ffh, File(demux_fp, 'r') as fh:
+        for samp, idx, seq, qual, _, _, _ in index.fetch(fh, samples=samples):
+            seq_id = id_fmt % {b'sample': samp, b'idx': idx}
+            ffh.write(format_fasta_record(seq_id, seq, qual))
+
+
+def merge_otu_tables(previous_fp, reused, new_fp, out_fp):
+    """Merges the reused samples of an OTU table with a newly picked one
+
+    Parameters
+    ----------
+    previous_fp : str
+        The previous OTU table filepath
+    reused : list of str
+        The samples to keep from the previous OTU table
+    new_fp : str or None
+        The newly picked OTU table filepath, None if no sample was picked
+    out_fp : str
+        The output OTU table filepath
+    """
+    table = load_table(previous_fp)
+    table.filter(reused, axis='sample')
+    if new_fp is not None:
+        table = table.merge(load_table(new_fp))
+    # OTUs only present in removed or changed samples
+    table.filter(lambda v, i, md: v.sum() > 0, axis='observation')
+    with biom_open(out_fp, 'w') as f:
+        table.to_hdf5(f, 'qp-target-gene')
@@ -0,0 +1,204 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from os.path import join, exists, dirname, relpath, getsize, getmtime
+from os import rename, remove
+from json import dump, load
+from zlib import crc32
+from collections import OrderedDict
+
+
+MANIFEST_FILENAME = 'manifest.json'
+
+
+class ChecksumWriter(object):
+    """Writes to a file, computing the checksum and size of what is written
+
+    Parameters
+    ----------
+    fh : file
+        The file, open for writing in binary mode
+    on_close : function, optional
+        Called with the writer once the file is closed
+
+    Notes
+    -----
+    The checksum is the CRC32 of the contents, as computed by Qiita's
+    `qiita_db.util.compute_checksum`
+    """
+    def __init__(self, fh, on_close=None):
+        self.fh = fh
+        self.crc = 0
+        self.size = 0
+        self._on_close = on_close
+
+    def write(self, data):
+        self.crc = crc32(data, self.crc)
+        self.size += len(data)
+        self.fh.write(data)
+
+    def flush(self):
+        self.fh.flush()
+
+    def close(self):
+        if not self.fh.closed:
+            self.fh.close()
+            if self._on_close is not None:
+                self._on_close(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def checksum(self):
+        # the & 0xFFFFFFFF gives the same value across python versions and
+        # platforms
+        return self.crc & 0xFFFFFFFF
+
+
+class Manifest(object):
+    """The checksums and sizes of the output files of a directory
+
+    Parameters
+    ----------
+    out_dir : str
+        The directory of the files. The manifest is kept in its
+        MANIFEST_FILENAME file
+
+    Notes
+    -----
+    The files written through `open` are checksummed as they are written,
+    so they are never read again. Each entry keeps the modification time of
+    the file, and entries of files modified afterwards are not used. Files
+    written otherwise, e.g. by external tools, are not checksummed.
+    """
+    def __init__(self, out_dir):
+        self.out_dir = out_dir
+        self.fp = join(out_dir, MANIFEST_FILENAME)
+        self.entries = OrderedDict()
+        if exists(self.fp):
+            with open(self.fp) as f:
+                self.entries = load(f, object_pairs_hook=OrderedDict)[
+                    'files']
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.save()
+
+    def _name(self, fp):
+        return relpath(fp, self.out_dir)
+
+    def open(self, fp):
+        """Opens a file for writing, recording its checksum once closed
+
+        Parameters
+        ----------
+        fp : str
+            The filepath, in the manifest directory
+
+        Returns
+        -------
+        ChecksumWriter
+            The file, open for writing in binary mode
+        """
+        return ChecksumWriter(
+            open(fp, 'wb'),
+            on_close=lambda w: self.add(fp, w.checksum, w.size))
+
+    def add(self, fp, checksum, size):
+        """Records the checksum and size of a file
+
+        Parameters
+        ----------
+        fp : str
+            The filepath, in the manifest directory
+        checksum : int
+            The CRC32 of the file contents
+        size : int
+            The size of the file, in bytes
+        """
+        self.entries[self._name(fp)] = {
+            'checksum': checksum, 'size': size, 'mtime': getmtime(fp)}
+
+    def get(self, fp):
+        """Returns the checksum and size of a file
+
+        Parameters
+        ----------
+        fp : str
+            The filepath, in the manifest directory
+
+        Returns
+        -------
+        (int, int) or None
+            The CRC32 of the file contents and its size, or None if the file
+            was not written through the manifest, such as the outputs of
+            external tools, or was modified since
+        """
+        entry = self.entries.get(self._name(fp))
+        if entry is None or not exists(fp) or \
+                entry['size'] != getsize(fp) or entry['mtime'] != getmtime(fp):
+            return None
+        return entry['checksum'], entry['size']
+
+    def save(self):
+        """Writes the manifest"""
+        tmp_fp = '%s.tmp' % self.fp
+        with open(tmp_fp, 'w') as f:
+            dump({'files': self.entries}, f, indent=4)
+        rename(tmp_fp, self.fp)
+
+
+def write_manifests(artifacts_info):
+    """Writes the manifests of the files of the artifacts
+
+    Parameters
+    ----------
+    artifacts_info : list of ArtifactInfo
+        The artifacts generated by a command
+
+    Returns
+    -------
+    list of str
+        The manifest filepaths, one per directory with checksummed artifact
+        files
+
+    Notes
+    -----
+    The manifest of each directory lists the checksum and size of its
+    artifact files, the values Qiita stores for each filepath. Only the
+    files checksummed while they were written are included, as reading the
+    others again would cost as much as Qiita checksumming them.
+    """
+    manifests = OrderedDict()
+    for ainfo in artifacts_info:
+        for fp, _ in ainfo.files:
+            out_dir = dirname(fp)
+            if out_dir not in manifests:
+                manifests[out_dir] = (Manifest(out_dir), [])
+            manifests[out_dir][1].append(fp)
+
+    written = []
+    for manifest, fps in manifests.values():
+        names = set(manifest._name(fp) for fp in fps
+                    if manifest.get(fp) is not None)
+        # only the artifact files are listed, not the intermediates
+        for name in list(manifest.entries):
+            if name not in names:
+                del manifest.entries[name]
+        if manifest.entries:
+            manifest.save()
+            written.append(manifest.fp)
+        elif exists(manifest.fp):
+            remove(manifest.fp)
+    return written
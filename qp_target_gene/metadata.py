@@ -0,0 +1,159 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from os.path import join, exists, getmtime
+from os import makedirs, rename, close
+from shutil import copyfile
+from hashlib import md5
+from tempfile import gettempdir, mkstemp
+from time import time
+
+
+# the artifact and prep information requested by this process, keyed by url,
+# with the time they were requested
+_RESPONSES = {}
+
+# number of seconds the responses are reused
+RESPONSES_MAX_AGE = 60
+
+
+def _get(qclient, url, **kwargs):
+    """Requests url to the Qiita server, reusing recent responses"""
+    now = time()
+    if url not in _RESPONSES or now - _RESPONSES[url][0] > RESPONSES_MAX_AGE:
+        _RESPONSES[url] = (now, qclient.get(url, **kwargs))
+    return _RESPONSES[url][1]
+
+
+def get_artifact_info(qclient, artifact_id):
+    """Retrieves the artifact information
+
+    Parameters
+    ----------
+    qclient : tgp.qiita_client.QiitaClient
+        The Qiita server client
+    artifact_id : str
+        The artifact id
+
+    Returns
+    -------
+    dict
+        The artifact information
+    """
+    return _get(qclient, "/qiita_db/artifacts/%s/" % artifact_id)
+
+
+def get_artifact_filepaths(qclient, artifact_id):
+    """Retrieves the artifact filepaths
+
+    Parameters
+    ----------
+    qclient : tgp.qiita_client.QiitaClient
+        The Qiita server client
+    artifact_id : str
+        The artifact id
+
+    Returns
+    -------
+    dict of {str: list of str}
+        The artifact filepaths keyed by type. If the job is staged, the
+        filepaths of the local copies of the files
+    """
+    # importing here to avoid a circular import, as the staging prefetches
+    # the artifact files
+    from qp_target_gene.staging import local_filepath
+
+    a_info = get_artifact_info(qclient, artifact_id)
+    return {k: [local_filepath(vv['filepath']) for vv in v]
+            for k, v in a_info['files'].items()}
+
+
+def get_prep_info(qclient, prep_id):
+    """Retrieves the prep information, without fetching the prep file
+
+    Parameters
+    ----------
+    qclient : tgp.qiita_client.QiitaClient
+        The Qiita server client
+    prep_id : str
+        The prep information id
+
+    Returns
+    -------
+    dict
+        The prep information
+    """
+    return _get(qclient, '/qiita_db/prep_template/%s/' % prep_id,
+                no_file_fetching=True)
+
+
+def get_prep_file_derivative(qclient, prep_id, name, generate, out_fp,
+                             cache_dir=None, max_age=600):
+    """Writes a file generated from the prep file, reusing a recent one
+
+    Parameters
+    ----------
+    qclient : tgp.qiita_client.QiitaClient
+        The Qiita server client
+    prep_id : str
+        The prep information id
+    name : str
+        The name of the generated file, e.g. 'qiime-mapping-file'. The files
+        are reused by name, so files generated differently need different
+        names
+    generate : function
+        Generates the file, called as `generate(prep_fp, out_fp)`
+    out_fp : str
+        The output filepath
+    cache_dir : str, optional
+        The directory where the generated files are kept. Defaults to a
+        `qp-target-gene` folder in the system's temporary directory, so
+        jobs running in the same node share them
+    max_age : int, optional
+        The number of seconds a generated file is reused
+
+    Returns
+    -------
+    str
+        The output filepath
+
+    Notes
+    -----
+    Qiita writes a new, timestamped, prep file every time the prep
+    information is modified, so the generated files are keyed by the prep id
+    and the prep file path. On a hit the prep file is neither fetched from
+    Qiita nor parsed.
+    """
+    if cache_dir is None:
+        cache_dir = join(gettempdir(), 'qp-target-gene', 'prep')
+
+    prep_info = get_prep_info(qclient, prep_id)
+    key = md5(('%s:%s:%s' % (name, prep_id, prep_info['prep-file'])).encode(
+        'utf-8')).hexdigest()
+    cached_fp = join(cache_dir, key)
+
+    if exists(cached_fp) and time() - getmtime(cached_fp) < max_age:
+        copyfile(cached_fp, out_fp)
+        return out_fp
+
+    prep_fp = qclient.fetch_file_from_central(prep_info['prep-file'])
+    generate(prep_fp, out_fp)
+
+    if not exists(cache_dir):
+        try:
+            makedirs(cache_dir)
+        except OSError:
+            # another job created it in the mean time
+            pass
+    # copying and renaming, so other jobs never see an incomplete file
+    fd, tmp_fp = mkstemp(dir=cache_dir)
+    close(fd)
+    copyfile(out_fp, tmp_fp)
+    rename(tmp_fp, cached_fp)
+
+    return out_fp
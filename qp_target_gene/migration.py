@@ -0,0 +1,228 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from os.path import exists, getsize, basename
+from os import remove, rename, fsync
+from json import dumps, loads
+from gzip import GzipFile
+from multiprocessing.pool import ThreadPool
+
+from qp_target_gene.manifest import ChecksumWriter
+
+
+# the number of bytes read at a time while compressing
+BUFFER_SIZE = 1048576
+
+
+def compress_file(fp, compresslevel=6):
+    """Compresses a file with gzip, computing the checksum as it is written
+
+    Parameters
+    ----------
+    fp : str
+        The filepath
+    compresslevel : int, optional
+        The gzip compression level, from 1 (fastest) to 9 (smallest)
+
+    Returns
+    -------
+    str, int, int
+        The compressed filepath, i.e. `fp` ending in .gz
+        The CRC32 checksum of the compressed file
+        The size of the compressed file
+
+    Notes
+    -----
+    The compressed file is written with a temporary name and renamed once it
+    is complete. The original file is not removed.
+    """
+    gz_fp = '%s.gz' % fp
+    tmp_fp = '%s.tmp' % gz_fp
+    try:
+        with open(fp, 'rb') as src, open(tmp_fp, 'wb') as dst:
+            writer = ChecksumWriter(dst)
+            with GzipFile(filename=basename(fp), mode='wb',
+                          compresslevel=compresslevel, fileobj=writer) as gz:
+                for block in iter(lambda: src.read(BUFFER_SIZE), b''):
+                    gz.write(block)
+            dst.flush()
+            fsync(dst.fileno())
+    except Exception:
+        if exists(tmp_fp):
+            remove(tmp_fp)
+        raise
+    rename(tmp_fp, gz_fp)
+    return gz_fp, writer.checksum, writer.size
+
+
+class _Journal(object):
+    """Records the progress of a migration, so it can be resumed
+
+    Parameters
+    ----------
+    fp : str
+        The journal filepath. It is created if it doesn't exist
+
+    Notes
+    -----
+    Each line is a JSON object with the filepath id, the original filepath,
+    the compressed filepath, its checksum and size, and its state:
+    'compressed' once the compressed file is written and 'committed' once
+    the database points to it. The lines are flushed to disk as they are
+    written, so the journal survives an interruption.
+    """
+    def __init__(self, fp):
+        self.fp = fp
+        self.entries = {}
+        if exists(fp):
+            with open(fp) as f:
+                for line in f:
+                    try:
+                        entry = loads(line)
+                    except ValueError:
+                        # a line interrupted while being written
+                        continue
+                    self.entries[entry['filepath_id']] = entry
+        self._fh = open(fp, 'a')
+
+    def add(self, filepath_id, fp, gz_fp, checksum, size, state):
+        entry = {'filepath_id': filepath_id, 'fp': fp, 'gz_fp': gz_fp,
+                 'checksum': checksum, 'size': size, 'state': state}
+        self.entries[filepath_id] = entry
+        self._fh.write(dumps(entry, sort_keys=True) + '\n')
+        self._fh.flush()
+        fsync(self._fh.fileno())
+        return entry
+
+    def close(self):
+        self._fh.close()
+
+
+def _remove_original(entry):
+    """Removes the original file of a committed entry"""
+    if exists(entry['fp']) and exists(entry['gz_fp']):
+        remove(entry['fp'])
+
+
+def _compress(args):
+    """Compresses a file, returning the error instead of raising it"""
+    filepath_id, fp, compresslevel = args
+    try:
+        return filepath_id, fp, compress_file(fp, compresslevel), None
+    except Exception as e:
+        return filepath_id, fp, None, '%s: %s' % (type(e).__name__, e)
+
+
+def migrate_to_gz(store, journal_fp, threads=4, batch_size=100,
+                  compresslevel=6, progress=None):
+    """Compresses the files of a filepath store, updating their records
+
+    Parameters
+    ----------
+    store : object
+        The database layer. `store.pending()` returns the
+        (filepath_id, filepath) of the files to compress, and
+        `store.update(updates)` updates, in a single transaction, the
+        records in `updates`: a list of (filepath_id, filepath, checksum,
+        size)
+    journal_fp : str
+        The file recording the progress of the migration
+    threads : int, optional
+        The number of files compressed at the same time
+    batch_size : int, optional
+        The number of records updated in each transaction
+    compresslevel : int, optional
+        The gzip compression level
+    progress : function, optional
+        Called with a message every time a batch is committed
+
+    Returns
+    -------
+    dict of {str: int}
+        The number of files compressed, reused from an interrupted run and
+        committed
+
+    Raises
+    ------
+    ValueError
+        If a file couldn't be compressed. The other files are still
+        compressed and committed
+
+    Notes
+    -----
+    The files are compressed concurrently, and their checksum and size are
+    computed while they are written, so they are never read back. The
+    original files are removed once the database points to the compressed
+    ones, so an interruption never leaves a record pointing to a missing
+    file. Running the migration again with the same journal commits the
+    files already compressed, without compressing them again, and resumes
+    with the rest.
+    """
+    journal = _Journal(journal_fp)
+    stats = {'compressed': 0, 'reused': 0, 'committed': 0}
+    errors = []
+    batch = []
+
+    def commit():
+        store.update([(e['filepath_id'], e['gz_fp'], e['checksum'], e['size'])
+                      for e in batch])
+        for e in batch:
+            _remove_original(journal.add(
+                e['filepath_id'], e['fp'], e['gz_fp'], e['checksum'],
+                e['size'], 'committed'))
+        stats['committed'] += len(batch)
+        del batch[:]
+        if progress is not None:
+            progress("%d files committed" % stats['committed'])
+
+    def add(entry):
+        batch.append(entry)
+        if len(batch) >= batch_size:
+            commit()
+
+    try:
+        # the files committed right before an interruption
+        for entry in list(journal.entries.values()):
+            if entry['state'] == 'committed':
+                _remove_original(entry)
+
+        to_compress = []
+        for filepath_id, fp in store.pending():
+            entry = journal.entries.get(filepath_id)
+            if (entry is not None and entry['fp'] == fp and
+                    exists(entry['gz_fp']) and
+                    getsize(entry['gz_fp']) == entry['size']):
+                # compressed, but not committed, before an interruption
+                stats['reused'] += 1
+                add(entry)
+            else:
+                to_compress.append((filepath_id, fp, compresslevel))
+
+        pool = ThreadPool(max(min(threads, len(to_compress)), 1))
+        try:
+            for filepath_id, fp, result, error in pool.imap_unordered(
+                    _compress, to_compress):
+                if error is not None:
+                    errors.append('%s (%s) -- %s' % (fp, filepath_id, error))
+                    continue
+                stats['compressed'] += 1
+                add(journal.add(filepath_id, fp, result[0], result[1],
+                                result[2], 'compressed'))
+        finally:
+            pool.close()
+            pool.join()
+
+        if batch:
+            commit()
+    finally:
+        journal.close()
+
+    if errors:
+        raise ValueError("Error compressing %d files:\n%s"
+                         % (len(errors), '\n'.join(errors)))
+    return stats
@@ -0,0 +1,120 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from array import array
+
+import numpy as np
+from scipy.sparse import coo_matrix
+from biom import Table
+from biom.util import biom_open
+
+from qp_target_gene.taxonomy import get_taxonomy_index
+
+
+def sample_id_from_read_id(read_id):
+    """Extracts the sample id from a demultiplexed read id
+
+    Parameters
+    ----------
+    read_id : str
+        The read id, formatted as `%(sample)s_%(idx)d`
+
+    Returns
+    -------
+    str
+        The sample id
+    """
+    return read_id.rsplit('_', 1)[0]
+
+
+def parse_otu_map(otu_map_fp):
+    """Streams an OTU map into a sparse COO representation
+
+    Parameters
+    ----------
+    otu_map_fp : str
+        The OTU map filepath; each line has the OTU id followed by the ids
+        of the reads assigned to it, all tab separated
+
+    Returns
+    -------
+    (np.array, np.array, np.array), list of str, list of str
+        The (data, rows, cols) COO arrays
+        The OTU ids, in row order
+        The sample ids, in column order
+
+    Notes
+    -----
+    Only the non-zero entries are held in memory, so memory use is
+    proportional to the number of (OTU, sample) pairs, not to the number of
+    reads in the map.
+    """
+    rows = array('I')
+    cols = array('I')
+    data = array('I')
+    otu_ids = []
+    sample_ids = []
+    sample_idx = {}
+    with open(otu_map_fp) as f:
+        for line in f:
+            fields = line.rstrip('\n').split('\t')
+            if not fields[0]:
+                continue
+            counts = {}
+            for read_id in fields[1:]:
+                sid = sample_id_from_read_id(read_id)
+                counts[sid] = counts.get(sid, 0) + 1
+            if not counts:
+                continue
+            row = len(otu_ids)
+            otu_ids.append(fields[0])
+            for sid, count in counts.items():
+                if sid not in sample_idx:
+                    sample_idx[sid] = len(sample_ids)
+                    sample_ids.append(sid)
+                rows.append(row)
+                cols.append(sample_idx[sid])
+                data.append(count)
+
+    coo = (np.frombuffer(data, dtype=np.uintc),
+           np.frombuffer(rows, dtype=np.uintc),
+           np.frombuffer(cols, dtype=np.uintc))
+    return coo, otu_ids, sample_ids
+
+
+def build_otu_table(otu_map_fp, taxonomy_fp, biom_fp):
+    """Builds the BIOM OTU table from an OTU map
+
+    Parameters
+    ----------
+    otu_map_fp : str
+        The OTU map filepath, as generated by SortMeRNA
+    taxonomy_fp : str
+        The reference taxonomy filepath
+    biom_fp : str
+        The output BIOM filepath
+
+    Returns
+    -------
+    biom.Table
+        The OTU table written to `biom_fp`
+    """
+    (data, rows, cols), otu_ids, sample_ids = parse_otu_map(otu_map_fp)
+    matrix = coo_matrix((data.astype(float), (rows, cols)),
+                        shape=(len(otu_ids), len(sample_ids)))
+
+    # the reference taxonomy is indexed once and shared across jobs
+    taxonomy = get_taxonomy_index(taxonomy_fp)
+    obs_md = [{'taxonomy': taxonomy.get(o, ['Unassigned'])} for o in otu_ids]
+
+    table = Table(matrix, otu_ids, sample_ids, observation_metadata=obs_md,
+                  type='OTU table')
+    with biom_open(biom_fp, 'w') as f:
+        table.to_hdf5(f, 'qp-target-gene')
+
+    return table
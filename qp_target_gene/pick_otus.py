@@ -6,37 +6,53 @@
 # The full license is in the file LICENSE, distributed with this software.
 # -----------------------------------------------------------------------------
 
-from os.path import join, basename
+from os.path import join, basename, exists
+from os import makedirs, remove
 from functools import partial
 from glob import glob
+from datetime import datetime
 from tarfile import open as taropen
-from gzip import open as gopen
 
+from h5py import is_hdf5
 from qiita_client import ArtifactInfo
-from qiita_client.util import system_call
 
-
-def write_parameters_file(fp, parameters):
-    """Write the QIIME parameters file
+from qp_target_gene.cache import cached_command
+from qp_target_gene.compression import detect_compression, decompress_file
+from qp_target_gene.checkpoint import Checkpoints
+from qp_target_gene.manifest import Manifest, write_manifests
+from qp_target_gene.metadata import get_artifact_filepaths
+from qp_target_gene.progress import ProgressReporter
+from qp_target_gene.staging import staged_command
+from qp_target_gene.timing import (
+    TIMINGS_FILENAME, Timings, count_demux_reads)
+from qp_target_gene.otu_table import build_otu_table
+from qp_target_gene.incremental import (
+    CHECKSUMS_FILENAME, parameters_hash, compute_sample_checksums,
+    write_checksums_file, read_checksums_file, find_changed_samples,
+    write_samples_fasta, merge_otu_tables)
+
+
+def generate_parameters_string(parameters):
+    """Generates the parameters string from the parameters dictionary
 
     Parameters
     ----------
-    fp : str
-        The paramters file filepath
     parameters : dict
-        The commands parameters, keyed by parameter name
+        The parameter values, keyed by parameter name
+
+    Returns
+    -------
+    str
+        A string with the parameters to the CLI call
     """
-    params = ['sortmerna_max_pos', 'similarity', 'sortmerna_coverage',
-              'threads']
-    with open(fp, 'w') as f:
-        f.write("pick_otus:otu_picking_method\tsortmerna\n")
-        for p in params:
-            f.write("pick_otus:%s\t%s\n" % (p, parameters[p]))
+    str_params = ['sortmerna_max_pos', 'similarity', 'sortmerna_coverage',
+                  'threads']
+    return ' '.join("--%s %s" % (sp, parameters[sp]) for sp in str_params)
 
 
 def generate_pick_closed_reference_otus_cmd(filepaths, out_dir, parameters,
                                             test=False):
-    """Generates the pick_closed_reference_otus.py command
+    """Generates the pick_otus.py command
 
     Parameters
     ----------
@@ -47,46 +63,99 @@ def generate_pick_closed_reference_otus_cmd(filepaths, out_dir, parameters,
     parameters : dict
         The command's parameters, keyed by parameter name
     test : boolean, optional
-        If True this is being called from a test so no gzip testing
+        If True this is being called from a test so the compression of the
+        sequences is not checked
 
     Returns
     -------
     str, str
-        The pick_closed_reference_otus.py command
+        The pick_otus.py command
         The output directory
+
+    Notes
+    -----
+    Only the SortMeRNA OTU picking is delegated to QIIME; the OTU table is
+    built by `generate_otu_table` once the OTU map is available. Compressed
+    sequences are decompressed to `out_dir`, as SortMeRNA can't read them.
     """
     # It should be only a single preprocessed fasta file
     seqs_fp = filepaths['preprocessed_fasta'][0]
 
     output_dir = join(out_dir, 'cr_otus')
-    param_fp = join(out_dir, 'cr_params.txt')
+    if not exists(output_dir):
+        makedirs(output_dir)
 
-    reference_fp = parameters.pop('reference-seq')
-    taxonomy_fp = parameters.pop('reference-tax')
+    reference_fp = parameters['reference-seq']
+    params_str = generate_parameters_string(parameters)
 
-    write_parameters_file(param_fp, parameters)
+    # SortMeRNA needs the sequences uncompressed
+    if not test and detect_compression(seqs_fp) is not None:
+        seqs_fp = decompress_file(seqs_fp, join(out_dir, 'seqs.fna'),
+                                  int(parameters['threads']))
 
-    cmd_ungz = ''
-    is_gz = False
-    if not test:
-        try:
-            with gopen(seqs_fp, 'rb') as f:
-                f.read(1)
-            is_gz = True
-        except (OSError, IOError):
-            pass
-
-        if is_gz:
-            seqs_fp_fna = join(out_dir, 'seqs.fna')
-            cmd_ungz = 'pigz -c -d -p%s %s > %s && ' % (
-                str(parameters['threads']), seqs_fp, seqs_fp_fna)
-            seqs_fp = seqs_fp_fna
-
-    cmd = "%spick_closed_reference_otus.py -i %s -r %s -o %s -p %s -t %s" % (
-        cmd_ungz, seqs_fp, reference_fp, output_dir, param_fp, taxonomy_fp)
+    cmd = "pick_otus.py -m sortmerna -i %s -r %s -o %s %s" % (
+        seqs_fp, reference_fp, join(output_dir, 'sortmerna_picked_otus'),
+        params_str)
     return cmd, output_dir
 
 
+def write_log_file(pick_out, command, std_out, std_err):
+    """Writes the OTU picking log file
+
+    Parameters
+    ----------
+    pick_out : str
+        Path to the pick otus directory
+    command : str
+        The executed OTU picking command
+    std_out : str
+        The command's standard output
+    std_err : str
+        The command's standard error
+
+    Returns
+    -------
+    str
+        The log filepath
+    """
+    log_fp = join(pick_out, 'log_%s.txt' % datetime.now().strftime(
+        '%Y%m%d%H%M%S'))
+    with open(log_fp, 'w') as f:
+        f.write("Command:\n%s\n\nStdout:\n%s\n\nStderr:\n%s\n"
+                % (command, std_out, std_err))
+    return log_fp
+
+
+def generate_otu_table(pick_out, taxonomy_fp):
+    """Builds the OTU table from the SortMeRNA OTU map
+
+    Parameters
+    ----------
+    pick_out : str
+        Path to the pick otus directory
+    taxonomy_fp : str
+        The reference taxonomy filepath
+
+    Returns
+    -------
+    str
+        The OTU table filepath
+
+    Raises
+    ------
+    ValueError
+        If the pick otus directory does not contain an OTU map
+    """
+    otu_maps = glob(join(pick_out, 'sortmerna_picked_otus', '*_otus.txt'))
+    if len(otu_maps) != 1:
+        raise ValueError("The pick otus directory should contain a single "
+                         "OTU map, found %d" % len(otu_maps))
+
+    biom_fp = join(pick_out, 'otu_table.biom')
+    build_otu_table(otu_maps[0], taxonomy_fp, biom_fp)
+    return biom_fp
+
+
 def generate_sortmerna_tgz(out_dir):
     """Generates the sortmerna failures tgz command
 
@@ -102,7 +171,9 @@ def generate_sortmerna_tgz(out_dir):
     """
     to_tgz = join(out_dir, 'sortmerna_picked_otus')
     tgz = to_tgz + '.tgz'
-    with taropen(tgz, "w:gz") as tar:
+    # the tgz is checksummed as it is written
+    with Manifest(out_dir) as manifest, manifest.open(tgz) as fh, \
+            taropen(tgz, "w|gz", fileobj=fh) as tar:
         tar.add(to_tgz, arcname=basename(to_tgz))
 
 
@@ -127,6 +198,48 @@ def generate_artifact_info(pick_out):
     return [ArtifactInfo('OTU table', 'BIOM', filepaths)]
 
 
+def get_reusable_samples(qclient, artifact_id, params_hash, checksums):
+    """Finds the samples of a previous OTU table that can be reused
+
+    Parameters
+    ----------
+    qclient : tgp.qiita_client.QiitaClient
+        The Qiita server client
+    artifact_id : str
+        The previous OTU table artifact id
+    params_hash : str
+        The hash of the current OTU picking parameters
+    checksums : dict of {str: str}
+        The checksum of each sample in the current demux file
+
+    Returns
+    -------
+    str or None, list of str, list of str
+        The previous OTU table filepath, None if it can't be reused
+        The samples whose OTU counts can be reused
+        The samples that need to be picked
+    """
+    fps = get_artifact_filepaths(qclient, artifact_id)
+    checksums_fp = join(fps['directory'][0], CHECKSUMS_FILENAME)
+    if not exists(checksums_fp):
+        return None, [], sorted(checksums)
+
+    prev_hash, prev_checksums = read_checksums_file(checksums_fp)
+    if prev_hash != params_hash:
+        return None, [], sorted(checksums)
+
+    reused, to_pick = find_changed_samples(prev_checksums, checksums)
+    return fps['biom'][0], reused, to_pick
+
+
+def _remove_logs(pick_out):
+    """Removes the OTU picking logs of a previous execution of the job"""
+    for fp in glob(join(pick_out, 'log_*.txt')):
+        remove(fp)
+
+
+@cached_command('pick_closed_reference_otus')
+@staged_command
 def pick_closed_reference_otus(qclient, job_id, parameters, out_dir):
     """Run split libraries fastq with the given parameters
 
@@ -150,31 +263,125 @@ def pick_closed_reference_otus(qclient, job_id, parameters, out_dir):
     ------
     ValueError
         If there is any error gathering the information from the server
+
+    Notes
+    -----
+    If `previous_otu_table` is set to an OTU table artifact id generated
+    with the same parameters, the counts of the samples whose reads didn't
+    change are reused and only the new or changed samples are picked. In
+    that case, the SortMeRNA output only covers the picked samples.
+
+    The completed OTU picking and OTU table are recorded in `out_dir`, so if
+    the job is re-run in the same directory and the SortMeRNA output, the
+    OTU table and the log are still present and unchanged, only the
+    packaging of the results is executed again.
     """
-    qclient.update_job_step(job_id, "Step 1 of 4: Collecting information")
-    artifact_id = parameters['input_data']
-    a_info = qclient.get("/qiita_db/artifacts/%s/" % artifact_id)
-    fps = {k: [vv['filepath'] for vv in v] for k, v in a_info['files'].items()}
-
-    qclient.update_job_step(job_id, "Step 2 of 4: Generating command")
-    command, pick_out = generate_pick_closed_reference_otus_cmd(
-        fps, out_dir, parameters)
-
-    qclient.update_job_step(job_id, "Step 3 of 4: Executing OTU picking")
-    std_out, std_err, return_value = system_call(command)
-    if return_value != 0:
-        error_msg = ("Error running OTU picking: %s\nStd out: %s\nStd err: %s"
-                     % (command, std_out, std_err))
-        return False, None, error_msg
-
-    qclient.update_job_step(job_id,
-                            "Step 4 of 4: Generating tgz sortmerna folder")
-    try:
-        generate_sortmerna_tgz(pick_out)
-    except Exception as e:
-        error_msg = ("Error while tgz failures:\nError: %s" % str(e))
-        return False, None, error_msg
-
-    artifacts_info = generate_artifact_info(pick_out)
-
-    return True, artifacts_info, ""
+    with ProgressReporter(qclient, job_id) as progress, \
+            Timings(join(out_dir, TIMINGS_FILENAME)) as timings:
+        progress.update("Step 1 of 5: Collecting information")
+        timings.start("Collecting information")
+        fps = get_artifact_filepaths(qclient, parameters['input_data'])
+
+        progress.update("Step 2 of 5: Generating command")
+        timings.start("Generating command")
+        # the per sample checksums allow future jobs to reuse this OTU table
+        demux_fp = fps.get('preprocessed_demux', [None])[0]
+        params_hash = parameters_hash(parameters)
+        checksums = None
+        if demux_fp is not None and is_hdf5(demux_fp):
+            checksums = compute_sample_checksums(demux_fp)
+
+        previous_fp = None
+        to_pick = None
+        if parameters.get('previous_otu_table') and checksums is not None:
+            previous_fp, reused, to_pick = get_reusable_samples(
+                qclient, parameters['previous_otu_table'], params_hash,
+                checksums)
+            if previous_fp is not None and to_pick:
+                seqs_fp = join(out_dir, 'seqs_to_pick.fna')
+                write_samples_fasta(demux_fp, to_pick, seqs_fp)
+                fps['preprocessed_fasta'] = [seqs_fp]
+
+        command, pick_out = generate_pick_closed_reference_otus_cmd(
+            fps, out_dir, parameters)
+        picked_otus = join(pick_out, 'sortmerna_picked_otus')
+
+        progress.update("Step 3 of 5: Executing OTU picking")
+        timings.start("OTU picking")
+        if demux_fp is not None and is_hdf5(demux_fp):
+            timings.add_reads(count_demux_reads(demux_fp))
+        checkpoints = Checkpoints(out_dir)
+        pick_inputs = [fps['preprocessed_fasta'][0],
+                       parameters['reference-seq']]
+        if previous_fp is not None and not to_pick:
+            _remove_logs(pick_out)
+            if not exists(picked_otus):
+                makedirs(picked_otus)
+            write_log_file(pick_out, 'None, all %d samples reused from %s'
+                           % (len(reused), previous_fp), '', '')
+        elif not checkpoints.is_complete('pick_otus', pick_inputs, command):
+            checkpoints.start('pick_otus')
+            _remove_logs(pick_out)
+            result = timings.run_command(
+                command, join(out_dir, 'logs'),
+                progress=lambda line: progress.update(
+                    "Step 3 of 5: Executing OTU picking: %s" % line))
+            write_log_file(pick_out, command, result.stdout_tail,
+                           result.stderr_tail)
+            if result.return_value != 0:
+                error_msg = ("Error running OTU picking: %s\nStd out: %s\n"
+                             "Std err: %s" % (command, result.stdout_tail,
+                                              result.stderr_tail))
+                return False, None, error_msg
+            # the per sample checksums are written with the OTU table
+            outputs = [fp for fp in glob(join(picked_otus, '*'))
+                       if basename(fp) != CHECKSUMS_FILENAME]
+            checkpoints.complete(
+                'pick_otus', pick_inputs,
+                outputs + glob(join(pick_out, 'log_*.txt')), command)
+
+        progress.update("Step 4 of 5: Building OTU table")
+        timings.start("Building OTU table")
+        biom_fp = join(pick_out, 'otu_table.biom')
+        checksums_fp = join(picked_otus, CHECKSUMS_FILENAME)
+        table_inputs = (glob(join(picked_otus, '*_otus.txt')) +
+                        glob(join(pick_out, 'log_*.txt')) +
+                        [parameters['reference-tax']])
+        table_key = ''
+        if previous_fp is not None:
+            table_inputs.append(previous_fp)
+            table_key = ','.join(reused)
+        if not checkpoints.is_complete('otu_table', table_inputs, table_key):
+            checkpoints.start('otu_table')
+            try:
+                if previous_fp is None:
+                    generate_otu_table(pick_out, parameters['reference-tax'])
+                elif not to_pick:
+                    merge_otu_tables(previous_fp, reused, None, biom_fp)
+                else:
+                    generate_otu_table(pick_out, parameters['reference-tax'])
+                    merge_otu_tables(previous_fp, reused, biom_fp, biom_fp)
+            except Exception as e:
+                error_msg = ("Error while building the OTU table:\nError: %s"
+                             % str(e))
+                return False, None, error_msg
+            table_outputs = [biom_fp]
+            if checksums is not None:
+                write_checksums_file(checksums_fp, params_hash, checksums)
+                table_outputs.append(checksums_fp)
+            checkpoints.complete('otu_table', table_inputs, table_outputs,
+                                 table_key)
+
+        progress.update("Step 5 of 5: Generating tgz sortmerna folder")
+        timings.start("Generating tgz")
+        try:
+            generate_sortmerna_tgz(pick_out)
+        except Exception as e:
+            error_msg = ("Error while tgz failures:\nError: %s" % str(e))
+            return False, None, error_msg
+
+        artifacts_info = generate_artifact_info(pick_out)
+        write_manifests(artifacts_info)
+        timings.attach(artifacts_info)
+
+        return True, artifacts_info, ""
@@ -0,0 +1,95 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from threading import Thread, Lock, Event
+from time import time
+
+
+class ProgressReporter(object):
+    """Reports the job step to Qiita from a background thread
+
+    Parameters
+    ----------
+    qclient : tgp.qiita_client.QiitaClient
+        The Qiita server client
+    job_id : str
+        The job id
+    min_interval : float, optional
+        The minimum number of seconds between two updates sent to Qiita
+    close_timeout : float, optional
+        The maximum number of seconds `close` waits for the last update to
+        be sent
+
+    Notes
+    -----
+    `update` never blocks: it only records the new step. The background
+    thread sends the latest recorded step, so the steps recorded while an
+    update is in flight, or within `min_interval` seconds of the previous
+    one, are coalesced. Errors sending the updates are ignored, as the job
+    status is informative and should not make the job fail.
+    """
+    def __init__(self, qclient, job_id, min_interval=2, close_timeout=10):
+        self.qclient = qclient
+        self.job_id = job_id
+        self.min_interval = min_interval
+        self.close_timeout = close_timeout
+
+        self._lock = Lock()
+        self._pending = None
+        self._has_pending = Event()
+        self._stop = Event()
+        self._thread = Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def update(self, step):
+        """Records the current job step
+
+        Parameters
+        ----------
+        step : str
+            The job step description
+        """
+        with self._lock:
+            self._pending = step
+        self._has_pending.set()
+
+    def close(self):
+        """Sends the last recorded step and stops the background thread"""
+        self._stop.set()
+        self._has_pending.set()
+        self._thread.join(self.close_timeout)
+
+    def _send_pending(self):
+        with self._lock:
+            step = self._pending
+            self._pending = None
+            self._has_pending.clear()
+        if step is None:
+            return
+        try:
+            self.qclient.update_job_step(self.job_id, step)
+        except Exception:
+            pass
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._has_pending.wait()
+            if self._stop.is_set():
+                break
+            start = time()
+            self._send_pending()
+            # bound the update rate; a stop request interrupts the wait
+            self._stop.wait(max(0, self.min_interval - (time() - start)))
+        self._send_pending()
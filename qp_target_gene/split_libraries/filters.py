@@ -0,0 +1,290 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from collections import namedtuple, OrderedDict
+
+import numpy as np
+
+
+# the bases QIIME doesn't count as ambiguous, or in homopolymers
+_BASES = np.zeros(256, dtype=bool)
+_BASES[[ord(c) for c in 'ACGT']] = True
+_BASES_ANY_CASE = _BASES.copy()
+_BASES_ANY_CASE[[ord(c) for c in 'acgt']] = True
+
+# the reads kept, where each read ends after the truncations, and the number
+# of reads discarded by each filter
+FilterResult = namedtuple('FilterResult', ['keep', 'stop', 'failures'])
+
+
+def _valid(lengths, width):
+    """Returns which positions of each read are within the read"""
+    return np.arange(width) < lengths[:, None]
+
+
+def max_homopolymer_runs(codes, lengths):
+    """Returns the longest homopolymer of each read
+
+    Parameters
+    ----------
+    codes : np.array of uint8
+        The reads, a row per read padded with zeros, as returned by
+        `qp_target_gene.split_libraries.primers.encode_reads`
+    lengths : np.array of int
+        The length of each read
+
+    Returns
+    -------
+    np.array of int
+        The length of the longest run of A, C, G or T of each read
+
+    Notes
+    -----
+    As QIIME's `seq_exceeds_homopolymers`, only runs of uppercase A, C, G
+    and T are considered. The runs of all the reads are found at once, over
+    the flattened batch.
+    """
+    n, width = codes.shape
+    # a zero after each read, so runs don't continue into the next read
+    flat = np.zeros((n, width + 1), dtype=np.uint8)
+    flat[:, :width] = np.where(_valid(lengths, width), codes, 0)
+    flat = flat.ravel()
+    starts = np.flatnonzero(np.concatenate(([True], flat[1:] != flat[:-1])))
+    runs = np.diff(np.append(starts, len(flat)))
+    bases = _BASES[flat[starts]]
+    result = np.zeros(n, dtype=int)
+    np.maximum.at(result, starts[bases] // (width + 1), runs[bases])
+    return result
+
+
+def count_ambiguous(codes, lengths):
+    """Returns the number of ambiguous bases of each read
+
+    Parameters
+    ----------
+    codes : np.array of uint8
+        The reads, a row per read padded with zeros
+    lengths : np.array of int
+        The length of each read
+
+    Returns
+    -------
+    np.array of int
+        The number of characters of each read that are not A, C, G or T, in
+        any case, as QIIME's `count_ambig`
+    """
+    valid = _BASES_ANY_CASE[codes] & _valid(lengths, codes.shape[1])
+    return lengths - valid.sum(axis=1)
+
+
+def first_ambiguous(codes, lengths, start=None):
+    """Returns where each read is truncated at its first N
+
+    Parameters
+    ----------
+    codes : np.array of uint8
+        The reads, a row per read padded with zeros
+    lengths : np.array of int
+        The length of each read
+    start : np.array of int, optional
+        Where to start looking in each read. Defaults to the first base
+
+    Returns
+    -------
+    np.array of int
+        The position of the first N of each read, or its length if it has no
+        N
+    """
+    valid = _valid(lengths, codes.shape[1])
+    if start is not None:
+        valid &= np.arange(codes.shape[1]) >= start[:, None]
+    is_n = (codes == ord('N')) & valid
+    return np.where(is_n.any(axis=1), is_n.argmax(axis=1), lengths)
+
+
+def mean_quality_below(quals, lengths, min_qual_score):
+    """Returns which reads have a mean quality score below a minimum
+
+    Parameters
+    ----------
+    quals : np.array of uint8
+        The quality scores, a row per read padded to the longest read
+    lengths : np.array of int
+        The length of each read
+    min_qual_score : int
+        The minimum mean quality score
+
+    Returns
+    -------
+    np.array of bool
+        Whether the mean quality score of each read is below the minimum.
+        Reads without bases are never below it, as in QIIME
+    """
+    sums = np.where(_valid(lengths, quals.shape[1]), quals, 0).sum(axis=1)
+    # the comparison of the sums avoids rounding the means
+    return sums < min_qual_score * lengths
+
+
+def quality_window_truncation(quals, lengths, window, min_qual_score,
+                              start=None):
+    """Returns where each read is truncated at its first low quality window
+
+    Parameters
+    ----------
+    quals : np.array of uint8
+        The quality scores, a row per read padded to the longest read
+    lengths : np.array of int
+        The length of each read
+    window : int
+        The size of the window
+    min_qual_score : int
+        The minimum mean quality score of a window
+    start : np.array of int, optional
+        Where the windows of each read start. Defaults to the first base
+
+    Returns
+    -------
+    np.array of bool, np.array of int
+        Whether each read passed the check, and where it is truncated: the
+        start of its first window with a mean quality score below the
+        minimum, or its length if it passed
+
+    Notes
+    -----
+    The windows follow QIIME's `check_window_qual_scores`: reads shorter
+    than the window are checked over a single window of their length, which
+    always passes, and the last window of each read is never checked.
+    """
+    n, width = quals.shape
+    start = np.zeros(n, dtype=int) if start is None else start
+    # the windows of each read, relative to its start
+    sizes = np.maximum(lengths - start, 0)
+    w = np.minimum(window, sizes)
+    cumsum = np.zeros((n, width + 1), dtype=np.int64)
+    cumsum[:, 1:] = np.cumsum(
+        np.where(_valid(lengths, width), quals, 0), axis=1)
+
+    pos = np.arange(width)
+    idx = pos - start[:, None]
+    checked = (idx >= 0) & (idx < (sizes - w)[:, None])
+    ends = np.minimum(pos + w[:, None], width)
+    sums = cumsum[np.arange(n)[:, None], ends] - cumsum[:, :width]
+    low = checked & (sums < min_qual_score * w[:, None])
+
+    failed = low.any(axis=1) & (w > 0)
+    stop = np.where(failed, low.argmax(axis=1), lengths)
+    return ~failed, stop
+
+
+def apply_sequence_filters(codes, lengths, max_ambig, max_homopolymer,
+                           truncate_ambi_bases=False):
+    """Applies the ambiguity and homopolymer filters to a batch of reads
+
+    Parameters
+    ----------
+    codes : np.array of uint8
+        The reads, a row per read padded with zeros
+    lengths : np.array of int
+        The length of each read
+    max_ambig : int
+        The maximum number of ambiguous bases of a read
+    max_homopolymer : int
+        The maximum length of the homopolymers of a read
+    truncate_ambi_bases : bool, optional
+        Whether the reads are truncated at their first N, instead of
+        discarded if they have too many ambiguous bases
+
+    Returns
+    -------
+    np.array of bool, np.array of int
+        Whether each read is kept, and where it ends after the truncation
+
+    Notes
+    -----
+    These are the checks of `apply_quality_filters` that don't need the
+    quality scores, so they can be applied to the reads of a demux file.
+    """
+    keep = max_homopolymer_runs(codes, lengths) <= max_homopolymer
+    if truncate_ambi_bases:
+        return keep, first_ambiguous(codes, lengths)
+    keep &= count_ambiguous(codes, lengths) <= max_ambig
+    return keep, lengths
+
+
+def apply_quality_filters(codes, quals, lengths, parameters, start=None):
+    """Applies the quality filters of split libraries to a batch of reads
+
+    Parameters
+    ----------
+    codes : np.array of uint8
+        The reads, a row per read padded with zeros
+    quals : np.array of uint8 or None
+        The quality scores, a row per read padded to the longest read, or
+        None if the reads have no quality scores
+    lengths : np.array of int
+        The length of each read
+    parameters : dict
+        The parameters of the Split libraries command: min_qual_score,
+        max_ambig, max_homopolymer, qual_score_window, truncate_ambi_bases
+        and min_seq_len
+    start : np.array of int, optional
+        Where the sequence of each read starts, after its barcode and
+        primer. Defaults to the first base
+
+    Returns
+    -------
+    FilterResult
+        Whether each read is kept, where it ends after the truncations, and
+        the number of reads discarded by each filter
+
+    Notes
+    -----
+    The filters are applied in QIIME's order, and a read is only counted
+    by the first filter it fails: the mean quality score, the ambiguous
+    bases and the homopolymers are checked over the whole read, then the
+    read is truncated at its first N (if `truncate_ambi_bases`, instead of
+    counting the ambiguous bases) and at its first low quality window, and
+    the reads shorter than `min_seq_len` after the truncations are
+    discarded.
+    """
+    n = len(lengths)
+    start = np.zeros(n, dtype=int) if start is None else start
+    keep = np.ones(n, dtype=bool)
+    stop = lengths.copy()
+    failures = OrderedDict()
+
+    def discard(name, failed):
+        failed = failed & keep
+        failures[name] = int(failed.sum())
+        keep[failed] = False
+
+    min_qual_score = int(parameters['min_qual_score'])
+    if quals is not None:
+        discard('min_qual_score',
+                mean_quality_below(quals, lengths, min_qual_score))
+    truncate_ambi_bases = parameters['truncate_ambi_bases']
+    if not truncate_ambi_bases:
+        discard('max_ambig', count_ambiguous(codes, lengths) >
+                int(parameters['max_ambig']))
+    discard('max_homopolymer', max_homopolymer_runs(codes, lengths) >
+            int(parameters['max_homopolymer']))
+
+    truncated = np.zeros(n, dtype=bool)
+    if truncate_ambi_bases:
+        stop = first_ambiguous(codes, lengths, start)
+        truncated |= stop < lengths
+    window = int(parameters['qual_score_window'])
+    if window and quals is not None:
+        _, w_stop = quality_window_truncation(
+            quals, stop, window, min_qual_score, start)
+        truncated |= w_stop < stop
+        stop = w_stop
+    discard('min_seq_len',
+            truncated & (stop - start < int(parameters['min_seq_len'])))
+
+    return FilterResult(keep, stop, failures)
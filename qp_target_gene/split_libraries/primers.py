@@ -0,0 +1,423 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from collections import namedtuple, OrderedDict
+
+import numpy as np
+import pandas as pd
+
+
+# the bases matched by each IUPAC code
+IUPAC = {'A': 'A', 'C': 'C', 'G': 'G', 'T': 'T', 'U': 'T',
+         'R': 'AG', 'Y': 'CT', 'S': 'GC', 'W': 'AT', 'K': 'GT', 'M': 'AC',
+         'B': 'CGT', 'D': 'AGT', 'H': 'ACT', 'V': 'ACG', 'N': 'ACGT'}
+
+_COMPLEMENT = {'A': 'T', 'C': 'G', 'G': 'C', 'T': 'A', 'U': 'A',
+               'R': 'Y', 'Y': 'R', 'S': 'S', 'W': 'W', 'K': 'M', 'M': 'K',
+               'B': 'V', 'D': 'H', 'H': 'D', 'V': 'B', 'N': 'N'}
+
+# the primers are stored as bit masks of the read bases, one bit per primer
+# position, so they can't be longer than the masks
+MAX_PRIMER_LENGTH = 64
+
+REVERSE_PRIMERS_MODES = ('disable', 'truncate_only', 'truncate_remove')
+
+# the position and number of errors of the best match of a primer in each
+# read of a batch; start and end are -1 if the primer was not found
+PrimerHits = namedtuple('PrimerHits', ['found', 'errors', 'start', 'end'])
+
+_ONE = np.uint64(1)
+
+
+def reverse_complement(primer):
+    """Returns the reverse complement of a primer
+
+    Parameters
+    ----------
+    primer : str
+        The primer, in IUPAC codes
+
+    Returns
+    -------
+    str
+        The reverse complement of the primer
+
+    Raises
+    ------
+    ValueError
+        If the primer has a character that is not an IUPAC code
+    """
+    try:
+        return ''.join(_COMPLEMENT[c] for c in reversed(primer.upper()))
+    except KeyError as e:
+        raise ValueError("Not an IUPAC code in primer %s: %s" % (primer, e))
+
+
+def encode_reads(seqs):
+    """Stores a batch of reads in an array
+
+    Parameters
+    ----------
+    seqs : list of bytes or np.array of bytes
+        The read sequences
+
+    Returns
+    -------
+    np.array of uint8, np.array of int
+        The bases of the reads, a row per read padded with zeros to the
+        longest read, and the length of each read
+
+    Notes
+    -----
+    The fixed width arrays of bytes, as read from the demux files, are
+    already padded with zeros, so their bases are used without copying
+    each read.
+    """
+    if isinstance(seqs, np.ndarray) and seqs.dtype.kind == 'S' and \
+            seqs.dtype.itemsize:
+        seqs = np.ascontiguousarray(seqs)
+        return (seqs.view(np.uint8).reshape(len(seqs), seqs.dtype.itemsize),
+                np.char.str_len(seqs))
+    lengths = np.array([len(s) for s in seqs], dtype=int)
+    codes = np.zeros((len(seqs), lengths.max() if len(seqs) else 0),
+                     dtype=np.uint8)
+    for i, seq in enumerate(seqs):
+        codes[i, :lengths[i]] = np.frombuffer(seq, dtype=np.uint8)
+    return codes, lengths
+
+
+def _pattern_masks(primer):
+    """Returns the positions of the primer matched by each read base
+
+    Each base gets a mask with the bit of each primer position matching the
+    base set, as used by the bit-parallel algorithm.
+    """
+    masks = np.zeros(256, dtype=np.uint64)
+    for i, c in enumerate(primer):
+        for base in IUPAC[c]:
+            for b in (base, base.lower()):
+                masks[ord(b)] |= _ONE << np.uint64(i)
+    return masks
+
+
+def _myers(masks, length, codes, lengths, anchored):
+    """Runs the bit-parallel edit distance over a batch of reads
+
+    Parameters
+    ----------
+    masks : np.array of uint64
+        The primer masks of each base, from `_pattern_masks`
+    length : int
+        The primer length
+    codes : np.array of uint8
+        The reads, as returned by `encode_reads`
+    lengths : np.array of int
+        The length of each read
+    anchored : bool
+        Whether the match has to start at the first base of the read
+
+    Returns
+    -------
+    np.array of int, np.array of int
+        The fewest errors (mismatches, insertions and deletions) of the
+        primer in each read, and the end (excluded) of the first match with
+        those errors
+
+    Notes
+    -----
+    The primer matches of all the reads are computed at once, a read base
+    at a time, following Myers (1999), J ACM 46(3):395-415.
+    """
+    n = codes.shape[0]
+    high = _ONE << np.uint64(length - 1)
+    pv = np.full(n, np.iinfo(np.uint64).max, dtype=np.uint64)
+    mv = np.zeros(n, dtype=np.uint64)
+    score = np.full(n, length, dtype=int)
+    best = score.copy()
+    best_end = np.zeros(n, dtype=int)
+    carry = _ONE if anchored else np.uint64(0)
+    with np.errstate(over='ignore'):
+        for j in range(codes.shape[1]):
+            eq = masks[codes[:, j]]
+            xv = eq | mv
+            xh = (((eq & pv) + pv) ^ pv) | eq
+            ph = mv | ~(xh | pv)
+            mh = pv & xh
+            score += (ph & high).astype(bool)
+            score -= (mh & high).astype(bool)
+            ph = (ph << _ONE) | carry
+            mh = mh << _ONE
+            pv = mh | ~(xv | ph)
+            mv = ph & xv
+
+            better = (score < best) & (j < lengths)
+            best[better] = score[better]
+            best_end[better] = j + 1
+    return best, best_end
+
+
+class PrimerMatcher(object):
+    """Finds a set of primers in batches of reads, allowing errors
+
+    Parameters
+    ----------
+    primers : list of str
+        The primers, in IUPAC codes
+    max_errors : int
+        The maximum number of errors (mismatches, insertions and deletions)
+        of a match
+
+    Raises
+    ------
+    ValueError
+        If there are no primers, a primer is longer than MAX_PRIMER_LENGTH or
+        has a character that is not an IUPAC code
+
+    Notes
+    -----
+    The primers are compiled once to bit masks, so the errors of a primer
+    in all the positions of a read are found in a pass over the read, for
+    all the reads of a batch at once. When there is more than one primer,
+    the match with the fewest errors is kept and, on ties, the one ending
+    first.
+    """
+    def __init__(self, primers, max_errors):
+        if not primers:
+            raise ValueError("No primers to match")
+        self.primers = [p.upper() for p in primers]
+        self.max_errors = int(max_errors)
+        for p in self.primers:
+            if not 0 < len(p) <= MAX_PRIMER_LENGTH:
+                raise ValueError("Primers should have between 1 and %d "
+                                 "bases: %s" % (MAX_PRIMER_LENGTH, p))
+            unknown = set(p) - set(IUPAC)
+            if unknown:
+                raise ValueError("Not an IUPAC code in primer %s: %s"
+                                 % (p, ', '.join(sorted(unknown))))
+        self._masks = [_pattern_masks(p) for p in self.primers]
+        self._reversed_masks = [_pattern_masks(p[::-1])
+                                for p in self.primers]
+
+    def _best(self, codes, lengths, anchored):
+        """Returns the best errors, end and primer of each read"""
+        errors = ends = primer = None
+        for i, (masks, p) in enumerate(zip(self._masks, self.primers)):
+            p_errors, p_ends = _myers(masks, len(p), codes, lengths, anchored)
+            if errors is None:
+                errors, ends = p_errors, p_ends
+                primer = np.zeros(len(errors), dtype=int)
+            else:
+                better = (p_errors < errors) | (
+                    (p_errors == errors) & (p_ends < ends))
+                errors = np.where(better, p_errors, errors)
+                ends = np.where(better, p_ends, ends)
+                primer[better] = i
+        return errors, ends, primer
+
+    def _hits(self, errors, start, end):
+        found = errors <= self.max_errors
+        return PrimerHits(found, errors, np.where(found, start, -1),
+                          np.where(found, end, -1))
+
+    def match_start(self, codes, lengths):
+        """Matches the primers at the start of each read
+
+        Parameters
+        ----------
+        codes : np.array of uint8
+            The reads, as returned by `encode_reads`
+        lengths : np.array of int
+            The length of each read
+
+        Returns
+        -------
+        PrimerHits
+            The primer matches. The start of the matches is always 0
+        """
+        # a match can't span more bases than the primer plus its insertions
+        width = max(len(p) for p in self.primers) + self.max_errors
+        errors, ends, _ = self._best(codes[:, :width], lengths, True)
+        return self._hits(errors, np.zeros(len(errors), dtype=int), ends)
+
+    def search(self, codes, lengths):
+        """Finds the primers anywhere in each read
+
+        Parameters
+        ----------
+        codes : np.array of uint8
+            The reads, as returned by `encode_reads`
+        lengths : np.array of int
+            The length of each read
+
+        Returns
+        -------
+        PrimerHits
+            The first of the primer matches with the fewest errors
+
+        Notes
+        -----
+        The bit-parallel algorithm finds where the matches end, so the
+        start is found matching the reversed primer backwards from the end.
+        """
+        errors, ends, primer = self._best(codes, lengths, False)
+        starts = ends.copy()
+        for i, p in enumerate(self.primers):
+            reads = np.flatnonzero((primer == i) &
+                                   (errors <= self.max_errors))
+            if not len(reads):
+                continue
+            # the bases before the end of each match, last base first
+            width = len(p) + self.max_errors
+            pos = ends[reads, None] - 1 - np.arange(width)
+            rev = np.where(pos >= 0, codes[reads[:, None],
+                                           np.maximum(pos, 0)], 0)
+            rev_lengths = np.minimum(ends[reads], width)
+            # the shortest alignment with the fewest errors gives the start
+            _, rev_ends = _myers(self._reversed_masks[i], len(p), rev,
+                                 rev_lengths, True)
+            starts[reads] = ends[reads] - rev_ends
+        return self._hits(errors, starts, ends)
+
+
+def read_mapping_primers(mapping_file):
+    """Returns the primers of each sample of a QIIME mapping file
+
+    Parameters
+    ----------
+    mapping_file : str
+        The mapping file filepath
+
+    Returns
+    -------
+    OrderedDict of {str: (list of str, list of str)}
+        The forward primers and the reverse complement of the reverse
+        primers of each sample, in the mapping file order
+
+    Notes
+    -----
+    As in QIIME, the primer columns may have several primers separated by
+    commas, and the reverse primers are given 5' to 3', so they are reverse
+    complemented to match them in the reads.
+    """
+    mapping = pd.read_csv(mapping_file, sep='\t', dtype=str,
+                          keep_default_na=False)
+    primers = OrderedDict()
+    for _, row in mapping.iterrows():
+        forward = [p.strip() for p in
+                   row.get('LinkerPrimerSequence', '').split(',')]
+        reverse = [p.strip() for p in
+                   row.get('ReverseLinkerPrimer', '').split(',')]
+        primers[row['#SampleID']] = (
+            [p for p in forward if p],
+            [reverse_complement(p) for p in reverse if p])
+    return primers
+
+
+class PrimerEngine(object):
+    """Applies the primer parameters of split libraries to batches of reads
+
+    Parameters
+    ----------
+    primers : dict of {str: (list of str, list of str)}
+        The forward primers and the reverse complement of the reverse
+        primers of each sample, as returned by `read_mapping_primers`
+    max_primer_mismatch : int
+        The maximum number of errors of the forward primers
+    reverse_primers : str, optional
+        What to do with the reverse primers: 'disable' ignores them,
+        'truncate_only' truncates the reads at the reverse primer if found
+        and 'truncate_remove' also discards the reads without it
+    reverse_primer_mismatches : int, optional
+        The maximum number of errors of the reverse primers
+    disable_primers : bool, optional
+        Whether to keep the reads without the forward primer
+
+    Raises
+    ------
+    ValueError
+        If the value of `reverse_primers` is not known, or it is not
+        'disable' and a sample has no reverse primers
+
+    Notes
+    -----
+    The samples with the same primers share their matchers, so the primers
+    are compiled once per primer set, not per sample.
+    """
+    def __init__(self, primers, max_primer_mismatch,
+                 reverse_primers='disable', reverse_primer_mismatches=0,
+                 disable_primers=False):
+        if reverse_primers not in REVERSE_PRIMERS_MODES:
+            raise ValueError(
+                "Value for 'reverse_primers' not recognized: %s. Please, "
+                "choose a value from %s" % (reverse_primers,
+                                            ', '.join(REVERSE_PRIMERS_MODES)))
+        self.reverse_primers = reverse_primers
+        self.disable_primers = disable_primers
+        self._matchers = {}
+        self._samples = {}
+        compiled = {}
+        for sample, (forward, reverse) in primers.items():
+            if reverse_primers != 'disable' and not reverse:
+                raise ValueError("The sample %s has no reverse primers"
+                                 % sample)
+            key = (tuple(forward), tuple(reverse))
+            if key not in compiled:
+                compiled[key] = len(compiled)
+                self._matchers[compiled[key]] = (
+                    PrimerMatcher(forward, max_primer_mismatch)
+                    if forward and not disable_primers else None,
+                    PrimerMatcher(reverse, reverse_primer_mismatches)
+                    if reverse_primers != 'disable' else None)
+            self._samples[sample] = compiled[key]
+
+    def process(self, seqs, samples):
+        """Finds the primers of a batch of reads
+
+        Parameters
+        ----------
+        seqs : list of bytes
+            The read sequences, without their barcodes
+        samples : list of str
+            The sample of each read
+
+        Returns
+        -------
+        np.array of bool, np.array of int, np.array of int
+            Whether each read is kept, and the start and end (excluded) of
+            the read without its primers
+
+        Raises
+        ------
+        KeyError
+            If a sample is not in the primers
+        """
+        codes, lengths = encode_reads(seqs)
+        keep = np.ones(len(seqs), dtype=bool)
+        start = np.zeros(len(seqs), dtype=int)
+        stop = lengths.copy()
+        groups = np.array([self._samples[s] for s in samples], dtype=int)
+        for group, (forward, reverse) in self._matchers.items():
+            reads = np.flatnonzero(groups == group)
+            if not len(reads):
+                continue
+            g_codes, g_lengths = codes[reads], lengths[reads]
+            if forward is not None:
+                hits = forward.match_start(g_codes, g_lengths)
+                keep[reads] = hits.found
+                start[reads] = np.maximum(hits.end, 0)
+            if reverse is not None:
+                # the reverse primer is looked for after the forward primer
+                g_codes = np.where(np.arange(codes.shape[1]) <
+                                   start[reads, None], 0, g_codes)
+                hits = reverse.search(g_codes.astype(np.uint8), g_lengths)
+                stop[reads] = np.where(
+                    hits.found, np.maximum(hits.start, start[reads]),
+                    g_lengths)
+                if self.reverse_primers == 'truncate_remove':
+                    keep[reads] &= hits.found
+        return keep, start, stop
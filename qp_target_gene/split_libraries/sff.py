@@ -0,0 +1,212 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from struct import Struct
+from collections import namedtuple
+
+import numpy as np
+
+from qp_target_gene.compression import map_input
+
+
+SFF_MAGIC = 0x2E736666
+
+# the number of bases (or quality scores) of each line of the output files,
+# as written by process_sff.py
+LINE_WIDTH = 60
+
+# magic, version, index offset, index length, number of reads, header
+# length, key length, number of flows and flowgram format
+_COMMON_HEADER = Struct('>IIQIIHHHB')
+# read header length, name length, number of bases, clip qual left/right and
+# clip adapter left/right
+_READ_HEADER = Struct('>HHIHHHH')
+
+_BASE36 = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'
+
+SFFRead = namedtuple('SFFRead', ['name', 'sequence', 'qual'])
+
+
+def _padding(length):
+    """Returns the bytes needed to align `length` to 8 bytes"""
+    return -length % 8
+
+
+class _Reader(object):
+    """Reads consecutive bytes from a file object, keeping the position"""
+    def __init__(self, fh):
+        self._fh = fh
+        self.position = 0
+
+    def read(self, size):
+        data = self._fh.read(size)
+        if len(data) != size:
+            raise ValueError("Truncated sff file: expected %d bytes at "
+                             "position %d" % (size, self.position))
+        self.position += size
+        return data
+
+    def skip(self, size):
+        if size:
+            self.read(size)
+
+
+def parse_sff(fp):
+    """Yields the clipped reads of an sff file
+
+    Parameters
+    ----------
+    fp : str
+        The sff filepath, optionally compressed
+
+    Returns
+    -------
+    generator of SFFRead
+        The name, the clipped sequence and the clipped quality scores (as a
+        np.array of uint8) of each read
+
+    Raises
+    ------
+    ValueError
+        If the file is not an sff file or is truncated
+
+    Notes
+    -----
+    The reads are clipped with the quality clip points, as process_sff.py
+    does, so the key sequence is removed. Uncompressed files are memory
+    mapped, so the reads are taken from the page cache without copying the
+    file; compressed files are streamed.
+    """
+    with map_input(fp) as fh:
+        reader = _Reader(fh)
+        (magic, _, index_offset, index_length, n_reads, header_length,
+         _, n_flows, _) = _COMMON_HEADER.unpack(
+            reader.read(_COMMON_HEADER.size))
+        if magic != SFF_MAGIC:
+            raise ValueError("%s is not an sff file" % fp)
+        reader.skip(header_length - _COMMON_HEADER.size)
+
+        for _ in range(n_reads):
+            if index_length and reader.position == index_offset:
+                reader.skip(index_length + _padding(index_length))
+
+            (read_header_length, name_length, n_bases, clip_left,
+             clip_right, _, _) = _READ_HEADER.unpack(
+                reader.read(_READ_HEADER.size))
+            name = reader.read(name_length)
+            reader.skip(read_header_length - _READ_HEADER.size - name_length)
+
+            # flowgram values and flow indices are not needed
+            data_length = 2 * n_flows + 3 * n_bases
+            reader.skip(2 * n_flows + n_bases)
+            bases = reader.read(n_bases)
+            qual = reader.read(n_bases)
+            reader.skip(_padding(data_length))
+
+            start = max(clip_left, 1) - 1
+            stop = clip_right or n_bases
+            yield SFFRead(name, bases[start:stop],
+                          np.frombuffer(qual, dtype=np.uint8)[start:stop])
+
+
+def _base36(value):
+    """Decodes a base 36 string of the 454 accession numbers"""
+    result = 0
+    for c in value:
+        result = result * 36 + _BASE36.index(c)
+    return result
+
+
+def decode_accession(name):
+    """Decodes the run information of a 454 read name
+
+    Parameters
+    ----------
+    name : str
+        The read name, a 454 universal accession number
+
+    Returns
+    -------
+    str
+        The xy, region and run description added by process_sff.py to the
+        header of the read
+
+    Raises
+    ------
+    ValueError
+        If the name is not a 454 universal accession number
+    """
+    if len(name) != 14:
+        raise ValueError("Not a 454 accession number: %s" % name)
+    n = _base36(name[:6])
+    year, n = divmod(n, 13 * 32 * 24 * 60 * 60)
+    month, n = divmod(n, 32 * 24 * 60 * 60)
+    day, n = divmod(n, 24 * 60 * 60)
+    hour, n = divmod(n, 60 * 60)
+    minute, second = divmod(n, 60)
+    region = int(name[7:9])
+    x, y = divmod(_base36(name[9:]), 4096)
+    return 'xy=%04d_%04d region=%d run=R_%d_%02d_%02d_%02d_%02d_%02d_' % (
+        x, y, region, year + 2000, month, day, hour, minute, second)
+
+
+def _header(read):
+    """Returns the fasta/qual header of a read"""
+    name = read.name.decode('ascii')
+    header = '>%s length=%d' % (name, len(read.sequence))
+    try:
+        header = '%s %s' % (header, decode_accession(name))
+    except ValueError:
+        pass
+    return header.encode('ascii') + b'\n'
+
+
+def _wrap(items, sep):
+    """Joins the items in lines of LINE_WIDTH items"""
+    lines = [sep.join(items[i:i + LINE_WIDTH])
+             for i in range(0, len(items), LINE_WIDTH)]
+    return b'\n'.join(lines) + b'\n'
+
+
+def write_sff_fasta_qual(sff_fp, seqs_fp, quals_fp):
+    """Writes the reads of an sff file as fasta and qual files
+
+    Parameters
+    ----------
+    sff_fp : str
+        The sff filepath, optionally compressed
+    seqs_fp : str
+        The output fasta filepath
+    quals_fp : str
+        The output qual filepath
+
+    Returns
+    -------
+    int
+        The number of reads written
+
+    Raises
+    ------
+    ValueError
+        If the file is not an sff file or is truncated
+
+    Notes
+    -----
+    The output is the same written by process_sff.py, without launching it.
+    """
+    count = 0
+    with open(seqs_fp, 'wb') as sfh, open(quals_fp, 'wb') as qfh:
+        for read in parse_sff(sff_fp):
+            header = _header(read)
+            seq = read.sequence
+            sfh.write(header + _wrap(
+                [seq[i:i + 1] for i in range(len(seq))], b''))
+            qfh.write(header + _wrap(
+                [str(q).encode('ascii') for q in read.qual], b' '))
+            count += 1
+    return count
@@ -7,10 +7,47 @@
 # -----------------------------------------------------------------------------
 
 from os.path import join, basename, splitext
-
-from qiita_client.util import system_call
+from shutil import copyfileobj
+
+from qp_target_gene.cache import cached_command
+from qp_target_gene.compression import (
+    strip_compression_extension, decompress_unsupported)
+from qp_target_gene.checkpoint import Checkpoints
+from qp_target_gene.demux_index import index_fp
+from qp_target_gene.manifest import Manifest, write_manifests
+from qp_target_gene.progress import ProgressReporter
+from qp_target_gene.staging import staged_command
+from qp_target_gene.timing import (
+    TIMINGS_FILENAME, Timings, count_demux_reads)
 from .util import (get_artifact_information, split_mapping_file,
-                   generate_demux_file, generate_artifact_info)
+                   generate_demux_file, generate_artifact_info, count_reads)
+from .sff import write_sff_fasta_qual
+
+
+# the checkpoint key of the sff processing stages; changing the way the sff
+# files are processed should change it, so they are processed again
+SFF_STAGE_KEY = 'parse_sff'
+
+# the bytes copied at a time while concatenating the outputs of the runs
+COPY_BUFFER_SIZE = 2 ** 20
+
+
+def concatenate_files(fps, out_fp, manifest):
+    """Concatenates files, checksumming the result as it is written
+
+    Parameters
+    ----------
+    fps : list of str
+        The filepaths, in order
+    out_fp : str
+        The output filepath
+    manifest : qp_target_gene.manifest.Manifest
+        The manifest of the output directory
+    """
+    with manifest.open(out_fp) as out:
+        for fp in fps:
+            with open(fp, 'rb') as f:
+                copyfileobj(f, out, COPY_BUFFER_SIZE)
 
 
 def generate_parameters_string(parameters):
@@ -53,8 +90,8 @@ def generate_parameters_string(parameters):
     return ' '.join(result)
 
 
-def generate_process_sff_commands(sffs, out_dir):
-    """Processes the sff files in `sffs`
+def generate_process_sff_filepaths(sffs, out_dir):
+    """Generates the fasta and qual filepaths of the sff files in `sffs`
 
     Parameters
     ----------
@@ -65,25 +102,19 @@ def generate_process_sff_commands(sffs, out_dir):
 
     Returns
     -------
-    list of str, list of str, list of str
-        The list of process_sff.py commands
+    list of str, list of str
         The list of fasta filepaths
         The list of qual filepaths
     """
-    sff_cmd_template = "process_sff.py -i %s -o %s"
     seqs = []
     quals = []
-    cmds = []
     for sff in sffs:
-        base = splitext(basename(sff))[0]
-        if sff.endswith('.gz'):
-            base = splitext(base)[0]
+        base = splitext(strip_compression_extension(basename(sff)))[0]
 
-        cmds.append(sff_cmd_template % (sff, out_dir))
         seqs.append(join(out_dir, '%s.fna' % base))
         quals.append(join(out_dir, '%s.qual' % base))
 
-    return cmds, seqs, quals
+    return seqs, quals
 
 
 def generate_split_libraries_cmd(seqs, quals, mapping_file, out_dir, params):
@@ -137,6 +168,10 @@ def generate_split_libraries_cmd(seqs, quals, mapping_file, out_dir, params):
                 "Your run prefix column defines '%s', but you have '%s' "
                 "as sequence files"
                 % (', '.join(mapping_files), ', '.join(seqs)))
+        # each run numbers its reads starting after the reads of the
+        # previous runs, so the runs can be executed in any order and their
+        # sequence ids never overlap
+        counts = count_reads(seqs)
         n = 1
         for i, (seq, mapping) in enumerate(zip(seqs, mapping_files)):
             qual_str = '-q %s -d' % quals[i] if quals else ''
@@ -144,13 +179,13 @@ def generate_split_libraries_cmd(seqs, quals, mapping_file, out_dir, params):
             out_dirs.append(split_dir)
             cmds.append("split_libraries.py -f %s -m %s %s -o %s -n %s %s"
                         % (seq, mapping, qual_str, split_dir, n, params_str))
-            # Number comes from (100K larger than amplicon):
-            # http://454.com/products/gs-FLX-system/index.asp
-            n = (i + 1) * 800000
+            n += counts[i]
 
     return cmds, out_dirs
 
 
+@cached_command('split_libraries', uses_prep=True)
+@staged_command
 def split_libraries(qclient, job_id, parameters, out_dir):
     """Run split libraries with the given parameters
 
@@ -180,98 +215,144 @@ def split_libraries(qclient, job_id, parameters, out_dir):
         If there is an error processing an sff file
         If there is an error running split_libraries.py
         If there is an error merging the results
+
+    Notes
+    -----
+    The completed stages are recorded in `out_dir`, so if the job is
+    re-run in the same directory the stages whose inputs and outputs didn't
+    change are not executed again.
     """
-    # Step 1 get the rest of the information need to run split libraries
-    qclient.update_job_step(job_id, "Step 1 of 4: Collecting information")
-    artifact_id = parameters['input_data']
-    filepaths, mapping_file, atype = get_artifact_information(
-        qclient, artifact_id, out_dir)
-
-    # Step 2 generate the split libraries command
-    qclient.update_job_step(job_id, "Step 2 of 4: preparing files")
-    sffs = filepaths.get('raw_sff', [])
-    seqs = filepaths.get('raw_fasta', [])
-    quals = filepaths.get('raw_qual', [])
-
-    if seqs and sffs:
-        raise ValueError('Cannot have SFF and raw fasta on the same artifact')
-    elif quals and not seqs:
-        raise ValueError('Cannot have just qual files on the artifact, you '
-                         'also need raw fasta files')
-    elif seqs and not quals:
-        raise ValueError('It is not currently possible to process fasta '
-                         'file(s) without qual file(s). This will be '
-                         'supported in the future. You can track progress on '
-                         'this by following: '
-                         'https://github.com/biocore/qiita/issues/953')
-    elif seqs:
-        seqs = sorted(seqs)
-        quals = sorted(quals)
-    else:
-        cmds, seqs, quals = generate_process_sff_commands(sffs, out_dir)
-        len_cmds = len(cmds)
-        for i, cmd in enumerate(cmds):
-            qclient.update_job_step(
-                job_id,
-                "Step 2 of 4: preparing files (processing sff file %d of %d)"
-                % (i, len_cmds))
-            std_out, std_err, return_value = system_call(cmd)
-            if return_value != 0:
-                raise RuntimeError(
-                    "Error processing sff file:\nStd output: %s\n Std error:%s"
-                    % (std_out, std_err))
-
-    output_dir = join(out_dir, 'sl_out')
-
-    commands, sl_outs = generate_split_libraries_cmd(
-        seqs, quals, mapping_file, output_dir, parameters)
-
-    # Step 3 execute split libraries
-    cmd_len = len(commands)
-    for i, cmd in enumerate(commands):
-        qclient.update_job_step(
-            job_id,
-            "Step 3 of 4: Executing demultiplexing and quality control "
-            "(%d of %d)" % (i, cmd_len))
-        std_out, std_err, return_value = system_call(cmd)
-        if return_value != 0:
-            raise RuntimeError(
-                "Error running split libraries:\nStd output: %s\nStd error:%s"
-                % (std_out, std_err))
-
-    # Step 4 merging results
-    if cmd_len > 1:
-        qclient.update_job_step(
-            job_id,
-            "Step 4 of 4: Merging results (concatenating files)")
-        to_cat = ['split_library_log.txt', 'seqs.fna']
+    with ProgressReporter(qclient, job_id) as progress, \
+            Timings(join(out_dir, TIMINGS_FILENAME)) as timings:
+        # Step 1 get the rest of the information need to run split libraries
+        progress.update("Step 1 of 4: Collecting information")
+        timings.start("Collecting information")
+        log_dir = join(out_dir, 'logs')
+        checkpoints = Checkpoints(out_dir)
+        artifact_id = parameters['input_data']
+        filepaths, mapping_file, atype = get_artifact_information(
+            qclient, artifact_id, out_dir)
+
+        # Step 2 generate the split libraries command
+        progress.update("Step 2 of 4: preparing files")
+        timings.start("Preparing files")
+        sffs = filepaths.get('raw_sff', [])
+        seqs = filepaths.get('raw_fasta', [])
+        quals = filepaths.get('raw_qual', [])
+
+        if seqs and sffs:
+            raise ValueError(
+                'Cannot have SFF and raw fasta on the same artifact')
+        elif quals and not seqs:
+            raise ValueError('Cannot have just qual files on the artifact, '
+                             'you also need raw fasta files')
+        elif seqs and not quals:
+            raise ValueError('It is not currently possible to process fasta '
+                             'file(s) without qual file(s). This will be '
+                             'supported in the future. You can track '
+                             'progress on this by following: '
+                             'https://github.com/biocore/qiita/issues/953')
+        elif seqs:
+            # QIIME reads the gzipped files, the others are decompressed
+            inputs_dir = join(out_dir, 'inputs')
+            seqs = decompress_unsupported(sorted(seqs), inputs_dir)
+            quals = decompress_unsupported(sorted(quals), inputs_dir)
+        else:
+            seqs, quals = generate_process_sff_filepaths(sffs, out_dir)
+            len_sffs = len(sffs)
+            for i, sff in enumerate(sffs):
+                progress.update(
+                    "Step 2 of 4: preparing files (processing sff file %d of "
+                    "%d)" % (i, len_sffs))
+                stage = 'process_sff_%d' % i
+                if checkpoints.is_complete(stage, [sff], SFF_STAGE_KEY):
+                    continue
+                checkpoints.start(stage)
+                try:
+                    write_sff_fasta_qual(sff, seqs[i], quals[i])
+                except ValueError as e:
+                    raise RuntimeError(
+                        "Error processing sff file %s: %s" % (sff, e))
+                checkpoints.complete(stage, [sff], [seqs[i], quals[i]],
+                                     SFF_STAGE_KEY)
+
+        output_dir = join(out_dir, 'sl_out')
+
+        commands, sl_outs = generate_split_libraries_cmd(
+            seqs, quals, mapping_file, output_dir, parameters)
+
+        # Step 3 execute split libraries
+        timings.start("Demultiplexing and quality control")
+        cmd_len = len(commands)
+        sl_files = ['split_library_log.txt', 'seqs.fna']
         if quals:
-            to_cat.append('seqs_filtered.qual')
-        for tc in to_cat:
-            files = [join(x, tc) for x in sl_outs]
-            cmd = "cat %s > %s" % (' '.join(files), join(output_dir, tc))
-            std_out, std_err, return_value = system_call(cmd)
-            if return_value != 0:
+            sl_files.append('seqs_filtered.qual')
+        for i, (cmd, sl_out) in enumerate(zip(commands, sl_outs)):
+            step = ("Step 3 of 4: Executing demultiplexing and quality "
+                    "control (%d of %d)" % (i, cmd_len))
+            progress.update(step)
+            stage = 'split_libraries_%d' % i
+            inputs = seqs + quals + [mapping_file]
+            if checkpoints.is_complete(stage, inputs, cmd):
+                continue
+            checkpoints.start(stage)
+            result = timings.run_command(
+                cmd, log_dir, progress=lambda line: progress.update(
+                    "%s: %s" % (step, line)))
+            if result.return_value != 0:
                 raise RuntimeError(
-                    "Error concatenating %s files:\nStd output: %s\n"
-                    "Std error:%s" % (tc, std_out, std_err))
-    if quals:
-        qclient.update_job_step(
-            job_id,
-            "Step 4 of 4: Merging results (converting fastqual to fastq)")
-        cmd = ("convert_fastaqual_fastq.py -f %s -q %s -o %s -F"
-               % (join(output_dir, 'seqs.fna'),
-                  join(output_dir, 'seqs_filtered.qual'),
-                  output_dir))
-        std_out, std_err, return_value = system_call(cmd)
-        if return_value != 0:
-            raise RuntimeError("Error converting the fasta/qual files to "
-                               "fastq. %d: %s" % (return_value, std_err))
-    qclient.update_job_step(
-        job_id, "Step 4 of 4: Merging results (generating demux file)")
-
-    generate_demux_file(output_dir)
-
-    artifacts_info = generate_artifact_info(output_dir)
-
-    return True, artifacts_info, ""
+                    "Error running split libraries:\nStd output: %s\nStd "
+                    "error:%s" % (result.stdout_tail, result.stderr_tail))
+            checkpoints.complete(stage, inputs,
+                                 [join(sl_out, f) for f in sl_files], cmd)
+
+        # Step 4 merging results
+        timings.start("Merging results")
+        if cmd_len > 1:
+            progress.update(
+                "Step 4 of 4: Merging results (concatenating files)")
+            # the outputs are concatenated here instead of with cat, so they
+            # are checksummed as they are written
+            with Manifest(output_dir) as manifest:
+                for tc in sl_files:
+                    files = [join(x, tc) for x in sl_outs]
+                    stage = 'concatenate_%s' % tc
+                    if checkpoints.is_complete(stage, files):
+                        continue
+                    checkpoints.start(stage)
+                    concatenate_files(files, join(output_dir, tc), manifest)
+                    checkpoints.complete(stage, files, [join(output_dir, tc)])
+        if quals:
+            progress.update(
+                "Step 4 of 4: Merging results (converting fastqual to fastq)")
+            inputs = [join(output_dir, 'seqs.fna'),
+                      join(output_dir, 'seqs_filtered.qual')]
+            cmd = ("convert_fastaqual_fastq.py -f %s -q %s -o %s -F"
+                   % (inputs[0], inputs[1], output_dir))
+            if not checkpoints.is_complete('convert_fastaqual', inputs, cmd):
+                checkpoints.start('convert_fastaqual')
+                result = timings.run_command(cmd, log_dir)
+                if result.return_value != 0:
+                    raise RuntimeError(
+                        "Error converting the fasta/qual files to fastq. "
+                        "%d: %s" % (result.return_value, result.stderr_tail))
+                checkpoints.complete('convert_fastaqual', inputs,
+                                     [join(output_dir, 'seqs.fastq')], cmd)
+        progress.update(
+            "Step 4 of 4: Merging results (generating demux file)")
+
+        timings.start("Generating demux file")
+        fastq_fp = join(output_dir, 'seqs.fastq')
+        if not checkpoints.is_complete('demux', [fastq_fp]):
+            checkpoints.start('demux')
+            generate_demux_file(output_dir)
+            demux_fp = join(output_dir, 'seqs.demux')
+            checkpoints.complete('demux', [fastq_fp],
+                                 [demux_fp, index_fp(demux_fp)])
+        timings.add_reads(count_demux_reads(join(output_dir, 'seqs.demux')))
+
+        artifacts_info = generate_artifact_info(output_dir)
+        write_manifests(artifacts_info)
+        timings.attach(artifacts_info)
+
+        return True, artifacts_info, ""
@@ -11,11 +11,22 @@ import re
 
 import pandas as pd
 
-from qiita_client.util import system_call
+from qp_target_gene.cache import cached_command
+from qp_target_gene.compression import decompress_unsupported
+from qp_target_gene.manifest import write_manifests
+from qp_target_gene.progress import ProgressReporter
+from qp_target_gene.staging import staged_command
+from qp_target_gene.timing import (
+    TIMINGS_FILENAME, Timings, count_demux_reads)
 from .util import (get_artifact_information, split_mapping_file,
                    generate_demux_file, generate_artifact_info)
 
 
+# the filepath types of the files read by split_libraries_fastq.py
+SEQUENCE_FILEPATH_TYPES = ('raw_forward_seqs', 'raw_reverse_seqs',
+                           'raw_barcodes')
+
+
 def generate_parameters_string(parameters):
     """Generates the parameters string from the parameters dictionary
 
@@ -61,7 +72,8 @@ def get_sample_names_by_run_prefix(mapping_file):
         If there is more than 1 sample per run_prefix
     """
     qiime_map = pd.read_csv(mapping_file, delimiter='\t', dtype=str,
-                            encoding='utf-8')
+                            encoding='utf-8',
+                            usecols=['#SampleID', 'run_prefix'])
     qiime_map.set_index('#SampleID', inplace=True)
 
     samples = {}
@@ -221,6 +233,8 @@ def generate_split_libraries_fastq_cmd(filepaths, mapping_file, atype,
     return cmd, output_dir
 
 
+@cached_command('split_libraries_fastq', uses_prep=True)
+@staged_command
 def split_libraries_fastq(qclient, job_id, parameters, out_dir):
     """Run split libraries fastq with the given parameters
 
@@ -240,30 +254,48 @@ def split_libraries_fastq(qclient, job_id, parameters, out_dir):
     bool, list, str
         The results of the job
     """
-    # Step 1 get the rest of the information need to run split libraries
-    qclient.update_job_step(job_id, "Step 1 of 4: Collecting information")
-    artifact_id = parameters['input_data']
-    filepaths, mapping_file, atype = get_artifact_information(
-        qclient, artifact_id, out_dir)
-
-    # Step 2 generate the split libraries fastq command
-    qclient.update_job_step(job_id, "Step 2 of 4: Generating command")
-    command, sl_out = generate_split_libraries_fastq_cmd(
-        filepaths, mapping_file, atype, out_dir, parameters)
-
-    # Step 3 execute split libraries
-    qclient.update_job_step(
-        job_id, "Step 3 of 4: Executing demultiplexing and quality control")
-    std_out, std_err, return_value = system_call(command)
-    if return_value != 0:
-        raise RuntimeError(
-            "Error processing files:\nStd output: %s\n Std error:%s"
-            % (std_out, std_err))
-
-    # Step 4 generate the demux file
-    qclient.update_job_step(job_id, "Step 4 of 4: Generating demux file")
-    generate_demux_file(sl_out)
-
-    artifacts_info = generate_artifact_info(sl_out)
-
-    return True, artifacts_info, ""
+    with ProgressReporter(qclient, job_id) as progress, \
+            Timings(join(out_dir, TIMINGS_FILENAME)) as timings:
+        # Step 1 get the rest of the information need to run split libraries
+        progress.update("Step 1 of 4: Collecting information")
+        timings.start("Collecting information")
+        artifact_id = parameters['input_data']
+        filepaths, mapping_file, atype = get_artifact_information(
+            qclient, artifact_id, out_dir)
+
+        # Step 2 generate the split libraries fastq command
+        progress.update("Step 2 of 4: Generating command")
+        timings.start("Generating command")
+        # QIIME reads the gzipped files, the others are decompressed
+        filepaths = {
+            fp_type: decompress_unsupported(fps, join(out_dir, 'inputs'))
+            if fp_type in SEQUENCE_FILEPATH_TYPES else fps
+            for fp_type, fps in filepaths.items()}
+        command, sl_out = generate_split_libraries_fastq_cmd(
+            filepaths, mapping_file, atype, out_dir, parameters)
+
+        # Step 3 execute split libraries
+        progress.update(
+            "Step 3 of 4: Executing demultiplexing and quality control")
+        timings.start("Demultiplexing and quality control")
+        result = timings.run_command(
+            command, join(out_dir, 'logs'),
+            progress=lambda line: progress.update(
+                "Step 3 of 4: Executing demultiplexing and quality control: "
+                "%s" % line))
+        if result.return_value != 0:
+            raise RuntimeError(
+                "Error processing files:\nStd output: %s\n Std error:%s"
+                % (result.stdout_tail, result.stderr_tail))
+
+        # Step 4 generate the demux file
+        progress.update("Step 4 of 4: Generating demux file")
+        timings.start("Generating demux file")
+        generate_demux_file(sl_out)
+        timings.add_reads(count_demux_reads(join(sl_out, 'seqs.demux')))
+
+        artifacts_info = generate_artifact_info(sl_out)
+        write_manifests(artifacts_info)
+        timings.attach(artifacts_info)
+
+        return True, artifacts_info, ""
@@ -0,0 +1,188 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from unittest import TestCase, main
+
+import numpy as np
+import numpy.testing as npt
+
+from qp_target_gene.split_libraries.primers import encode_reads
+from qp_target_gene.split_libraries.filters import (
+    max_homopolymer_runs, count_ambiguous, first_ambiguous,
+    mean_quality_below, quality_window_truncation, apply_sequence_filters,
+    apply_quality_filters)
+
+
+# the per read checks of QIIME 1 split_libraries.py, to compare the results
+def count_ambig(curr_seq, valid_chars='ATCG'):
+    up_seq = curr_seq.upper()
+    total = 0
+    for vchar in valid_chars:
+        total += up_seq.count(vchar)
+    return len(curr_seq) - total
+
+
+def seq_exceeds_homopolymers(curr_seq, max_len=6):
+    for base in 'ATGC':
+        curr = base * (max_len + 1)
+        if curr in curr_seq:
+            return True
+    return False
+
+
+def check_window_qual_scores(qual_scores, window=50, min_average=25):
+    length = len(qual_scores)
+    window = min(window, length)
+    if window == 0:
+        return True, 0
+    window_score = sum(qual_scores[:window])
+    idx = 0
+    while (window_score / float(window) >= min_average and
+           idx < length - window):
+        window_score += qual_scores[idx + window] - qual_scores[idx]
+        idx += 1
+    return idx == length - window, idx
+
+
+def _quals(quals):
+    result = np.zeros((len(quals), max(len(q) for q in quals)),
+                      dtype=np.uint8)
+    for i, q in enumerate(quals):
+        result[i, :len(q)] = q
+    return result
+
+
+class FiltersTests(TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.seqs = [''.join(rng.choice(list('AAAACGTNnacRY'),
+                                        rng.randint(0, 80)))
+                     for _ in range(300)]
+        self.quals = [list(rng.choice([10, 20, 25, 30, 35, 40], len(s)))
+                      for s in self.seqs]
+        self.codes, self.lengths = encode_reads(
+            [s.encode('ascii') for s in self.seqs])
+        self.qual_array = _quals(self.quals)
+
+    def test_max_homopolymer_runs(self):
+        codes, lengths = encode_reads([b'AAACCCCGT', b'', b'NNNNAAT',
+                                       b'TTAAaaaa', b'G'])
+        npt.assert_equal(max_homopolymer_runs(codes, lengths),
+                         [4, 0, 2, 2, 1])
+
+        obs = max_homopolymer_runs(self.codes, self.lengths)
+        for max_len in range(1, 6):
+            npt.assert_equal(obs > max_len,
+                             [seq_exceeds_homopolymers(s, max_len)
+                              for s in self.seqs])
+
+    def test_count_ambiguous(self):
+        codes, lengths = encode_reads([b'ACGTN', b'', b'acgtnRY'])
+        npt.assert_equal(count_ambiguous(codes, lengths), [1, 0, 3])
+        npt.assert_equal(count_ambiguous(self.codes, self.lengths),
+                         [count_ambig(s) for s in self.seqs])
+
+    def test_first_ambiguous(self):
+        codes, lengths = encode_reads([b'ACGTNACN', b'ACGT', b'NACGn'])
+        npt.assert_equal(first_ambiguous(codes, lengths), [4, 4, 0])
+        npt.assert_equal(first_ambiguous(codes, lengths, np.array([5, 0, 1])),
+                         [7, 4, 5])
+        npt.assert_equal(first_ambiguous(self.codes, self.lengths),
+                         [len(s.split('N')[0]) for s in self.seqs])
+
+    def test_mean_quality_below(self):
+        quals = _quals([[30, 30, 20], [25, 25], [0]])
+        npt.assert_equal(mean_quality_below(quals, np.array([3, 2, 0]), 25),
+                         [False, False, False])
+        npt.assert_equal(mean_quality_below(quals, np.array([3, 2, 0]), 26),
+                         [False, True, False])
+
+        for min_qual in (20, 25, 30):
+            npt.assert_equal(
+                mean_quality_below(self.qual_array, self.lengths, min_qual),
+                [len(q) > 0 and np.mean(q) < min_qual for q in self.quals])
+
+    def test_quality_window_truncation(self):
+        quals = _quals([[30, 30, 30, 10, 10, 30, 30],
+                        [30, 30, 30, 30, 30, 30, 10],
+                        [10, 10]])
+        obs_pass, obs_stop = quality_window_truncation(
+            quals, np.array([7, 7, 2]), 2, 25)
+        npt.assert_equal(obs_pass, [False, True, True])
+        npt.assert_equal(obs_stop, [2, 7, 2])
+
+        rng = np.random.RandomState(1)
+        for window in (1, 3, 10, 50):
+            for min_qual in (20, 25, 30):
+                start = rng.randint(0, 5, len(self.quals))
+                obs_pass, obs_stop = quality_window_truncation(
+                    self.qual_array, self.lengths, window, min_qual, start)
+                for i, q in enumerate(self.quals):
+                    passed, idx = check_window_qual_scores(
+                        q[start[i]:], window, min_qual)
+                    self.assertEqual(obs_pass[i], passed)
+                    self.assertEqual(obs_stop[i], self.lengths[i]
+                                     if passed else start[i] + idx)
+
+    def test_apply_sequence_filters(self):
+        codes, lengths = encode_reads([b'ACGTACGT', b'ACNNACGT',
+                                       b'AAAAAGTA', b'ACGTANGT'])
+        keep, stop = apply_sequence_filters(codes, lengths, 1, 4)
+        npt.assert_equal(keep, [True, False, False, True])
+        npt.assert_equal(stop, lengths)
+
+        keep, stop = apply_sequence_filters(codes, lengths, 1, 4, True)
+        npt.assert_equal(keep, [True, True, False, True])
+        npt.assert_equal(stop, [8, 2, 8, 5])
+
+        keep, _ = apply_sequence_filters(self.codes, self.lengths, 2, 3)
+        npt.assert_equal(keep, [count_ambig(s) <= 2 and
+                                not seq_exceeds_homopolymers(s, 3)
+                                for s in self.seqs])
+
+    def test_apply_quality_filters(self):
+        params = {'min_qual_score': 25, 'max_ambig': 1,
+                  'max_homopolymer': 4, 'qual_score_window': 0,
+                  'truncate_ambi_bases': False, 'min_seq_len': 3}
+        codes, lengths = encode_reads([b'ACGTACGTAC', b'ACGTNNACGT',
+                                       b'ACAAAAAGTA', b'ACGTACGTAC',
+                                       b'ACGNACGTAC'])
+        quals = _quals([[30] * 10, [30] * 10, [30] * 10,
+                        [30] * 5 + [10] * 5, [30, 30, 30] + [10] * 7])
+        obs = apply_quality_filters(codes, quals, lengths, params)
+        npt.assert_equal(obs.keep, [True, False, False, False, False])
+        npt.assert_equal(obs.stop, lengths)
+        self.assertEqual(obs.failures, {'min_qual_score': 2, 'max_ambig': 1,
+                                        'max_homopolymer': 1,
+                                        'min_seq_len': 0})
+
+        params.update({'min_qual_score': 20, 'qual_score_window': 3,
+                       'truncate_ambi_bases': True})
+        obs = apply_quality_filters(codes, quals, lengths, params,
+                                    start=np.array([1, 1, 1, 1, 1]))
+        npt.assert_equal(obs.keep, [True, True, False, True, False])
+        npt.assert_equal(obs.stop, [10, 4, 10, 4, 3])
+        self.assertEqual(obs.failures, {'min_qual_score': 1,
+                                        'max_homopolymer': 1,
+                                        'min_seq_len': 0})
+
+        # the reads too short after the truncations are discarded
+        params['min_seq_len'] = 4
+        obs = apply_quality_filters(codes, quals, lengths, params,
+                                    start=np.array([1, 1, 1, 1, 1]))
+        npt.assert_equal(obs.keep, [True, False, False, False, False])
+        self.assertEqual(obs.failures['min_seq_len'], 2)
+
+        # without quality scores
+        obs = apply_quality_filters(codes, None, lengths, params)
+        npt.assert_equal(obs.keep, [True, True, False, True, False])
+        npt.assert_equal(obs.stop, [10, 4, 10, 10, 3])
+
+
+if __name__ == '__main__':
+    main()
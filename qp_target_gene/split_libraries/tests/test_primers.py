@@ -0,0 +1,159 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from unittest import TestCase, main
+from os import close, remove
+from os.path import exists
+from tempfile import mkstemp
+
+import numpy as np
+import numpy.testing as npt
+
+from qp_target_gene.split_libraries.primers import (
+    reverse_complement, encode_reads, PrimerMatcher, read_mapping_primers,
+    PrimerEngine)
+
+
+class PrimersTests(TestCase):
+    def setUp(self):
+        self._clean_up_files = []
+
+    def tearDown(self):
+        for fp in self._clean_up_files:
+            if exists(fp):
+                remove(fp)
+
+    def test_reverse_complement(self):
+        self.assertEqual(reverse_complement('GGACTACHVGGGTWTCTAAT'),
+                         'ATTAGAWACCCBDGTAGTCC')
+        self.assertEqual(reverse_complement('acgn'), 'NCGT')
+        with self.assertRaises(ValueError):
+            reverse_complement('ACGX')
+
+    def test_encode_reads(self):
+        codes, lengths = encode_reads([b'ACG', b'', b'TTTTT'])
+        npt.assert_equal(lengths, [3, 0, 5])
+        npt.assert_equal(codes, [[65, 67, 71, 0, 0],
+                                 [0, 0, 0, 0, 0],
+                                 [84, 84, 84, 84, 84]])
+
+        codes, lengths = encode_reads(np.array([b'ACG', b'', b'TTTTT']))
+        npt.assert_equal(lengths, [3, 0, 5])
+        npt.assert_equal(codes, [[65, 67, 71, 0, 0],
+                                 [0, 0, 0, 0, 0],
+                                 [84, 84, 84, 84, 84]])
+
+    def test_primer_matcher_error(self):
+        with self.assertRaises(ValueError):
+            PrimerMatcher([], 1)
+        with self.assertRaisesRegexp(ValueError, 'IUPAC'):
+            PrimerMatcher(['ACGX'], 1)
+        with self.assertRaisesRegexp(ValueError, 'between 1 and 64'):
+            PrimerMatcher(['A' * 65], 1)
+
+    def test_match_start(self):
+        matcher = PrimerMatcher(['GTGCCAGCMGCCGCGGTAA'], 1)
+        codes, lengths = encode_reads([
+            # exact, with each base of the degenerate position
+            b'GTGCCAGCAGCCGCGGTAATACG',
+            b'GTGCCAGCCGCCGCGGTAATACG',
+            # a mismatch, an insertion and a deletion
+            b'GTGCCAGCAGCCGCTGTAATACG',
+            b'GTGCCAGCAGCCGACGGTAATACG',
+            b'GTGCCAGCAGCCCGGTAATACG',
+            # two mismatches
+            b'GTGCCAGCAGCCGCTGTATTACG',
+            # the primer is not at the start
+            b'TTTGTGCCAGCAGCCGCGGTAATACG',
+            # too short
+            b'GTGCC'])
+        obs = matcher.match_start(codes, lengths)
+        npt.assert_equal(obs.found, [True] * 5 + [False] * 3)
+        npt.assert_equal(obs.errors[:5], [0, 0, 1, 1, 1])
+        npt.assert_equal(obs.start, [0] * 5 + [-1] * 3)
+        npt.assert_equal(obs.end, [19, 19, 19, 20, 18, -1, -1, -1])
+
+    def test_search(self):
+        matcher = PrimerMatcher(['ATTAGAWACCCBDGTAGTCC', 'ACGTACGT'], 2)
+        codes, lengths = encode_reads([
+            b'AAAAAAAAATTAGAAACCCCAGTAGTCCAAAA',
+            b'AAAAAAAAATTAGAAACCCCAGGTCCAAAA',
+            b'AAAATTAGAAACCCCAGTAGTCC',
+            b'TTTACGTACGTTTTTTATTAGAAACCCCAGTAGTCC',
+            b'AAAAAAAAAAAAAAAAAAAAAAAAA'])
+        obs = matcher.search(codes, lengths)
+        npt.assert_equal(obs.found, [True, True, True, True, False])
+        npt.assert_equal(obs.errors[:4], [0, 2, 0, 0])
+        npt.assert_equal(obs.start, [8, 8, 3, 3, -1])
+        npt.assert_equal(obs.end, [28, 26, 23, 11, -1])
+
+    def test_read_mapping_primers(self):
+        fd, fp = mkstemp(suffix='_mapping.txt')
+        close(fd)
+        self._clean_up_files.append(fp)
+        with open(fp, 'w') as f:
+            f.write(MAPPING_FILE)
+        obs = read_mapping_primers(fp)
+        self.assertEqual(list(obs), ['Sample1', 'Sample2'])
+        self.assertEqual(obs['Sample1'],
+                         (['GTGCCAGCMGCCGCGGTAA'], ['ATTAGAWACCCBDGTAGTCC']))
+        self.assertEqual(obs['Sample2'],
+                         (['GTGCCAGCMGCCGCGGTAA', 'GTGYCAGCMGCCGCGGTAA'],
+                          []))
+
+    def test_primer_engine(self):
+        primers = {'s1': (['GTGCCAGCMGCCGCGGTAA'], ['ATTAGAWACCCBDGTAGTCC']),
+                   's2': (['ACGTACGT'], ['TTTTTTTT'])}
+        seqs = [b'GTGCCAGCAGCCGCGGTAACCCCCATTAGAAACCCCAGTAGTCCGG',
+                b'GTGCCAGCAGCCGCGGTAACCCCCGGGGG',
+                b'ACGTACGTAAAATTTTTTTT',
+                b'TTTTTTTTACGTACGTAAAA']
+        samples = ['s1', 's1', 's2', 's2']
+
+        keep, start, stop = PrimerEngine(primers, 0).process(seqs, samples)
+        npt.assert_equal(keep, [True, True, True, False])
+        npt.assert_equal(start[:3], [19, 19, 8])
+        npt.assert_equal(stop, [46, 29, 20, 20])
+
+        keep, start, stop = PrimerEngine(
+            primers, 0, 'truncate_only', 1).process(seqs, samples)
+        npt.assert_equal(keep, [True, True, True, False])
+        npt.assert_equal(start[:3], [19, 19, 8])
+        npt.assert_equal(stop[:3], [24, 29, 12])
+
+        keep, start, stop = PrimerEngine(
+            primers, 0, 'truncate_remove', 1).process(seqs, samples)
+        npt.assert_equal(keep, [True, False, True, False])
+
+        keep, start, stop = PrimerEngine(
+            primers, 0, disable_primers=True).process(seqs, samples)
+        npt.assert_equal(keep, [True] * 4)
+        npt.assert_equal(start, [0] * 4)
+
+        with self.assertRaises(KeyError):
+            PrimerEngine(primers, 0).process(seqs, ['s1', 's1', 's2', 's3'])
+
+    def test_primer_engine_error(self):
+        with self.assertRaisesRegexp(ValueError, 'not recognized'):
+            PrimerEngine({}, 0, 'whops')
+        with self.assertRaisesRegexp(ValueError, 'no reverse primers'):
+            PrimerEngine({'s1': (['ACGT'], [])}, 0, 'truncate_only')
+
+
+MAPPING_FILE = (
+    "#SampleID\tBarcodeSequence\tLinkerPrimerSequence\tReverseLinkerPrimer\t"
+    "Description\n"
+    "Sample1\tGTCCGCAAGTTA\tGTGCCAGCMGCCGCGGTAA\tGGACTACHVGGGTWTCTAAT\t"
+    "TGP test\n"
+    "Sample2\tCGTAGAGCTCTC\tGTGCCAGCMGCCGCGGTAA,GTGYCAGCMGCCGCGGTAA\t\t"
+    "TGP test\n"
+)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from unittest import TestCase, main
+from os import remove
+from os.path import exists, isdir, join, dirname
+from shutil import rmtree, copyfileobj
+from tempfile import mkdtemp
+from struct import pack
+import gzip
+
+import numpy.testing as npt
+
+from qp_target_gene.split_libraries.sff import (
+    parse_sff, decode_accession, write_sff_fasta_qual)
+
+
+TEST_DATA = join(dirname(__file__), 'test_data')
+
+
+def _pad(data):
+    return data + b'\0' * (-len(data) % 8)
+
+
+def _sff(reads, n_flows=4, index=b''):
+    """Builds an sff file with the index after the first read"""
+    key = b'TCAG'
+    header_length = len(_pad(b'\0' * 31 + b'ACGT'[:n_flows] + key))
+    records = []
+    for name, bases, quals, clip_left, clip_right in reads:
+        header = pack('>HHIHHHH', len(_pad(b'\0' * 16 + name)), len(name),
+                      len(bases), clip_left, clip_right, 0, 0)
+        data = (b'\0' * 2 * n_flows + b'\1' * len(bases) + bases +
+                bytes(bytearray(quals)))
+        records.append(_pad(header + name) + _pad(data))
+    index_offset = header_length + len(records[0]) if index else 0
+    common = pack('>IIQIIHHHB', 0x2E736666, 1, index_offset, len(index),
+                  len(reads), header_length, len(key), n_flows, 1)
+    return (_pad(common + b'ACGT'[:n_flows] + key) + records[0] +
+            _pad(index) + b''.join(records[1:]))
+
+
+class SFFTests(TestCase):
+    def setUp(self):
+        self._clean_up_files = []
+        self.out_dir = mkdtemp()
+        self._clean_up_files.append(self.out_dir)
+
+    def tearDown(self):
+        for fp in self._clean_up_files:
+            if exists(fp):
+                if isdir(fp):
+                    rmtree(fp)
+                else:
+                    remove(fp)
+
+    def _write(self, name, data):
+        fp = join(self.out_dir, name)
+        if name.endswith('.gz'):
+            with gzip.open(fp, 'wb') as f:
+                f.write(data)
+        else:
+            with open(fp, 'wb') as f:
+                f.write(data)
+        return fp
+
+    def test_parse_sff(self):
+        data = _sff([(b'read1', b'TCAGACGTAC', range(30, 40), 5, 9),
+                     (b'read2', b'TCAGGG', range(6), 5, 0),
+                     (b'read3', b'TCAG', range(4), 5, 0)],
+                    index=b'.mft1.00' + b'\0' * 12)
+        for name in ('test.sff', 'test.sff.gz'):
+            obs = list(parse_sff(self._write(name, data)))
+            self.assertEqual([(r.name, r.sequence) for r in obs],
+                             [(b'read1', b'ACGTA'), (b'read2', b'GG'),
+                              (b'read3', b'')])
+            npt.assert_equal(obs[0].qual, [34, 35, 36, 37, 38])
+            npt.assert_equal(obs[1].qual, [4, 5])
+            self.assertEqual(len(obs[2].qual), 0)
+
+    def test_parse_sff_error(self):
+        fp = self._write('test.sff', b'>read1\nACGT\n' * 10)
+        with self.assertRaisesRegexp(ValueError, 'not an sff file'):
+            list(parse_sff(fp))
+
+        data = _sff([(b'read1', b'TCAGACGTAC', range(10), 5, 0)])
+        fp = self._write('truncated.sff', data[:-10])
+        with self.assertRaisesRegexp(ValueError, 'Truncated sff file'):
+            list(parse_sff(fp))
+
+    def test_decode_accession(self):
+        self.assertEqual(decode_accession('FLP3FBN01ELBSX'),
+                         'xy=1766_0111 region=1 run=R_2008_12_09_13_51_01_')
+        with self.assertRaises(ValueError):
+            decode_accession('read1')
+
+    def test_write_sff_fasta_qual(self):
+        seqs_fp = join(self.out_dir, 'example.fna')
+        quals_fp = join(self.out_dir, 'example.qual')
+        obs = write_sff_fasta_qual(join(TEST_DATA, 'example_sff.sff.gz'),
+                                   seqs_fp, quals_fp)
+        self.assertEqual(obs, 1339)
+
+        # the same output of process_sff.py
+        for fp, exp_fp in ((seqs_fp, 'example_seqs.fna.gz'),
+                           (quals_fp, 'example_quals.fna.gz')):
+            with open(fp, 'rb') as f, gzip.open(join(TEST_DATA, exp_fp)) as e:
+                self.assertEqual(f.read(), e.read())
+
+        # from the uncompressed file too
+        sff_fp = join(self.out_dir, 'example.sff')
+        with gzip.open(join(TEST_DATA, 'example_sff.sff.gz')) as f, \
+                open(sff_fp, 'wb') as o:
+            copyfileobj(f, o)
+        self.assertEqual(write_sff_fasta_qual(sff_fp, seqs_fp, quals_fp),
+                         1339)
+        with open(seqs_fp, 'rb') as f, \
+                gzip.open(join(TEST_DATA, 'example_seqs.fna.gz')) as e:
+            self.assertEqual(f.read(), e.read())
+
+    def test_write_sff_fasta_qual_wrap(self):
+        sff_fp = self._write('test.sff', _sff(
+            [(b'read1', b'TCAG' + b'A' * 65, [30] * 69, 5, 0)]))
+        seqs_fp = join(self.out_dir, 'test.fna')
+        quals_fp = join(self.out_dir, 'test.qual')
+        self.assertEqual(write_sff_fasta_qual(sff_fp, seqs_fp, quals_fp), 1)
+        with open(seqs_fp) as f:
+            self.assertEqual(f.read(), '>read1 length=65\n%s\n%s\n'
+                             % ('A' * 60, 'A' * 5))
+        with open(quals_fp) as f:
+            self.assertEqual(f.read(), '>read1 length=65\n%s\n%s\n'
+                             % (' '.join(['30'] * 60), ' '.join(['30'] * 5)))
+
+
+if __name__ == '__main__':
+    main()
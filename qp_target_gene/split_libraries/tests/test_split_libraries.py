@@ -13,13 +13,15 @@ from shutil import rmtree, copyfile
 from tempfile import mkdtemp, mkstemp
 from json import dumps
 from functools import partial
+from zlib import crc32
 
 from qiita_client import ArtifactInfo
 from qiita_client.testing import PluginTestCase
 
+from qp_target_gene.manifest import Manifest
 from qp_target_gene.split_libraries.split_libraries import (
-    generate_parameters_string, generate_process_sff_commands,
-    generate_split_libraries_cmd, split_libraries)
+    generate_parameters_string, generate_process_sff_filepaths,
+    generate_split_libraries_cmd, split_libraries, concatenate_files)
 
 
 class SplitLibrariesTests(PluginTestCase):
@@ -63,21 +65,34 @@ class SplitLibrariesTests(PluginTestCase):
         with self.assertRaises(ValueError):
             generate_parameters_string(parameters)
 
-    def test_generate_process_sff_commands(self):
+    def test_concatenate_files(self):
+        out_dir = mkdtemp()
+        self._clean_up_files.append(out_dir)
+        fps = []
+        for i, data in enumerate([b'>r_1\nACGT\n', b'', b'>r_2\nTGCA\n']):
+            fps.append(join(out_dir, 'seqs_%d.fna' % i))
+            with open(fps[-1], 'wb') as f:
+                f.write(data)
+
+        out_fp = join(out_dir, 'seqs.fna')
+        manifest = Manifest(out_dir)
+        concatenate_files(fps, out_fp, manifest)
+        exp = b'>r_1\nACGT\n>r_2\nTGCA\n'
+        with open(out_fp, 'rb') as f:
+            self.assertEqual(f.read(), exp)
+        self.assertEqual(manifest.get(out_fp),
+                         (crc32(exp) & 0xFFFFFFFF, len(exp)))
+
+    def test_generate_process_sff_filepaths(self):
         out_dir = "/directory/output/"
         sff_fps = ["/directory/file1.sff", "/directory/file2.sff.gz"]
-        obs_cmds, obs_seqs, obs_quals = generate_process_sff_commands(
-            sff_fps, out_dir)
+        obs_seqs, obs_quals = generate_process_sff_filepaths(sff_fps, out_dir)
 
-        exp_cmds = [
-            "process_sff.py -i /directory/file1.sff -o /directory/output/",
-            "process_sff.py -i /directory/file2.sff.gz -o /directory/output/"]
         exp_seqs = ["/directory/output/file1.fna",
                     "/directory/output/file2.fna"]
         exp_quals = ["/directory/output/file1.qual",
                      "/directory/output/file2.qual"]
 
-        self.assertEqual(obs_cmds, exp_cmds)
         self.assertEqual(obs_seqs, exp_seqs)
         self.assertEqual(obs_quals, exp_quals)
 
@@ -118,6 +133,10 @@ class SplitLibrariesTests(PluginTestCase):
                 join(test_dir, "prefix_2_seqs.fna")]
         quals = [join(test_dir, "prefix_1_seqs.qual"),
                  join(test_dir, "prefix_2_seqs.qual")]
+        for fp, n_reads in zip(seqs, [3, 2]):
+            with open(fp, 'w') as f:
+                f.write(''.join('>read_%d\nACGT\n' % i
+                                for i in range(n_reads)))
         mapping_file = join(test_dir, "mapping_file.txt")
         with open(mapping_file, 'w') as f:
             f.write(MAPPING_FILE_MULT)
@@ -144,7 +163,7 @@ class SplitLibrariesTests(PluginTestCase):
             "split_libraries.py -f {0}/prefix_2_seqs.fna -m "
             "{0}/sl_out/mappings/prefix_2_mapping_file.txt -q "
             "{0}/prefix_2_seqs.qual -d -o {0}/sl_out/prefix_2_mapping_file "
-            "-n 800000 --min_seq_len 200 --max_seq_len 1000 --min_qual_score "
+            "-n 4 --min_seq_len 200 --max_seq_len 1000 --min_qual_score "
             "25 --max_ambig 6 --max_homopolymer 6 --max_primer_mismatch 0 "
             "--barcode_type golay_12 --max_barcode_errors 1.5 "
             "--qual_score_window 0 --reverse_primer_mismatches 0 "
@@ -240,6 +259,7 @@ class SplitLibrariesTests(PluginTestCase):
         fps = [(path_builder('seqs.fna'), 'preprocessed_fasta'),
                (path_builder('seqs.fastq'), 'preprocessed_fastq'),
                (path_builder('seqs.demux'), 'preprocessed_demux'),
+               (path_builder('seqs.demux.index.json'), 'log'),
                (path_builder('split_library_log.txt'), 'log')]
         exp_ainfo = [ArtifactInfo('demultiplexed', 'Demultiplexed', fps)]
         self.assertEqual(obs_ainfo, exp_ainfo)
@@ -264,6 +284,7 @@ class SplitLibrariesTests(PluginTestCase):
         fps = [(path_builder('seqs.fna'), 'preprocessed_fasta'),
                (path_builder('seqs.fastq'), 'preprocessed_fastq'),
                (path_builder('seqs.demux'), 'preprocessed_demux'),
+               (path_builder('seqs.demux.index.json'), 'log'),
                (path_builder('split_library_log.txt'), 'log')]
         exp_ainfo = [ArtifactInfo('demultiplexed', 'Demultiplexed', fps)]
         self.assertEqual(obs_ainfo, exp_ainfo)
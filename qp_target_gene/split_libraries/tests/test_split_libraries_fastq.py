@@ -380,6 +380,7 @@ class SplitLibrariesFastqTests(PluginTestCase):
             (path_builder('seqs.fna'), 'preprocessed_fasta'),
             (path_builder('seqs.fastq'), 'preprocessed_fastq'),
             (path_builder('seqs.demux'), 'preprocessed_demux'),
+            (path_builder('seqs.demux.index.json'), 'log'),
             (path_builder('split_library_log.txt'), 'log')]
         exp_ainfo = [ArtifactInfo('demultiplexed', 'Demultiplexed', filepaths)]
         self.assertEqual(obs_ainfo, exp_ainfo)
@@ -13,13 +13,15 @@ from os.path import isdir, exists, join, basename
 from shutil import rmtree
 from os import remove, close
 from tempfile import mkdtemp, mkstemp
+import gzip
 
 from qiita_client import ArtifactInfo
 from qiita_client.testing import PluginTestCase
 
 from qp_target_gene.split_libraries.util import (
-    get_artifact_information, split_mapping_file, generate_demux_file,
-    generate_artifact_info)
+    write_qiime_mapping_file, get_artifact_information, split_mapping_file,
+    generate_demux_file, generate_artifact_info, count_fasta_reads,
+    count_reads, QIIME_COLUMNS, REQUIRED_PASSTHROUGH, _read_header)
 
 
 class UtilTests(PluginTestCase):
@@ -34,6 +36,42 @@ class UtilTests(PluginTestCase):
                 else:
                     remove(fp)
 
+    def test_write_qiime_mapping_file(self):
+        out_dir = mkdtemp()
+        self._clean_up_files.append(out_dir)
+        prep_fp = join(out_dir, 'prep.txt')
+        with open(prep_fp, 'w') as f:
+            f.write(PREP_FILE)
+
+        obs_fp = join(out_dir, 'qiime-mapping-file.txt')
+        write_qiime_mapping_file(prep_fp, obs_fp)
+        with open(obs_fp) as f:
+            self.assertEqual(f.read(), EXP_QIIME_MAPPING_FILE)
+
+    def test_write_qiime_mapping_file_passthrough(self):
+        out_dir = mkdtemp()
+        self._clean_up_files.append(out_dir)
+        prep_fp = join(out_dir, 'prep.txt')
+        with open(prep_fp, 'w') as f:
+            f.write(WIDE_PREP_FILE)
+
+        obs_fp = join(out_dir, 'qiime-mapping-file.txt')
+        write_qiime_mapping_file(prep_fp, obs_fp, passthrough=['platform'])
+        with open(obs_fp) as f:
+            self.assertEqual(f.read(), EXP_PASSTHROUGH_MAPPING_FILE)
+
+    def test_write_qiime_mapping_file_chunks(self):
+        out_dir = mkdtemp()
+        self._clean_up_files.append(out_dir)
+        prep_fp = join(out_dir, 'prep.txt')
+        with open(prep_fp, 'w') as f:
+            f.write(PREP_FILE)
+
+        obs_fp = join(out_dir, 'qiime-mapping-file.txt')
+        write_qiime_mapping_file(prep_fp, obs_fp, chunksize=1)
+        with open(obs_fp) as f:
+            self.assertEqual(f.read(), EXP_QIIME_MAPPING_FILE)
+
     def test_get_artifact_information(self):
         out_dir = mkdtemp()
         obs_fps, obs_map, obs_at = get_artifact_information(
@@ -47,6 +85,10 @@ class UtilTests(PluginTestCase):
         self.assertEqual(obs_fps, exp_fps)
         self.assertEqual(obs_at, "FASTQ")
         self.assertEqual(basename(obs_map), 'qiime-mapping-file.txt')
+        # only the columns used by split libraries are in the mapping file
+        exp = set(QIIME_COLUMNS.values()) | set(REQUIRED_PASSTHROUGH) | {
+            '#SampleID', 'Description'}
+        self.assertLessEqual(set(_read_header(obs_map)), exp)
 
     def test_split_mapping_file_single(self):
         out_dir = mkdtemp()
@@ -85,6 +127,54 @@ class UtilTests(PluginTestCase):
         with open(obs[1], "U") as f:
             self.assertEqual(f.read(), EXP_MAPPING_FILE_2)
 
+    def test_split_mapping_file_open_files(self):
+        out_dir = mkdtemp()
+        self._clean_up_files.append(out_dir)
+
+        fd, fp = mkstemp(suffix='_map.txt')
+        close(fd)
+        self._clean_up_files.append(fp)
+
+        with open(fp, 'w') as f:
+            f.write(MAPPING_FILE_INTERLEAVED)
+
+        # the files are closed and reopened as the lanes are interleaved
+        obs = split_mapping_file(fp, out_dir, max_open_files=1)
+        exp = [join(out_dir, 'prefix_1_mapping_file.txt'),
+               join(out_dir, 'prefix_2_mapping_file.txt')]
+        self.assertEqual(obs, exp)
+
+        with open(obs[0], "U") as f:
+            self.assertEqual(f.read(), EXP_INTERLEAVED_1)
+
+        with open(obs[1], "U") as f:
+            self.assertEqual(f.read(), EXP_MAPPING_FILE_2)
+
+    def test_count_fasta_reads(self):
+        out_dir = mkdtemp()
+        self._clean_up_files.append(out_dir)
+        fp = join(out_dir, 'seqs.fna')
+        with open(fp, 'w') as f:
+            f.write(FASTA_SEQS)
+        gz_fp = join(out_dir, 'seqs.fna.gz')
+        with gzip.open(gz_fp, 'wb') as f:
+            f.write(FASTA_SEQS.encode('ascii'))
+        empty_fp = join(out_dir, 'empty.fna')
+        with open(empty_fp, 'w') as f:
+            f.write('')
+
+        self.assertEqual(count_fasta_reads(fp), 4)
+        self.assertEqual(count_fasta_reads(gz_fp), 4)
+        self.assertEqual(count_fasta_reads(empty_fp), 0)
+        # with the headers split across chunks
+        for chunk_size in range(1, 20):
+            self.assertEqual(count_fasta_reads(fp, chunk_size), 4)
+            self.assertEqual(count_fasta_reads(gz_fp, chunk_size), 4)
+
+        self.assertEqual(count_reads([fp, gz_fp, empty_fp]), [4, 4, 0])
+        self.assertEqual(count_reads([fp]), [4])
+        self.assertEqual(count_reads([]), [])
+
     def test_generate_demux_file(self):
         out_dir = mkdtemp()
         self._clean_up_files.append(out_dir)
@@ -124,6 +214,7 @@ class UtilTests(PluginTestCase):
         fps = [("/sl/output/seqs.fna", "preprocessed_fasta"),
                ("/sl/output/seqs.fastq", "preprocessed_fastq"),
                ("/sl/output/seqs.demux", "preprocessed_demux"),
+               ("/sl/output/seqs.demux.index.json", "log"),
                ("/sl/output/split_library_log.txt", "log")]
         exp = [ArtifactInfo('demultiplexed', 'Demultiplexed', fps)]
         self.assertEqual(obs, exp)
@@ -143,6 +234,19 @@ qwe
 DEF
 """
 
+PREP_FILE = (
+    "sample_name\trun_prefix\tprimer\tbarcode\treverselinkerprimer\n"
+    "Sample1\tprefix_1\tGTGCCAGCMGCCGCGGTAA\tGTCCGCAAGTTA\tNA\n"
+    "Sample2\tprefix_2\tGTGCCAGCMGCCGCGGTAA\tCGTAGAGCTCTC\tNA\n"
+)
+
+EXP_QIIME_MAPPING_FILE = (
+    "#SampleID\tBarcodeSequence\tLinkerPrimerSequence\t"
+    "ReverseLinkerPrimer\trun_prefix\tDescription\n"
+    "Sample1\tGTCCGCAAGTTA\tGTGCCAGCMGCCGCGGTAA\tNA\tprefix_1\tXXQIITAXX\n"
+    "Sample2\tCGTAGAGCTCTC\tGTGCCAGCMGCCGCGGTAA\tNA\tprefix_2\tXXQIITAXX\n"
+)
+
 MAPPING_FILE_SINGLE = (
     "#SampleID\tBarcodeSequence\tLinkerPrimerSequence\tDescription\n"
     "Sample1\tGTCCGCAAGTTA\tGTGCCAGCMGCCGCGGTAA\tTGP test\n"
@@ -162,11 +266,52 @@ EXP_MAPPING_FILE_1 = (
     "Sample1\tGTCCGCAAGTTA\tGTGCCAGCMGCCGCGGTAA\tprefix_1\tTGP øtest\n"
 )
 
+MAPPING_FILE_INTERLEAVED = (
+    "#SampleID\tBarcodeSequence\tLinkerPrimerSequence\trun_prefix\t"
+    "Description\n"
+    "Sample1\tGTCCGCAAGTTA\tGTGCCAGCMGCCGCGGTAA\tprefix_1\tTGP øtest\n"
+    "Sample2\tCGTAGAGCTCTC\tGTGCCAGCMGCCGCGGTAA\tprefix_2\tTGP øtest\n"
+    "Sample3\tCCTCTGAGAGCT\tGTGCCAGCMGCCGCGGTAA\tprefix_1\tTGP øtest\n"
+    "Sample4\tACGTACGTACGT\tGTGCCAGCMGCCGCGGTAA\t\tTGP øtest\n"
+)
+
+EXP_INTERLEAVED_1 = (
+    "#SampleID\tBarcodeSequence\tLinkerPrimerSequence\trun_prefix\t"
+    "Description\n"
+    "Sample1\tGTCCGCAAGTTA\tGTGCCAGCMGCCGCGGTAA\tprefix_1\tTGP øtest\n"
+    "Sample3\tCCTCTGAGAGCT\tGTGCCAGCMGCCGCGGTAA\tprefix_1\tTGP øtest\n"
+)
+
 EXP_MAPPING_FILE_2 = (
     "#SampleID\tBarcodeSequence\tLinkerPrimerSequence\trun_prefix\t"
     "Description\n"
     "Sample2\tCGTAGAGCTCTC\tGTGCCAGCMGCCGCGGTAA\tprefix_2\tTGP øtest\n"
 )
 
+WIDE_PREP_FILE = (
+    "sample_name\tplatform\trun_prefix\tprimer\tbarcode\tcenter_name\t"
+    "library_construction_protocol\n"
+    "Sample1\tIllumina\tprefix_1\tGTGCCAGCMGCCGCGGTAA\tGTCCGCAAGTTA\tANL\t"
+    "EMP\n"
+    "Sample2\tIllumina\tprefix_2\tGTGCCAGCMGCCGCGGTAA\tCGTAGAGCTCTC\tANL\t"
+    "EMP\n"
+)
+
+EXP_PASSTHROUGH_MAPPING_FILE = (
+    "#SampleID\tBarcodeSequence\tLinkerPrimerSequence\tplatform\t"
+    "run_prefix\tDescription\n"
+    "Sample1\tGTCCGCAAGTTA\tGTGCCAGCMGCCGCGGTAA\tIllumina\tprefix_1\t"
+    "XXQIITAXX\n"
+    "Sample2\tCGTAGAGCTCTC\tGTGCCAGCMGCCGCGGTAA\tIllumina\tprefix_2\t"
+    "XXQIITAXX\n"
+)
+
+FASTA_SEQS = (
+    ">read_1 length=10\nACGTACGTAC\n"
+    ">read_2 length=12\nACGTAC\nGTACGT\n"
+    ">read_3 length=0\n\n"
+    ">read_4 length=4\nACGT\n")
+
+
 if __name__ == '__main__':
     main()
@@ -8,13 +8,118 @@
 
 from os.path import join, exists
 from functools import partial
+from collections import OrderedDict
 from os import makedirs, stat
+from multiprocessing.pool import ThreadPool
 
 import pandas as pd
 from h5py import File
 from qiita_client import ArtifactInfo
 from qiita_files.demux import to_hdf5
 
+from qp_target_gene.compression import iter_chunks
+from qp_target_gene.demux_index import write_demux_index, index_fp
+from qp_target_gene.manifest import Manifest
+from qp_target_gene.metadata import (
+    get_artifact_info, get_artifact_filepaths, get_prep_file_derivative)
+
+
+# the prep information columns required by QIIME 1, and their names in the
+# mapping file
+QIIME_COLUMNS = OrderedDict([('barcode', 'BarcodeSequence'),
+                             ('primer', 'LinkerPrimerSequence'),
+                             ('reverselinkerprimer', 'ReverseLinkerPrimer')])
+
+# the columns always copied to the mapping file, as the plugin uses them
+REQUIRED_PASSTHROUGH = ('run_prefix',)
+
+# the prep information columns the split libraries commands use
+MAPPING_FILE_COLUMNS = tuple(QIIME_COLUMNS) + REQUIRED_PASSTHROUGH
+
+# the number of samples of the prep information read at a time
+MAPPING_CHUNK_SIZE = 10000
+
+# the maximum number of files open while splitting a mapping file
+MAX_OPEN_MAPPING_FILES = 256
+
+# the bytes read at a time, and the files read concurrently, while counting
+# the reads of the sequence files
+COUNT_CHUNK_SIZE = 2 ** 24
+COUNT_THREADS = 4
+
+
+def _read_header(fp):
+    """Returns the column names of a tab-separated file"""
+    with open(fp, 'rb') as f:
+        return f.readline().decode('utf-8').rstrip('\r\n').split('\t')
+
+
+def write_qiime_mapping_file(prep_fp, qiime_map, passthrough=None,
+                             chunksize=MAPPING_CHUNK_SIZE):
+    """Writes a QIIME-compliant mapping file from a prep file
+
+    Parameters
+    ----------
+    prep_fp : str
+        The prep information filepath
+    qiime_map : str
+        The output mapping file filepath
+    passthrough : list of str, optional
+        The prep information columns copied to the mapping file, besides the
+        ones QIIME needs. Defaults to all of them
+    chunksize : int, optional
+        The number of samples read at a time
+
+    Notes
+    -----
+    Only the columns written are read, and the prep information is read in
+    chunks of `chunksize` samples, so the memory used doesn't depend on
+    the size of the prep information. The values are read as categories, as
+    most columns take a few different values.
+    """
+    header = _read_header(prep_fp)
+    if 'sample_name' not in header:
+        raise ValueError("The prep information file doesn't have a "
+                         "sample_name column")
+
+    # the column names are given to pandas as read from the header, as it
+    # doesn't accept names of different types (str and unicode in python 2)
+    sample_name = header[header.index('sample_name')]
+    # the QIIME 1 required columns go first, in this order, followed by the
+    # other columns in the prep information order
+    required = [header[header.index(c)] for c in QIIME_COLUMNS
+                if c in header]
+    others = [c for c in header if c != sample_name and c not in required]
+    if passthrough is not None:
+        others = [c for c in others
+                  if c in passthrough or c in REQUIRED_PASSTHROUGH]
+    columns = required + others
+
+    dtype = {c: 'category' for c in columns}
+    dtype[sample_name] = str
+    chunks = pd.read_csv(prep_fp, sep='\t', usecols=[sample_name] + columns,
+                         dtype=dtype, na_values=[], keep_default_na=False,
+                         encoding='utf-8', chunksize=chunksize)
+
+    mode = 'w'
+    for df in chunks:
+        df.set_index(sample_name, inplace=True)
+        df = df[columns].rename(columns=QIIME_COLUMNS)
+        # by design the prep info file doesn't have a Description column so
+        # we can fill without checking
+        df['Description'] = 'XXQIITAXX'
+        df.index.name = '#SampleID'
+        df.to_csv(qiime_map, sep='\t', mode=mode, header=mode == 'w',
+                  encoding='utf-8')
+        mode = 'a'
+
+    if mode == 'w':
+        # a prep information without samples
+        with open(qiime_map, 'wb') as f:
+            f.write(('\t'.join(
+                ['#SampleID'] + [QIIME_COLUMNS.get(c, c) for c in columns] +
+                ['Description']) + '\n').encode('utf-8'))
+
 
 def get_artifact_information(qclient, artifact_id, out_dir):
     """Retrieves the artifact information for running split libraries
@@ -35,58 +140,27 @@ def get_artifact_information(qclient, artifact_id, out_dir):
         The artifact Qiime-compliant mapping file path
         The artifact type
     """
-    # Get the artifact filepath information
-    artifact_info = qclient.get("/qiita_db/artifacts/%s/" % artifact_id)
-    fps = {k: [vv['filepath'] for vv in v]
-           for k, v in artifact_info['files'].items()}
+    artifact_info = get_artifact_info(qclient, artifact_id)
     # Get the artifact type
     artifact_type = artifact_info['type']
-    # Get the artifact metadata
-    prep_info = qclient.get('/qiita_db/prep_template/%s/'
-                            % artifact_info['prep_information'][0])
-
-    df = pd.read_csv(prep_info['prep-file'], sep='\t', dtype='str',
-                     na_values=[], keep_default_na=False)
-    df.set_index('sample_name', inplace=True)
-
-    # rename columns to match QIIME 1 required columns
-    columns = df.columns.values.tolist()
-    sort_columns = []
-    if 'barcode' in columns:
-        df.rename(columns={'barcode': 'BarcodeSequence'}, inplace=True)
-        sort_columns.append('BarcodeSequence')
-    if 'primer' in columns:
-        df.rename(columns={'primer': 'LinkerPrimerSequence'}, inplace=True)
-        sort_columns.append('LinkerPrimerSequence')
-    if 'reverselinkerprimer' in columns:
-        df.rename(columns={'reverselinkerprimer': 'ReverseLinkerPrimer'},
-                  inplace=True)
-        sort_columns.append('ReverseLinkerPrimer')
-
-    # by design the prep info file doesn't have a Description column so we can
-    # fill without checking
-    df['Description'] = 'XXQIITAXX'
-
-    # sorting columns to be a valid "classic" QIIME1 mapping file
-    columns = df.columns.values.tolist()
-    if 'BarcodeSequence' in columns:
-        columns.remove('BarcodeSequence')
-    if 'LinkerPrimerSequence' in columns:
-        columns.remove('LinkerPrimerSequence')
-    columns.remove('Description')
-    sort_columns.extend(columns)
-    sort_columns.append('Description')
-
-    df = df[sort_columns]
-
+    # Get the artifact metadata; the mapping file is reused from recent jobs
+    # on the same prep information, and only has the columns split libraries
+    # uses, which are part of its name so changing them generates it again
     qiime_map = join(out_dir, 'qiime-mapping-file.txt')
-    df.index.name = '#SampleID'
-    df.to_csv(qiime_map, sep='\t')
+    get_prep_file_derivative(
+        qclient, artifact_info['prep_information'][0],
+        'qiime-mapping-file:%s' % ','.join(MAPPING_FILE_COLUMNS),
+        partial(write_qiime_mapping_file, passthrough=MAPPING_FILE_COLUMNS),
+        qiime_map)
+    # Get the artifact filepath information; the filepaths are requested
+    # last, as staged jobs wait for the local copies of the files
+    fps = get_artifact_filepaths(qclient, artifact_id)
 
     return fps, qiime_map, artifact_type
 
 
-def split_mapping_file(mapping_file, out_dir):
+def split_mapping_file(mapping_file, out_dir,
+                       max_open_files=MAX_OPEN_MAPPING_FILES):
     """Splits a QIIME-compliant mapping file by run_prefix
 
     Parameters
@@ -95,29 +169,115 @@ def split_mapping_file(mapping_file, out_dir):
         The mapping file filepath
     out_dir : str
         The path to the output directory
+    max_open_files : int, optional
+        The maximum number of output files open at the same time
 
     Returns
     -------
     list of str
         The paths to the splitted mapping files
+
+    Notes
+    -----
+    The mapping file is read once, line by line, copying each sample to the
+    file of its run_prefix, so it is never loaded in memory.
     """
-    mf = pd.read_csv(mapping_file, delimiter='\t', dtype=str, encoding='utf-8')
-    mf.set_index('#SampleID', inplace=True)
+    header = _read_header(mapping_file)
+    if 'run_prefix' not in header:
+        return [mapping_file]
+    prefix_idx = header.index('run_prefix')
 
+    if not exists(out_dir):
+        makedirs(out_dir)
     path_builder = partial(join, out_dir)
-    if 'run_prefix' in mf:
-        if not exists(out_dir):
-            makedirs(out_dir)
-        output_fps = []
-        for prefix, df in mf.groupby('run_prefix'):
-            out_fp = path_builder('%s_mapping_file.txt' % prefix)
-            output_fps.append(out_fp)
-            df.to_csv(out_fp, index_label='#SampleID', sep='\t',
-                      encoding='utf-8')
-    else:
-        output_fps = [mapping_file]
 
-    return output_fps
+    output_fps = {}
+    open_fhs = {}
+    try:
+        with open(mapping_file, 'rb') as f:
+            header_line = f.readline().rstrip(b'\r\n') + b'\n'
+            for line in f:
+                line = line.rstrip(b'\r\n')
+                if not line:
+                    continue
+                values = line.split(b'\t')
+                prefix = (values[prefix_idx].decode('utf-8')
+                          if len(values) > prefix_idx else '')
+                # the samples without run_prefix are not in any lane
+                if not prefix:
+                    continue
+
+                fh = open_fhs.get(prefix)
+                if fh is None:
+                    if len(open_fhs) >= max_open_files:
+                        for open_fh in open_fhs.values():
+                            open_fh.close()
+                        open_fhs.clear()
+                    if prefix in output_fps:
+                        fh = open(output_fps[prefix], 'ab')
+                    else:
+                        output_fps[prefix] = path_builder(
+                            '%s_mapping_file.txt' % prefix)
+                        fh = open(output_fps[prefix], 'wb')
+                        fh.write(header_line)
+                    open_fhs[prefix] = fh
+                fh.write(line + b'\n')
+    finally:
+        for fh in open_fhs.values():
+            fh.close()
+
+    return [output_fps[prefix] for prefix in sorted(output_fps)]
+
+
+def count_fasta_reads(fp, chunk_size=COUNT_CHUNK_SIZE):
+    """Counts the reads of a fasta or qual file
+
+    Parameters
+    ----------
+    fp : str
+        The filepath, optionally compressed
+    chunk_size : int, optional
+        The number of bytes read at a time
+
+    Returns
+    -------
+    int
+        The number of reads, i.e. the number of lines starting with '>'
+    """
+    count = 0
+    previous = b'\n'
+    for chunk in iter_chunks(fp, chunk_size):
+        count += chunk.count(b'\n>')
+        # the headers at the start of the file, or of a chunk after a
+        # newline, are not preceded by a newline in the chunk
+        if previous == b'\n' and chunk[:1] == b'>':
+            count += 1
+        previous = chunk[-1:]
+    return count
+
+
+def count_reads(fps, threads=COUNT_THREADS):
+    """Counts the reads of a set of fasta or qual files
+
+    Parameters
+    ----------
+    fps : list of str
+        The filepaths, optionally compressed
+    threads : int, optional
+        The number of files read at the same time
+
+    Returns
+    -------
+    list of int
+        The number of reads of each file
+    """
+    if len(fps) < 2:
+        return [count_fasta_reads(fp) for fp in fps]
+    pool = ThreadPool(min(len(fps), threads))
+    try:
+        return pool.map(count_fasta_reads, fps)
+    finally:
+        pool.close()
 
 
 def generate_demux_file(sl_out):
@@ -149,6 +309,10 @@ def generate_demux_file(sl_out):
     demux_fp = join(sl_out, 'seqs.demux')
     with File(demux_fp, "w") as f:
         to_hdf5(fastq_fp, f)
+    # the index lets the commands using the demux file read any subset of
+    # its samples without going through the rest
+    with Manifest(sl_out) as manifest:
+        write_demux_index(demux_fp, manifest)
     return demux_fp
 
 
@@ -173,5 +337,6 @@ def generate_artifact_info(sl_out):
     filepaths = [(path_builder('seqs.fna'), 'preprocessed_fasta'),
                  (path_builder('seqs.fastq'), 'preprocessed_fastq'),
                  (path_builder('seqs.demux'), 'preprocessed_demux'),
+                 (index_fp(path_builder('seqs.demux')), 'log'),
                  (path_builder('split_library_log.txt'), 'log')]
     return [ArtifactInfo('demultiplexed', 'Demultiplexed', filepaths)]
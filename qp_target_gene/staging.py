@@ -0,0 +1,348 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from os.path import (join, exists, isdir, basename, dirname, relpath,
+                     getsize, getmtime)
+from os import makedirs, rename, listdir, utime, walk
+from time import time
+from threading import Thread, Event
+from shutil import copy2, copytree, rmtree
+from functools import wraps
+from multiprocessing.pool import ThreadPool
+
+from qiita_client import ArtifactInfo
+
+from qp_target_gene.config import get_config_value
+from qp_target_gene.manifest import MANIFEST_FILENAME
+from qp_target_gene.metadata import get_artifact_filepaths
+from qp_target_gene.timing import TIMINGS_FILENAME
+
+
+# the directory of the job where the input files are copied
+STAGED_INPUTS_DIR = 'staged'
+
+# the files of a job published to its output directory even if it fails
+DIAGNOSTIC_FILES = ('logs', TIMINGS_FILENAME)
+
+# the file of the job directory touched while the job runs, and the seconds
+# between touches
+HEARTBEAT_FILENAME = '.heartbeat'
+HEARTBEAT_INTERVAL = 60
+
+# the stage of the job running in this process, if any
+_STAGE = None
+
+
+def _makedirs(path):
+    """Creates a directory, if another thread didn't create it first"""
+    try:
+        makedirs(path)
+    except OSError:
+        if not isdir(path):
+            raise
+
+
+def copy_atomically(src, dst):
+    """Copies a file or a directory, renaming it once complete
+
+    Parameters
+    ----------
+    src : str
+        The source filepath
+    dst : str
+        The destination filepath
+
+    Returns
+    -------
+    str
+        The destination filepath
+
+    Notes
+    -----
+    The copy is written next to the destination and renamed, so an
+    interrupted copy never leaves a partial file at the destination. Files
+    are not copied again if the destination has the same size and
+    modification time as the source.
+    """
+    if isdir(src):
+        tmp = '%s.tmp' % dst
+        rmtree(tmp, ignore_errors=True)
+        copytree(src, tmp)
+        if exists(dst):
+            rmtree(dst)
+    else:
+        if exists(dst) and getsize(dst) == getsize(src) and \
+                int(getmtime(dst)) == int(getmtime(src)):
+            return dst
+        _makedirs(dirname(dst))
+        tmp = '%s.tmp' % dst
+        copy2(src, tmp)
+    rename(tmp, dst)
+    return dst
+
+
+class Stage(object):
+    """Runs a job in a node-local directory
+
+    Parameters
+    ----------
+    job_dir : str
+        The node-local directory of the job
+    threads : int
+        The number of files copied at the same time
+
+    Notes
+    -----
+    The input files are copied in background threads, so the copies run
+    while the job collects the rest of its information; a job only waits
+    for a file when it asks for its local copy. Another thread touches the
+    HEARTBEAT_FILENAME file of the job directory until the stage is closed,
+    so the directory of a running job is never seen as abandoned.
+    """
+    def __init__(self, job_dir, threads):
+        self.job_dir = job_dir
+        _makedirs(job_dir)
+        self._pool = ThreadPool(max(threads, 1))
+        self._copies = {}
+        self._closed = Event()
+        self._heartbeat = Thread(target=self._beat)
+        self._heartbeat.daemon = True
+        self._heartbeat.start()
+
+    def _beat(self):
+        fp = join(self.job_dir, HEARTBEAT_FILENAME)
+        while True:
+            with open(fp, 'a'):
+                utime(fp, None)
+            if self._closed.wait(HEARTBEAT_INTERVAL):
+                break
+
+    def prefetch(self, filepaths):
+        """Starts copying files to the job directory
+
+        Parameters
+        ----------
+        filepaths : dict of {str: list of str}
+            The filepaths keyed by type, as returned by
+            `qp_target_gene.metadata.get_artifact_filepaths`
+        """
+        for fp_type, fps in filepaths.items():
+            for fp in fps:
+                if fp in self._copies or not exists(fp):
+                    continue
+                dst = join(self.job_dir, STAGED_INPUTS_DIR, fp_type,
+                           basename(fp))
+                self._copies[fp] = self._pool.apply_async(
+                    copy_atomically, (fp, dst))
+
+    def local_filepath(self, fp):
+        """Returns the local copy of a file, waiting for it to be copied
+
+        Parameters
+        ----------
+        fp : str
+            The filepath
+
+        Returns
+        -------
+        str
+            The filepath of the local copy, or fp if it was not prefetched
+        """
+        if fp not in self._copies:
+            return fp
+        return self._copies[fp].get()
+
+    def publish(self, fps, out_dir):
+        """Copies files of the job directory to the output directory
+
+        Parameters
+        ----------
+        fps : list of str
+            The filepaths, in the job directory
+        out_dir : str
+            The job output directory
+
+        Returns
+        -------
+        dict of {str: str}
+            The published filepath of each file. Files outside the job
+            directory, or that don't exist, are not published
+        """
+        copies = {}
+        for fp in fps:
+            rel = relpath(fp, self.job_dir)
+            if rel.startswith('..') or not exists(fp):
+                continue
+            copies[fp] = self._pool.apply_async(
+                copy_atomically, (fp, join(out_dir, rel)))
+        return {fp: result.get() for fp, result in copies.items()}
+
+    def publish_artifacts(self, artifacts_info, out_dir):
+        """Publishes the files of the artifacts generated by the job
+
+        Parameters
+        ----------
+        artifacts_info : list of ArtifactInfo
+            The artifacts generated by the job
+        out_dir : str
+            The job output directory
+
+        Returns
+        -------
+        list of ArtifactInfo
+            The artifacts, with their published filepaths
+
+        Notes
+        -----
+        The manifests next to the artifact files are published as well.
+        """
+        fps = [fp for ainfo in artifacts_info for fp, _ in ainfo.files]
+        manifests = set(join(dirname(fp), MANIFEST_FILENAME) for fp in fps)
+        published = self.publish(fps + sorted(manifests), out_dir)
+        return [ArtifactInfo(ainfo.output_name, ainfo.artifact_type,
+                             [(published.get(fp, fp), fp_type)
+                              for fp, fp_type in ainfo.files])
+                for ainfo in artifacts_info]
+
+    def close(self):
+        """Waits for the pending copies and stops the background threads"""
+        self._closed.set()
+        self._heartbeat.join()
+        self._pool.close()
+        self._pool.join()
+
+
+def local_filepath(fp):
+    """Returns the local copy of a file of the input artifact, if staged
+
+    Parameters
+    ----------
+    fp : str
+        The filepath
+
+    Returns
+    -------
+    str
+        The filepath of the local copy, or fp if the job is not staged or
+        the file was not prefetched
+    """
+    if _STAGE is None:
+        return fp
+    return _STAGE.local_filepath(fp)
+
+
+def _last_modified(path):
+    """Returns the newest modification time of a directory and its files"""
+    mtimes = [getmtime(path)]
+    for root, dirs, fnames in walk(path):
+        mtimes.extend(getmtime(join(root, f)) for f in dirs + fnames)
+    return max(mtimes)
+
+
+def sweep_scratch_dir(scratch_dir, max_age):
+    """Removes the job directories abandoned in the scratch directory
+
+    Parameters
+    ----------
+    scratch_dir : str
+        The scratch directory
+    max_age : float
+        The hours since the last modification of any of its files after
+        which a job directory is removed
+
+    Returns
+    -------
+    list of str
+        The removed job directories
+
+    Notes
+    -----
+    The jobs remove their directory once they succeed, so only the
+    directories of failed jobs, kept so re-running them resumes them, and
+    of jobs killed while running (e.g. by the queue system) are left behind.
+    The running jobs touch their heartbeat file, so their directories are
+    never removed.
+    """
+    if not isdir(scratch_dir):
+        return []
+    oldest = time() - max_age * 3600
+    removed = []
+    for name in sorted(listdir(scratch_dir)):
+        job_dir = join(scratch_dir, name)
+        try:
+            if not isdir(job_dir) or _last_modified(job_dir) >= oldest:
+                continue
+        except OSError:
+            # removed by another job
+            continue
+        rmtree(job_dir, ignore_errors=True)
+        removed.append(job_dir)
+    return removed
+
+
+def staged_command(func):
+    """Decorates a command so it runs in a node-local scratch directory
+
+    Parameters
+    ----------
+    func : function
+        The command
+
+    Returns
+    -------
+    function
+        The decorated command
+
+    Notes
+    -----
+    Staging is only used if SCRATCH_DIR is set in the plugin configuration
+    file. The files of the input artifact are prefetched to the scratch
+    directory and the command runs in it; once the command succeeds, the
+    files of the generated artifacts are published to the output directory
+    and the job directory, with the intermediate files, is removed. The
+    logs and timings are published even if the command fails, and the job
+    directory of a failed job is kept, so re-running the job in the same
+    node resumes it from its completed stages. The job directories unused
+    for MAX_AGE hours are removed before the job starts.
+    """
+    @wraps(func)
+    def wrapper(qclient, job_id, parameters, out_dir):
+        global _STAGE
+
+        scratch_dir = get_config_value('staging', 'SCRATCH_DIR')
+        if not scratch_dir:
+            return func(qclient, job_id, parameters, out_dir)
+
+        threads = int(get_config_value('staging', 'COPY_THREADS', '4'))
+        sweep_scratch_dir(
+            scratch_dir, float(get_config_value('staging', 'MAX_AGE', '168')))
+        stage = Stage(join(scratch_dir, str(job_id)), threads)
+        success = False
+        try:
+            stage.prefetch(get_artifact_filepaths(
+                qclient, parameters['input_data']))
+            _STAGE = stage
+            success, artifacts_info, error_msg = func(
+                qclient, job_id, parameters, stage.job_dir)
+            if success:
+                artifacts_info = stage.publish_artifacts(
+                    artifacts_info, out_dir)
+        finally:
+            _STAGE = None
+            try:
+                stage.publish([join(stage.job_dir, fp)
+                               for fp in DIAGNOSTIC_FILES], out_dir)
+            except (OSError, IOError):
+                # the diagnostics are a best effort, they don't fail the job
+                pass
+            stage.close()
+        if success:
+            rmtree(stage.job_dir, ignore_errors=True)
+
+        return success, artifacts_info, error_msg
+    return wrapper
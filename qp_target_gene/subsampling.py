@@ -0,0 +1,272 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from os.path import join
+from functools import partial
+from zlib import crc32
+
+import numpy as np
+from h5py import File
+
+from qiita_client import ArtifactInfo
+from qiita_files.format.fasta import format_fasta_record
+from qiita_files.format.fastq import format_fastq_record
+
+from qp_target_gene.cache import cached_command
+from qp_target_gene.manifest import Manifest, write_manifests
+from qp_target_gene.metadata import get_artifact_filepaths
+from qp_target_gene.progress import ProgressReporter
+from qp_target_gene.staging import staged_command
+from qp_target_gene.timing import (
+    TIMINGS_FILENAME, Timings, count_demux_reads)
+from qp_target_gene.demux_index import DemuxIndex, CHUNK_SIZE, index_fp
+from qp_target_gene.trimming import ID_FMT
+from qp_target_gene.split_libraries.util import generate_demux_file
+
+
+SUBSAMPLING_METHODS = ('hypergeometric', 'reservoir')
+
+
+def sample_random_state(seed, sample):
+    """Returns the random number generator of a sample
+
+    Parameters
+    ----------
+    seed : int
+        The subsampling seed
+    sample : str
+        The sample name
+
+    Returns
+    -------
+    np.random.RandomState
+        The random number generator
+
+    Notes
+    -----
+    Each sample gets its own generator, so the reads kept from a sample
+    don't depend on the other samples in the file.
+    """
+    return np.random.RandomState(
+        (int(seed) + crc32(sample.encode('utf-8'))) & 0xFFFFFFFF)
+
+
+def hypergeometric_masks(rng, count, depth, chunk_size=CHUNK_SIZE):
+    """Yields which reads of a sample are kept, a chunk at a time
+
+    Parameters
+    ----------
+    rng : np.random.RandomState
+        The random number generator
+    count : int
+        The number of reads of the sample
+    depth : int
+        The number of reads kept
+    chunk_size : int, optional
+        The number of reads of each chunk
+
+    Returns
+    -------
+    generator of np.array of bool
+        Whether each read of the chunk is kept
+
+    Notes
+    -----
+    The number of reads kept from each chunk is drawn from the
+    hypergeometric distribution of the reads still to keep among the reads
+    left, so exactly `depth` reads are kept, all the subsets being equally
+    likely, without holding more than a chunk in memory.
+    """
+    remaining = count
+    needed = min(depth, count)
+    for start in range(0, count, chunk_size):
+        size = min(chunk_size, count - start)
+        if remaining > size:
+            kept = rng.hypergeometric(size, remaining - size, needed) \
+                if needed else 0
+        else:
+            kept = needed
+        mask = np.zeros(size, dtype=bool)
+        mask[rng.choice(size, kept, replace=False)] = True
+        remaining -= size
+        needed -= kept
+        yield mask
+
+
+def reservoir_sample(rng, reads, depth):
+    """Keeps a uniform random subset of the reads of a sample
+
+    Parameters
+    ----------
+    rng : np.random.RandomState
+        The random number generator
+    reads : iterable
+        The reads of the sample
+    depth : int
+        The number of reads kept
+
+    Returns
+    -------
+    list
+        The reads kept, in their original order
+
+    Notes
+    -----
+    The number of reads doesn't need to be known beforehand, and only the
+    reads kept are held in memory.
+    """
+    reservoir = []
+    for i, read in enumerate(reads):
+        if i < depth:
+            reservoir.append((i, read))
+        else:
+            j = rng.randint(0, i + 1)
+            if j < depth:
+                reservoir[j] = (i, read)
+    return [read for _, read in sorted(reservoir, key=lambda r: r[0])]
+
+
+def _subsample(fh, index, sample, depth, method, rng):
+    """Returns the reads kept from a sample, in their original order"""
+    reads = index.fetch(fh, samples=[sample])
+    count = index[sample]['count']
+    if count <= depth:
+        # nothing to subsample
+        return reads
+    if method == 'reservoir':
+        return iter(reservoir_sample(rng, reads, depth))
+    return _masked(reads, hypergeometric_masks(rng, count, depth))
+
+
+def _masked(reads, masks):
+    """Yields the reads whose value in the masks is True"""
+    for mask in masks:
+        for keep in mask:
+            read = next(reads)
+            if keep:
+                yield read
+
+
+def generate_subsampling(filepaths, out_dir, parameters):
+    """Subsamples the reads of each sample of the filepaths
+
+    Parameters
+    ----------
+    filepaths : list of str
+        The demux filepaths
+    out_dir : str
+        The job output directory
+    parameters : dict
+        The command's parameters, keyed by parameter name
+
+    Returns
+    -------
+    int
+        The number of reads kept
+
+    Raises
+    ------
+    ValueError
+        If the method is not known or the depth is not positive
+
+    Notes
+    -----
+    The samples with fewer reads than the depth are kept whole.
+    """
+    depth = int(parameters['depth'])
+    method = parameters['method']
+    seed = int(parameters['seed'])
+    if method not in SUBSAMPLING_METHODS:
+        raise ValueError("Unknown subsampling method: %s. Please, choose "
+                         "from %s" % (method, ', '.join(SUBSAMPLING_METHODS)))
+    if depth < 1:
+        raise ValueError("The depth should be a positive number: %d" % depth)
+
+    pd = partial(join, out_dir)
+    kept = 0
+    with Manifest(out_dir) as manifest, \
+            manifest.open(pd('seqs.fna')) as ffh, \
+            manifest.open(pd('seqs.fastq')) as qfh:
+        for f in filepaths:
+            index = DemuxIndex.load(f)
+            with File(f, 'r') as fh:
+                for sample in index.names:
+                    rng = sample_random_state(seed, sample)
+                    for samp, idx, seq, qual, bc_ori, bc_cor, bc_err in \
+                            _subsample(fh, index, sample, depth, method, rng):
+                        seq_id = ID_FMT % {b'sample': samp, b'idx': idx,
+                                           b'bc_ori': bc_ori,
+                                           b'bc_cor': bc_cor,
+                                           b'bc_diff': bc_err}
+                        ffh.write(format_fasta_record(seq_id, seq, qual))
+                        qfh.write(format_fastq_record(seq_id, seq, qual))
+                        kept += 1
+    return kept
+
+
+@cached_command('subsampling')
+@staged_command
+def subsampling(qclient, job_id, parameters, out_dir):
+    """Run subsampling over the given parameters
+
+    Parameters
+    ----------
+    qclient : tgp.qiita_client.QiitaClient
+        The Qiita server client
+    job_id : str
+        The job id
+    parameters : dict
+        The parameter values to run the subsampling
+    out_dir : str
+        The path to the job's output directory
+
+    Returns
+    -------
+    bool, list, str
+        The results of the job.
+            bool: if the job was successful
+            list: artifacts created, can be None
+            str: error message, "" if no error was generated
+    """
+    with ProgressReporter(qclient, job_id) as progress, \
+            Timings(join(out_dir, TIMINGS_FILENAME)) as timings:
+        progress.update("Step 1 of 3: Collecting information")
+        timings.start("Collecting information")
+        fps = get_artifact_filepaths(qclient, parameters['input_data'])
+        if 'preprocessed_demux' not in fps:
+            error_msg = "Artifact doesn't contain a preprocessed demux"
+            return False, None, error_msg
+
+        progress.update("Step 2 of 3: Executing Subsampling")
+        timings.start("Subsampling")
+        timings.add_reads(count_demux_reads(fps['preprocessed_demux'][0]))
+        try:
+            kept = generate_subsampling(
+                fps['preprocessed_demux'], out_dir, parameters)
+        except ValueError as e:
+            return False, None, str(e)
+        if not kept:
+            return False, None, "No sequences were kept"
+
+        progress.update("Step 3 of 3: Generating new Demuxed")
+        timings.start("Generating demux file")
+        generate_demux_file(out_dir)
+        timings.add_reads(kept)
+
+        pb = partial(join, out_dir)
+        ainfo = [
+            ArtifactInfo(
+                'Subsampled Demultiplexed', 'Demultiplexed',
+                [(pb('seqs.fna'), 'preprocessed_fasta'),
+                 (pb('seqs.fastq'), 'preprocessed_fastq'),
+                 (pb('seqs.demux'), 'preprocessed_demux'),
+                 (index_fp(pb('seqs.demux')), 'log')])]
+        write_manifests(ainfo)
+        timings.attach(ainfo)
+
+        return True, ainfo, ""
@@ -1,40 +1,46 @@
 # We need to gz all the preprocessed_fasta/preprocessed_fastq from the
-# Demultiplexed artifacts. This needs to be ran on the main Qiita install
-from os.path import getsize
-
+# Demultiplexed artifacts. This needs to be ran on the main Qiita install,
+# with this plugin installed in the same environment.
+#
+# The files are compressed concurrently and the database is updated in
+# batches. If the script is interrupted, running it again resumes the
+# migration from the journal, without compressing again the files already
+# compressed.
 from qiita_db.study import Study
-from qiita_db.processing_job import _system_call as system_call
 from qiita_db.sql_connection import TRN
-from qiita_db.util import compute_checksum
-
 
-artifacts = [a for s in Study.iter() for a in
-             s.artifacts(artifact_type='Demultiplexed')]
+from qp_target_gene.migration import migrate_to_gz
 
-len_artifacts = len(artifacts)
-print("===> We are going to process %d artifacts" % len_artifacts)
 
-sql = """UPDATE qiita.filepath SET (filepath, checksum, fp_size) = (%s, %s, %s)
-         WHERE filepath_id = %s"""
-command = "pigz -p20 %s"
+class QiitaFilepathStore(object):
+    """The preprocessed files of the Demultiplexed artifacts"""
+    sql = """UPDATE qiita.filepath
+             SET (filepath, checksum, fp_size) = (%s, %s, %s)
+             WHERE filepath_id = %s"""
 
-for i, a in enumerate(artifacts):
-    if (i+1) % 10:
-        print("Processing artifact: %d/%d" % ((i+1), len_artifacts))
+    def pending(self):
+        artifacts = [a for s in Study.iter() for a in
+                     s.artifacts(artifact_type='Demultiplexed')]
+        print("===> We are going to process %d artifacts" % len(artifacts))
+        for a in artifacts:
+            for fp in a.filepaths:
+                if fp['fp_type'] in ('preprocessed_fastq',
+                                     'preprocessed_fasta') and \
+                        not fp['fp'].endswith('.gz'):
+                    yield fp['fp_id'], fp['fp']
 
-    fps_to_gz = [fp for fp in a.filepaths if fp['fp_type'] in (
-        'preprocessed_fastq', 'preprocessed_fasta')
-        and not fp['fp'].endswith('.gz')]
-
-    for fp in fps_to_gz:
+    def update(self, updates):
         with TRN:
-            pout, perr, rv = system_call(command % fp['fp'])
-            if rv != 0:
-                raise ValueError(
-                    "Error in artifact: %d, fid: %d %s -- %s" % (
-                        a.id, fp['fp_id'], pout, perr))
-            new_fp = '%s.gz' % fp['fp']
-            checksum = compute_checksum(new_fp)
-            size = getsize(new_fp)
-            TRN.add(sql, [new_fp, checksum, size, fp['fp_id']])
+            for fp_id, fp, checksum, size in updates:
+                TRN.add(self.sql, [fp, checksum, size, fp_id])
             TRN.execute()
+
+
+def report(msg):
+    print("Processing: %s" % msg)
+
+
+stats = migrate_to_gz(QiitaFilepathStore(), '052020_gz-files.journal',
+                      threads=20, batch_size=100, progress=report)
+print("===> Done: %(compressed)d files compressed, %(reused)d resumed, "
+      "%(committed)d committed" % stats)
@@ -0,0 +1,252 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from os.path import join, exists, isdir, abspath, dirname
+from os import stat, makedirs, rename, mkdir, chmod, listdir
+from shutil import rmtree
+from hashlib import md5
+from tempfile import mkdtemp, gettempdir
+
+import numpy as np
+
+
+# indexes already opened by this process, keyed by index directory
+_INDEXES = {}
+
+
+def _encode(text):
+    """Encodes a string as UTF-8, unless it is already a byte string"""
+    if isinstance(text, bytes):
+        return text
+    return text.encode('utf-8')
+
+
+def _make_shared_dir(path):
+    """Creates a directory, and its parents, where every user can write
+
+    Parameters
+    ----------
+    path : str
+        The directory path
+
+    Notes
+    -----
+    The directories are sticky, as the system's temporary directory, so the
+    indexes built by a user can't be removed by the others.
+    """
+    if exists(path):
+        return
+    _make_shared_dir(dirname(path))
+    try:
+        mkdir(path)
+        chmod(path, 0o1777)
+    except OSError:
+        # another job created it in the mean time
+        if not isdir(path):
+            raise
+
+
+def parse_taxonomy(taxonomy_fp):
+    """Parses a reference taxonomy file
+
+    Parameters
+    ----------
+    taxonomy_fp : str
+        The reference taxonomy filepath, i.e. `reference-tax`
+
+    Yields
+    ------
+    str, str
+        The OTU id and its lineage
+    """
+    with open(taxonomy_fp) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            otu_id, lineage = line.split('\t', 1)
+            yield otu_id, lineage.strip()
+
+
+def split_lineage(lineage):
+    """Splits a lineage string by rank
+
+    Parameters
+    ----------
+    lineage : str
+        The lineage, with ranks separated by ';'
+
+    Returns
+    -------
+    list of str
+        The lineage ranks
+    """
+    return [r.strip() for r in lineage.split(';')]
+
+
+def build_taxonomy_index(taxonomy_fp, index_dir):
+    """Builds the memory-mappable index of a reference taxonomy
+
+    Parameters
+    ----------
+    taxonomy_fp : str
+        The reference taxonomy filepath
+    index_dir : str
+        The directory where the index is written
+
+    Notes
+    -----
+    The index is formed by 4 numpy arrays:
+    - ids.npy: the sorted OTU ids, as fixed width byte strings
+    - lineage_idx.npy: the lineage of each OTU id, as an index into the
+      unique lineages
+    - offsets.npy: the start of each unique lineage in lineages.npy
+    - lineages.npy: the unique lineages, concatenated
+    Lineages are interned, so a lineage shared by several OTUs is only
+    stored once.
+    """
+    ids = []
+    lineage_idx = []
+    interned = {}
+    for otu_id, lineage in parse_taxonomy(taxonomy_fp):
+        ids.append(_encode(otu_id))
+        lineage_idx.append(interned.setdefault(lineage, len(interned)))
+
+    lineages = [None] * len(interned)
+    for lineage, i in interned.items():
+        lineages[i] = _encode(lineage)
+    offsets = np.zeros(len(lineages) + 1, dtype=np.int64)
+    np.cumsum([len(x) for x in lineages], out=offsets[1:])
+
+    ids = np.array(ids, dtype='|S%d' % max([len(i) for i in ids] or [1]))
+    order = np.argsort(ids, kind='mergesort')
+
+    if not exists(index_dir):
+        makedirs(index_dir)
+    np.save(join(index_dir, 'ids.npy'), ids[order])
+    np.save(join(index_dir, 'lineage_idx.npy'),
+            np.array(lineage_idx, dtype=np.int32)[order])
+    np.save(join(index_dir, 'offsets.npy'), offsets)
+    np.save(join(index_dir, 'lineages.npy'),
+            np.frombuffer(b''.join(lineages), dtype=np.uint8))
+
+
+class TaxonomyIndex(object):
+    """Read-only, memory-mapped lookup of OTU lineages
+
+    Parameters
+    ----------
+    index_dir : str
+        The directory containing an index written by `build_taxonomy_index`
+    """
+    def __init__(self, index_dir):
+        def load(name):
+            fp = join(index_dir, name)
+            try:
+                return np.load(fp, mmap_mode='r')
+            except ValueError:
+                # empty arrays can't be memory-mapped
+                return np.load(fp)
+
+        self._ids = load('ids.npy')
+        self._lineage_idx = load('lineage_idx.npy')
+        self._offsets = load('offsets.npy')
+        self._lineages = load('lineages.npy')
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __contains__(self, otu_id):
+        return self._find(otu_id) is not None
+
+    def __getitem__(self, otu_id):
+        lineage = self.get(otu_id)
+        if lineage is None:
+            raise KeyError(otu_id)
+        return lineage
+
+    def _find(self, otu_id):
+        key = _encode(otu_id)
+        pos = np.searchsorted(self._ids, key)
+        if pos < len(self._ids) and self._ids[pos] == key:
+            return pos
+        return None
+
+    def get(self, otu_id, default=None):
+        """Returns the lineage of an OTU
+
+        Parameters
+        ----------
+        otu_id : str
+            The OTU id
+        default : object, optional
+            The value to return if the OTU is not in the index
+
+        Returns
+        -------
+        list of str
+            The lineage ranks
+        """
+        pos = self._find(otu_id)
+        if pos is None:
+            return default
+        i = self._lineage_idx[pos]
+        lineage = self._lineages[self._offsets[i]:self._offsets[i + 1]]
+        return split_lineage(lineage.tobytes().decode('utf-8'))
+
+
+def get_taxonomy_index(taxonomy_fp, cache_dir=None):
+    """Returns the index of a reference taxonomy, building it if needed
+
+    Parameters
+    ----------
+    taxonomy_fp : str
+        The reference taxonomy filepath
+    cache_dir : str, optional
+        The directory where the indexes are stored. Defaults to a
+        `qp-target-gene` folder in the system's temporary directory, so
+        jobs running in the same node share them
+
+    Returns
+    -------
+    TaxonomyIndex
+        The taxonomy index
+    """
+    if cache_dir is None:
+        cache_dir = join(gettempdir(), 'qp-target-gene', 'taxonomy')
+
+    # the reference is identified by its path, size and modification time,
+    # so an updated reference gets a new index
+    st = stat(taxonomy_fp)
+    key = md5(_encode('%s:%d:%r' % (abspath(taxonomy_fp), st.st_size,
+                                    st.st_mtime))).hexdigest()
+    index_dir = join(cache_dir, key)
+
+    if index_dir not in _INDEXES:
+        if not exists(index_dir):
+            _make_shared_dir(cache_dir)
+            # build in a temporary directory and then rename it, so other
+            # jobs never see an incomplete index
+            tmp_dir = mkdtemp(dir=cache_dir)
+            try:
+                build_taxonomy_index(taxonomy_fp, tmp_dir)
+                # mkdtemp only lets its owner read the directory, while the
+                # index is shared with the other users of the node
+                chmod(tmp_dir, 0o755)
+                for name in listdir(tmp_dir):
+                    chmod(join(tmp_dir, name), 0o644)
+                try:
+                    rename(tmp_dir, index_dir)
+                except OSError:
+                    # another job built the same index first
+                    pass
+            finally:
+                rmtree(tmp_dir, ignore_errors=True)
+        _INDEXES[index_dir] = TaxonomyIndex(index_dir)
+
+    return _INDEXES[index_dir]
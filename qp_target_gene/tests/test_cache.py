@@ -0,0 +1,140 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from unittest import TestCase, main
+from os.path import isdir, exists, join
+from os import remove, makedirs, listdir, utime, environ
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from qiita_client import ArtifactInfo
+
+from qp_target_gene.cache import (
+    compute_file_checksum, generate_cache_key, get_cached_result,
+    store_result, evict_results, cached_command)
+
+
+class UnreachableQiitaServer(object):
+    """Stand-in for a Qiita server whose requests fail"""
+    def get(self, url, **kwargs):
+        raise RuntimeError("Request failed: %s" % url)
+
+
+class CacheTests(TestCase):
+    def setUp(self):
+        self._clean_up_files = []
+        self.cache_dir = mkdtemp()
+        self._clean_up_files.append(self.cache_dir)
+        self.out_dir = mkdtemp()
+        self._clean_up_files.append(self.out_dir)
+
+        makedirs(join(self.out_dir, 'cr_otus', 'sortmerna_picked_otus'))
+        self.files = {'cr_otus/otu_table.biom': 'biom table',
+                      'cr_otus/sortmerna_picked_otus/seqs_otus.txt': 'map',
+                      'cr_otus/log_20151204223007.txt': 'log'}
+        for fp, content in self.files.items():
+            with open(join(self.out_dir, fp), 'w') as f:
+                f.write(content)
+        self._environ = environ.get('QP_TARGET_GENE_CONFIG_FP')
+        self.ainfo = [ArtifactInfo('OTU table', 'BIOM', [
+            (join(self.out_dir, 'cr_otus/otu_table.biom'), 'biom'),
+            (join(self.out_dir, 'cr_otus/sortmerna_picked_otus'),
+             'directory'),
+            (join(self.out_dir, 'cr_otus/log_20151204223007.txt'), 'log')])]
+
+    def tearDown(self):
+        if self._environ is None:
+            environ.pop('QP_TARGET_GENE_CONFIG_FP', None)
+        else:
+            environ['QP_TARGET_GENE_CONFIG_FP'] = self._environ
+        for fp in self._clean_up_files:
+            if exists(fp):
+                if isdir(fp):
+                    rmtree(fp)
+                else:
+                    remove(fp)
+
+    def test_compute_file_checksum(self):
+        fp = join(self.out_dir, 'cr_otus/otu_table.biom')
+        self.assertEqual(compute_file_checksum(fp),
+                         'e8cc22e77591c323d122cb34f51f6815')
+        self.assertEqual(compute_file_checksum(fp, buffer_size=3),
+                         'e8cc22e77591c323d122cb34f51f6815')
+
+    def test_generate_cache_key(self):
+        params = {'input_data': 1, 'length': 100}
+        obs = generate_cache_key('trimming', '1.9.2', params, ['a', 'b'])
+        self.assertEqual(len(obs), 32)
+        # the artifact id and the order of the checksums are not relevant
+        self.assertEqual(generate_cache_key(
+            'trimming', '1.9.2', {'input_data': 2, 'length': 100},
+            ['b', 'a']), obs)
+        self.assertNotEqual(generate_cache_key(
+            'trimming', '1.9.2', {'input_data': 1, 'length': 90},
+            ['a', 'b']), obs)
+        self.assertNotEqual(generate_cache_key(
+            'trimming', '1.9.3', params, ['a', 'b']), obs)
+        self.assertNotEqual(generate_cache_key(
+            'trimming', '1.9.2', params, ['a', 'c']), obs)
+
+    def test_store_and_get_cached_result(self):
+        self.assertIsNone(get_cached_result(self.cache_dir, 'key', 'out'))
+        self.assertTrue(
+            store_result(self.cache_dir, 'key', self.out_dir, self.ainfo))
+        self.assertEqual(listdir(self.cache_dir), ['key'])
+
+        new_out_dir = mkdtemp()
+        self._clean_up_files.append(new_out_dir)
+        obs = get_cached_result(self.cache_dir, 'key', new_out_dir)
+        exp = [ArtifactInfo('OTU table', 'BIOM', [
+            (join(new_out_dir, 'cr_otus/otu_table.biom'), 'biom'),
+            (join(new_out_dir, 'cr_otus/sortmerna_picked_otus'),
+             'directory'),
+            (join(new_out_dir, 'cr_otus/log_20151204223007.txt'), 'log')])]
+        self.assertEqual(obs, exp)
+        for fp, content in self.files.items():
+            with open(join(new_out_dir, fp)) as f:
+                self.assertEqual(f.read(), content)
+
+    def test_store_result_outside_out_dir(self):
+        ainfo = [ArtifactInfo('OTU table', 'BIOM', [('/tmp/a.biom', 'biom')])]
+        self.assertFalse(
+            store_result(self.cache_dir, 'key', self.out_dir, ainfo))
+        self.assertEqual(listdir(self.cache_dir), [])
+
+    def test_evict_results(self):
+        for i, key in enumerate(['old', 'new']):
+            store_result(self.cache_dir, key, self.out_dir, self.ainfo)
+            utime(join(self.cache_dir, key, 'artifacts.json'), (i, i))
+        # each entry has 16 bytes
+        evict_results(self.cache_dir, 32)
+        self.assertEqual(sorted(listdir(self.cache_dir)), ['new', 'old'])
+        evict_results(self.cache_dir, 20)
+        self.assertEqual(listdir(self.cache_dir), ['new'])
+        evict_results(self.cache_dir, 0)
+        self.assertEqual(listdir(self.cache_dir), [])
+
+    def test_cached_command_key_error(self):
+        config_fp = join(self.out_dir, 'config.cfg')
+        with open(config_fp, 'w') as f:
+            f.write('[cache]\nCACHE_DIR = %s\n' % self.cache_dir)
+        environ['QP_TARGET_GENE_CONFIG_FP'] = config_fp
+
+        @cached_command('command')
+        def command(qclient, job_id, parameters, out_dir):
+            return True, self.ainfo, ''
+
+        # the command runs without the cache if its key can't be computed
+        obs = command(UnreachableQiitaServer(), 'job-id', {'input_data': 1},
+                      self.out_dir)
+        self.assertEqual(obs, (True, self.ainfo, ''))
+        self.assertEqual(listdir(self.cache_dir), [])
+
+
+if __name__ == '__main__':
+    main()
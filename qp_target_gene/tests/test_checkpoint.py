@@ -0,0 +1,109 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from unittest import TestCase, main
+from os import remove, makedirs
+from os.path import exists, isdir, join
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from qp_target_gene.checkpoint import Checkpoints, CHECKPOINTS_DIR
+
+
+class CheckpointsTests(TestCase):
+    def setUp(self):
+        self._clean_up_files = []
+        self.out_dir = mkdtemp()
+        self._clean_up_files.append(self.out_dir)
+        self.input_fp = self._write('input.txt', 'input')
+        self.output_fp = self._write('output.txt', 'output')
+
+    def tearDown(self):
+        for fp in self._clean_up_files:
+            if exists(fp):
+                if isdir(fp):
+                    rmtree(fp)
+                else:
+                    remove(fp)
+
+    def _write(self, fname, contents):
+        fp = join(self.out_dir, fname)
+        with open(fp, 'w') as f:
+            f.write(contents)
+        return fp
+
+    def test_checksum(self):
+        checkpoints = Checkpoints(self.out_dir)
+        self.assertEqual(checkpoints.checksum(self.input_fp),
+                         'a43c1b0aa53a0c908810c06ab1ff3967')
+        self.assertIsNone(checkpoints.checksum(join(self.out_dir, 'nope')))
+
+    def test_is_complete(self):
+        checkpoints = Checkpoints(self.out_dir)
+        self.assertFalse(checkpoints.is_complete('stage', [self.input_fp]))
+
+        checkpoints.complete('stage', [self.input_fp], [self.output_fp],
+                             key='cmd')
+        self.assertTrue(exists(join(self.out_dir, CHECKPOINTS_DIR,
+                                    'stage.json')))
+        self.assertTrue(checkpoints.is_complete('stage', [self.input_fp],
+                                                key='cmd'))
+        # a new job in the same directory
+        checkpoints = Checkpoints(self.out_dir)
+        self.assertTrue(checkpoints.is_complete('stage', [self.input_fp],
+                                                key='cmd'))
+        # a different key, e.g. different parameters
+        self.assertFalse(checkpoints.is_complete('stage', [self.input_fp],
+                                                 key='other cmd'))
+        # different inputs
+        self.assertFalse(checkpoints.is_complete(
+            'stage', [self.input_fp, self.output_fp], key='cmd'))
+
+    def test_is_complete_modified(self):
+        checkpoints = Checkpoints(self.out_dir)
+        checkpoints.complete('stage', [self.input_fp], [self.output_fp])
+        self._write('input.txt', 'new input')
+        self.assertFalse(checkpoints.is_complete('stage', [self.input_fp]))
+
+        checkpoints.complete('stage', [self.input_fp], [self.output_fp])
+        self._write('output.txt', 'truncated')
+        self.assertFalse(checkpoints.is_complete('stage', [self.input_fp]))
+
+        checkpoints.complete('stage', [self.input_fp], [self.output_fp])
+        remove(self.output_fp)
+        self.assertFalse(checkpoints.is_complete('stage', [self.input_fp]))
+
+    def test_is_complete_directory(self):
+        checkpoints = Checkpoints(self.out_dir)
+        sl_out = join(self.out_dir, 'sl_out')
+        makedirs(sl_out)
+        self._write('sl_out/seqs.fna', '>a\nACGT\n')
+        checkpoints.complete('stage', [self.input_fp], [sl_out])
+        self.assertTrue(checkpoints.is_complete('stage', [self.input_fp]))
+
+        self._write('sl_out/seqs.fna', '>a\nACG\n')
+        self.assertFalse(checkpoints.is_complete('stage', [self.input_fp]))
+
+    def test_is_complete_incomplete_marker(self):
+        checkpoints = Checkpoints(self.out_dir)
+        checkpoints.complete('stage', [self.input_fp], [self.output_fp])
+        with open(join(self.out_dir, CHECKPOINTS_DIR, 'stage.json'),
+                  'w') as f:
+            f.write('{"key": ')
+        self.assertFalse(checkpoints.is_complete('stage', [self.input_fp]))
+
+    def test_start(self):
+        checkpoints = Checkpoints(self.out_dir)
+        checkpoints.start('stage')
+        checkpoints.complete('stage', [self.input_fp], [self.output_fp])
+        checkpoints.start('stage')
+        self.assertFalse(checkpoints.is_complete('stage', [self.input_fp]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from unittest import TestCase, main
+from os import remove
+from os.path import exists, isdir, join
+from shutil import rmtree
+from tempfile import mkdtemp
+from struct import pack
+import zlib
+import gzip
+
+from qp_target_gene.compression import (
+    GZIP, BGZF, ZSTD, detect_compression, strip_compression_extension,
+    open_input, map_input, iter_chunks, decompress_file,
+    decompress_unsupported)
+
+
+def _bgzf_block(data):
+    """Compresses data as a BGZF block, as written by bgzip"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+    cdata = compressor.compress(data) + compressor.flush()
+    return (pack('<2sBBIBBH', b'\x1f\x8b', 8, 4, 0, 0, 255, 6) +
+            pack('<2sHH', b'BC', 2, len(cdata) + 25) + cdata +
+            pack('<II', zlib.crc32(data) & 0xFFFFFFFF, len(data)))
+
+
+def _bgzf(data, block_size=1000):
+    """Compresses data as a BGZF file, with the end of file block"""
+    return b''.join(_bgzf_block(data[i:i + block_size])
+                    for i in range(0, len(data), block_size)) + \
+        _bgzf_block(b'')
+
+
+class CompressionTests(TestCase):
+    def setUp(self):
+        self._clean_up_files = []
+        self.out_dir = mkdtemp()
+        self._clean_up_files.append(self.out_dir)
+        self.data = b''.join(b'>read_%d\nACGTACGTAC\n' % i
+                             for i in range(5000))
+
+        self.plain_fp = join(self.out_dir, 'seqs.fna')
+        with open(self.plain_fp, 'wb') as f:
+            f.write(self.data)
+        self.gz_fp = join(self.out_dir, 'seqs.fna.gz')
+        with gzip.open(self.gz_fp, 'wb') as f:
+            f.write(self.data)
+        self.bgzf_fp = join(self.out_dir, 'seqs.fna.bgz')
+        with open(self.bgzf_fp, 'wb') as f:
+            f.write(_bgzf(self.data))
+        self.empty_fp = join(self.out_dir, 'empty.fna')
+        with open(self.empty_fp, 'wb') as f:
+            f.write(b'')
+
+    def tearDown(self):
+        for fp in self._clean_up_files:
+            if exists(fp):
+                if isdir(fp):
+                    rmtree(fp)
+                else:
+                    remove(fp)
+
+    def test_detect_compression(self):
+        self.assertIsNone(detect_compression(self.plain_fp))
+        self.assertIsNone(detect_compression(self.empty_fp))
+        self.assertEqual(detect_compression(self.gz_fp), GZIP)
+        self.assertEqual(detect_compression(self.bgzf_fp), BGZF)
+
+        # from the contents, not the name
+        fp = join(self.out_dir, 'seqs.fna')
+        with open(fp, 'wb') as f:
+            f.write(_bgzf(b'ACGT'))
+        self.assertEqual(detect_compression(fp), BGZF)
+        with open(fp, 'wb') as f:
+            f.write(b'\x28\xb5\x2f\xfd' + b'\0' * 10)
+        self.assertEqual(detect_compression(fp), ZSTD)
+
+    def test_strip_compression_extension(self):
+        self.assertEqual(strip_compression_extension('a.sff.gz'), 'a.sff')
+        self.assertEqual(strip_compression_extension('a.fastq.zst'),
+                         'a.fastq')
+        self.assertEqual(strip_compression_extension('a.sff'), 'a.sff')
+
+    def test_open_input(self):
+        for fp in (self.plain_fp, self.gz_fp, self.bgzf_fp):
+            for threads in (1, 3):
+                with open_input(fp, threads) as f:
+                    self.assertEqual(f.readline(), b'>read_0\n')
+                    self.assertEqual(f.read(), self.data[8:])
+        with open_input(self.empty_fp) as f:
+            self.assertEqual(f.read(), b'')
+
+    def test_open_input_bgzf_error(self):
+        data = _bgzf(self.data)
+        fp = join(self.out_dir, 'truncated.bgz')
+        with open(fp, 'wb') as f:
+            f.write(data[:-100])
+        with self.assertRaisesRegexp(ValueError, 'Truncated BGZF'):
+            with open_input(fp) as f:
+                f.read()
+
+        # a bit flipped in the compressed data of the last block
+        fp = join(self.out_dir, 'corrupted.bgz')
+        block = bytearray(_bgzf_block(b'ACGT' * 100))
+        block[20] ^= 1
+        with open(fp, 'wb') as f:
+            f.write(_bgzf_block(b'ACGT') + bytes(block))
+        with self.assertRaises((ValueError, zlib.error)):
+            with open_input(fp) as f:
+                f.read()
+
+    def test_map_input(self):
+        for fp in (self.plain_fp, self.gz_fp, self.bgzf_fp):
+            with map_input(fp) as f:
+                self.assertEqual(f.read(8), b'>read_0\n')
+                self.assertEqual(f.read(), self.data[8:])
+        with map_input(self.empty_fp) as f:
+            self.assertEqual(f.read(), b'')
+
+    def test_iter_chunks(self):
+        for fp in (self.plain_fp, self.gz_fp, self.bgzf_fp):
+            chunks = list(iter_chunks(fp, 1000))
+            self.assertTrue(all(len(c) == 1000 for c in chunks[:-1]))
+            self.assertEqual(b''.join(chunks), self.data)
+        self.assertEqual(list(iter_chunks(self.empty_fp)), [])
+
+    def test_decompress_file(self):
+        for fp in (self.gz_fp, self.bgzf_fp):
+            out_fp = join(self.out_dir, 'out.fna')
+            self.assertEqual(decompress_file(fp, out_fp), out_fp)
+            with open(out_fp, 'rb') as f:
+                self.assertEqual(f.read(), self.data)
+            self.assertFalse(exists(out_fp + '.tmp'))
+
+    def test_decompress_unsupported(self):
+        fps = [self.plain_fp, self.gz_fp, self.bgzf_fp]
+        out_dir = join(self.out_dir, 'inputs')
+        self.assertEqual(decompress_unsupported(fps, out_dir), fps)
+        self.assertFalse(exists(out_dir))
+
+        obs = decompress_unsupported(fps, out_dir, supported=(None, GZIP))
+        self.assertEqual(obs, [self.plain_fp, self.gz_fp,
+                               join(out_dir, 'seqs.fna')])
+        with open(obs[2], 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from unittest import TestCase, main
+from os import environ, remove, close
+from os.path import exists
+from tempfile import mkstemp
+
+from qp_target_gene import plugin
+from qp_target_gene.config import (
+    DEFAULT_CONFIG_FP, get_plugin_config_fp, get_config_fps,
+    get_config_value, write_plugin_options)
+
+
+class ConfigTests(TestCase):
+    def setUp(self):
+        self._clean_up_files = []
+        self._environ = environ.get('QP_TARGET_GENE_CONFIG_FP')
+
+    def tearDown(self):
+        if self._environ is None:
+            environ.pop('QP_TARGET_GENE_CONFIG_FP', None)
+        else:
+            environ['QP_TARGET_GENE_CONFIG_FP'] = self._environ
+        for fp in self._clean_up_files:
+            if exists(fp):
+                remove(fp)
+
+    def test_get_plugin_config_fp(self):
+        self.assertEqual(get_plugin_config_fp(), plugin.conf_fp)
+
+    def test_get_config_fps(self):
+        environ.pop('QP_TARGET_GENE_CONFIG_FP', None)
+        obs = get_config_fps()
+        self.assertEqual(obs[0], DEFAULT_CONFIG_FP)
+
+        # the files that don't exist are not read
+        environ['QP_TARGET_GENE_CONFIG_FP'] = '/does/not/exist.cfg'
+        self.assertEqual(get_config_fps(), obs)
+
+        fd, fp = mkstemp(suffix='.cfg')
+        close(fd)
+        self._clean_up_files.append(fp)
+        environ['QP_TARGET_GENE_CONFIG_FP'] = fp
+        self.assertEqual(get_config_fps(), obs + [fp])
+
+    def test_get_config_value(self):
+        environ.pop('QP_TARGET_GENE_CONFIG_FP', None)
+        self.assertEqual(get_config_value('cache', 'CACHE_DIR'), '')
+        self.assertEqual(get_config_value('cache', 'CACHE_SIZE'), '50')
+        self.assertEqual(get_config_value('timings', 'ATTACH_TO_LOG'),
+                         'False')
+        self.assertEqual(get_config_value('cache', 'UNKNOWN', 'x'), 'x')
+        self.assertEqual(get_config_value('unknown', 'CACHE_DIR', 'x'), 'x')
+
+        fd, fp = mkstemp(suffix='.cfg')
+        close(fd)
+        self._clean_up_files.append(fp)
+        with open(fp, 'w') as f:
+            f.write("[cache]\nCACHE_DIR = /tmp/cache\n")
+        environ['QP_TARGET_GENE_CONFIG_FP'] = fp
+        self.assertEqual(get_config_value('cache', 'CACHE_DIR'), '/tmp/cache')
+        # the options not in the file keep their default value
+        self.assertEqual(get_config_value('cache', 'CACHE_SIZE', '1'), '50')
+        self.assertEqual(get_config_value('staging', 'COPY_THREADS'), '4')
+
+    def test_write_plugin_options(self):
+        fd, fp = mkstemp(suffix='.conf')
+        close(fd)
+        self._clean_up_files.append(fp)
+        with open(fp, 'w') as f:
+            f.write("[main]\nNAME = QIIMEq2\n")
+        write_plugin_options(fp)
+        with open(fp) as f:
+            obs = f.read()
+        self.assertTrue(obs.startswith("[main]\nNAME = QIIMEq2\n\n[cache]\n"))
+        self.assertEqual(obs.count('[main]'), 1)
+        self.assertIn('[staging]\n', obs)
+
+        # the options set in the file are read
+        with open(fp, 'w') as f:
+            f.write(obs.replace('ATTACH_TO_LOG = False',
+                                'ATTACH_TO_LOG = True'))
+        environ['QP_TARGET_GENE_CONFIG_FP'] = fp
+        self.assertEqual(get_config_value('timings', 'ATTACH_TO_LOG'),
+                         'True')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from unittest import TestCase, main
+from os import remove, utime
+from os.path import exists, isdir, join, getmtime
+from shutil import rmtree, copy
+from tempfile import mkdtemp
+from json import load, dump
+from zlib import crc32
+
+import numpy.testing as npt
+from h5py import File
+
+from qp_target_gene.demux_index import (
+    DemuxIndex, write_demux_index, index_fp)
+from qp_target_gene.manifest import Manifest
+
+
+DEMUX_FP = 'support_files/filtered_5_seqs.demux'
+
+
+class DemuxIndexTests(TestCase):
+    def setUp(self):
+        self._clean_up_files = []
+        self.out_dir = mkdtemp()
+        self._clean_up_files.append(self.out_dir)
+        self.demux_fp = join(self.out_dir, 'seqs.demux')
+        copy(DEMUX_FP, self.demux_fp)
+
+    def tearDown(self):
+        for fp in self._clean_up_files:
+            if exists(fp):
+                if isdir(fp):
+                    rmtree(fp)
+                else:
+                    remove(fp)
+
+    def test_build(self):
+        index = DemuxIndex.build(self.demux_fp)
+        self.assertTrue(index.has_qual)
+        self.assertEqual(index.total, 31448)
+        self.assertEqual(index.names, ['1.SKB7.640196', '1.SKB8.640193'])
+        self.assertEqual(index['1.SKB7.640196'],
+                         {'name': '1.SKB7.640196', 'count': 15213,
+                          'offset': 0, 'min': 151, 'max': 151,
+                          'mean': 151.0, 'median': 151.0, 'std': 0.0})
+        self.assertEqual(index['1.SKB8.640193']['offset'], 15213)
+        self.assertEqual(index.stats['max'], 151)
+        self.assertIn('1.SKB8.640193', index)
+        self.assertNotIn('1.SKB1.640202', index)
+
+    def test_write_load(self):
+        manifest = Manifest(self.out_dir)
+        obs = write_demux_index(self.demux_fp, manifest)
+        fp = index_fp(self.demux_fp)
+        self.assertEqual(fp, self.demux_fp + '.index.json')
+        with open(fp, 'rb') as f:
+            data = f.read()
+        # the index is checksummed as it is written
+        self.assertEqual(manifest.get(fp),
+                         (crc32(data) & 0xFFFFFFFF, len(data)))
+        with open(fp) as f:
+            info = load(f)
+        self.assertEqual(info['total'], 31448)
+
+        # the written index is used
+        info['samples'][0]['count'] = 10
+        with open(fp, 'w') as f:
+            dump(info, f)
+        self.assertEqual(DemuxIndex.load(self.demux_fp).total, 16245)
+
+        # also if a copy of the demux file lost the fractions of a second of
+        # its modification time
+        mtime = int(getmtime(self.demux_fp)) + 0.5
+        utime(self.demux_fp, (mtime, mtime))
+        self.assertEqual(DemuxIndex.load(self.demux_fp).total, 16245)
+
+        # but not once the demux file changes
+        mtime = getmtime(self.demux_fp) + 10
+        utime(self.demux_fp, (mtime, mtime))
+        self.assertEqual(DemuxIndex.load(self.demux_fp).total, obs.total)
+
+        # or if there is no index
+        remove(fp)
+        self.assertEqual(DemuxIndex.load(self.demux_fp).total, obs.total)
+
+    def test_count(self):
+        index = DemuxIndex.build(self.demux_fp)
+        self.assertEqual(index.count(), 31448)
+        self.assertEqual(index.count(['1.SKB8.640193']), 16235)
+        with self.assertRaises(KeyError):
+            index.count(['1.SKB1.640202'])
+
+    def test_locate(self):
+        index = DemuxIndex.build(self.demux_fp)
+        self.assertEqual(index.locate(0), ('1.SKB7.640196', 0))
+        self.assertEqual(index.locate(15212), ('1.SKB7.640196', 15212))
+        self.assertEqual(index.locate(15213), ('1.SKB8.640193', 0))
+        self.assertEqual(index.locate(31447), ('1.SKB8.640193', 16234))
+        with self.assertRaises(IndexError):
+            index.locate(31448)
+
+    def test_locate_empty_samples(self):
+        index = DemuxIndex([{'name': 'a', 'count': 0},
+                            {'name': 'b', 'count': 2},
+                            {'name': 'c', 'count': 0},
+                            {'name': 'd', 'count': 1}], False)
+        self.assertEqual(index.locate(0), ('b', 0))
+        self.assertEqual(index.locate(1), ('b', 1))
+        self.assertEqual(index.locate(2), ('d', 0))
+
+    def test_fetch_samples(self):
+        index = DemuxIndex.build(self.demux_fp)
+        with File(self.demux_fp, 'r') as fh:
+            obs = list(index.fetch(fh, samples=['1.SKB8.640193'],
+                                   chunk_size=1000))
+            grp = fh['1.SKB8.640193']
+            self.assertEqual(len(obs), 16235)
+            samp, idx, seq, qual, bc_ori, bc_cor, bc_err = obs[-1]
+            self.assertEqual(samp, b'1.SKB8.640193')
+            self.assertEqual(idx, 16234)
+            self.assertEqual(seq, grp['sequence'][16234])
+            npt.assert_equal(qual, grp['qual'][16234][:len(seq)])
+            self.assertEqual(bc_ori, grp['barcode/original'][16234])
+            self.assertEqual(bc_cor, grp['barcode/corrected'][16234])
+            self.assertEqual(bc_err, grp['barcode/error'][16234])
+
+            with self.assertRaises(KeyError):
+                list(index.fetch(fh, samples=['1.SKB1.640202']))
+
+    def test_fetch_range(self):
+        index = DemuxIndex.build(self.demux_fp)
+        with File(self.demux_fp, 'r') as fh:
+            obs = [(s, i) for s, i, _, _, _, _, _ in index.fetch(
+                fh, start=15211, stop=15215, chunk_size=3)]
+            self.assertEqual(obs, [(b'1.SKB7.640196', 15211),
+                                   (b'1.SKB7.640196', 15212),
+                                   (b'1.SKB8.640193', 0),
+                                   (b'1.SKB8.640193', 1)])
+            self.assertEqual(len(list(index.fetch(fh))), 31448)
+            self.assertEqual(len(list(index.fetch(fh, start=31440,
+                                                  stop=40000))), 8)
+
+    def test_fetch_batches(self):
+        index = DemuxIndex.build(self.demux_fp)
+        with File(self.demux_fp, 'r') as fh:
+            batches = list(index.fetch_batches(
+                fh, start=15000, stop=15300, chunk_size=100))
+            self.assertEqual([(b.sample, b.start, len(b.sequence))
+                              for b in batches],
+                             [(b'1.SKB7.640196', 15000, 100),
+                              (b'1.SKB7.640196', 15100, 100),
+                              (b'1.SKB7.640196', 15200, 13),
+                              (b'1.SKB8.640193', 0, 87)])
+            self.assertEqual(batches[-1].qual.shape, (87, 151))
+            npt.assert_equal(batches[-1].bc_error,
+                             fh['1.SKB8.640193/barcode/error'][:87])
+
+
+if __name__ == '__main__':
+    main()
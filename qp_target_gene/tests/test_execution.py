@@ -0,0 +1,164 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from unittest import TestCase, main
+from os import environ, remove, close
+from os.path import exists, isdir, join, basename
+from shutil import rmtree
+from tempfile import mkdtemp, mkstemp
+from sys import executable
+
+from qp_target_gene.execution import (
+    ResourceLimits, run_command, which)
+
+
+class ExecutionTests(TestCase):
+    def setUp(self):
+        self._clean_up_files = []
+        self._environ = environ.get('QP_TARGET_GENE_CONFIG_FP')
+        self.out_dir = mkdtemp()
+        self._clean_up_files.append(self.out_dir)
+        self.log_dir = join(self.out_dir, 'logs')
+
+    def tearDown(self):
+        if self._environ is None:
+            environ.pop('QP_TARGET_GENE_CONFIG_FP', None)
+        else:
+            environ['QP_TARGET_GENE_CONFIG_FP'] = self._environ
+        for fp in self._clean_up_files:
+            if exists(fp):
+                if isdir(fp):
+                    rmtree(fp)
+                else:
+                    remove(fp)
+
+    def _read(self, fp):
+        with open(fp) as f:
+            return f.read()
+
+    def test_resource_limits_error(self):
+        with self.assertRaises(ValueError):
+            ResourceLimits(io_class='fastest')
+
+    def test_resource_limits_from_config(self):
+        environ.pop('QP_TARGET_GENE_CONFIG_FP', None)
+        obs = ResourceLimits.from_config()
+        self.assertIsNone(obs.cpu_affinity)
+        self.assertIsNone(obs.memory_limit)
+        self.assertEqual(obs.nice, 0)
+        self.assertIsNone(obs.io_class)
+        self.assertIsNone(obs.io_priority)
+
+        fd, fp = mkstemp(suffix='.cfg')
+        close(fd)
+        self._clean_up_files.append(fp)
+        with open(fp, 'w') as f:
+            f.write("[resources]\nCPU_AFFINITY = 0-3\nMEMORY_LIMIT = 1.5\n"
+                    "NICE = 10\nIO_CLASS = best-effort\nIO_PRIORITY = 7\n")
+        environ['QP_TARGET_GENE_CONFIG_FP'] = fp
+        obs = ResourceLimits.from_config()
+        self.assertEqual(obs.cpu_affinity, '0-3')
+        self.assertEqual(obs.memory_limit, 1.5)
+        self.assertEqual(obs.nice, 10)
+        self.assertEqual(obs.io_class, 'best-effort')
+        self.assertEqual(obs.io_priority, 7)
+
+    def test_resource_limits_wrap(self):
+        cmd = 'echo test > out.txt'
+        self.assertEqual(ResourceLimits().wrap(cmd), ['/bin/sh', '-c', cmd])
+
+        obs = ResourceLimits(cpu_affinity='0', io_class='best-effort',
+                             io_priority=7).wrap(cmd)
+        exp = []
+        if which('taskset'):
+            exp.extend(['taskset', '-c', '0'])
+        if which('ionice'):
+            exp.extend(['ionice', '-c', '2', '-n', '7'])
+        exp.extend(['/bin/sh', '-c', cmd])
+        self.assertEqual(obs, exp)
+
+        obs = ResourceLimits(memory_limit=1.5, nice=10).wrap(cmd)
+        self.assertEqual(obs, ['nice', '-n', '10', '/bin/sh', '-c',
+                               'ulimit -v 1572864 || exit 1\n%s' % cmd])
+
+    def test_run_command(self):
+        obs = run_command('echo test; echo error >&2', self.log_dir,
+                          limits=ResourceLimits())
+        self.assertEqual(obs.return_value, 0)
+        self.assertEqual(basename(obs.stdout_fp), '1_echo.stdout.txt')
+        self.assertEqual(basename(obs.stderr_fp), '1_echo.stderr.txt')
+        self.assertEqual(self._read(obs.stdout_fp), 'test\n')
+        self.assertEqual(self._read(obs.stderr_fp), 'error\n')
+        self.assertEqual(obs.stdout_tail, 'test\n')
+        self.assertEqual(obs.stderr_tail, 'error\n')
+        self.assertEqual(
+            sorted(obs.usage), ['cpu_time', 'peak_rss', 'read_bytes',
+                                'wall_time', 'write_bytes'])
+        self.assertGreater(obs.usage['peak_rss'], 0)
+
+        # the output of previous commands is kept
+        obs = run_command('echo other', self.log_dir, limits=ResourceLimits())
+        self.assertEqual(basename(obs.stdout_fp), '2_echo.stdout.txt')
+
+    def test_run_command_error(self):
+        obs = run_command('exit 3', self.log_dir, limits=ResourceLimits())
+        self.assertEqual(obs.return_value, 3)
+
+        obs = run_command('kill -9 $$', self.log_dir, limits=ResourceLimits())
+        self.assertEqual(obs.return_value, -9)
+
+    def test_run_command_limits(self):
+        obs = run_command('nice', self.log_dir,
+                          limits=ResourceLimits(nice=5))
+        self.assertEqual(obs.return_value, 0)
+        self.assertTrue(int(self._read(obs.stdout_fp)) >= 5)
+
+        cmd = '%s -c "x = bytearray(500 * 1024 * 1024)"' % executable
+        obs = run_command(cmd, self.log_dir,
+                          limits=ResourceLimits(memory_limit=0.25))
+        self.assertNotEqual(obs.return_value, 0)
+        self.assertIn('MemoryError', self._read(obs.stderr_fp))
+
+    def test_run_command_tail(self):
+        cmd = 'for i in $(seq 1 100); do echo "line $i"; done'
+        obs = run_command(cmd, self.log_dir, limits=ResourceLimits(),
+                          tail_bytes=17)
+        self.assertEqual(obs.stdout_tail,
+                         '[... 775 bytes omitted]\nline 99\nline 100\n')
+        self.assertEqual(obs.stderr_tail, '')
+        # the file has the whole output
+        with open(obs.stdout_fp) as f:
+            self.assertEqual(len(f.readlines()), 100)
+
+    def test_run_command_rotation(self):
+        cmd = 'for i in $(seq 1 100); do echo "line $i"; done'
+        obs = run_command(cmd, self.log_dir, limits=ResourceLimits(),
+                          max_bytes=100, backup_count=2)
+        self.assertEqual(self._read(obs.stdout_fp).splitlines()[-1],
+                         'line 100')
+        self.assertTrue(exists(obs.stdout_fp + '.1'))
+        self.assertTrue(exists(obs.stdout_fp + '.2'))
+        self.assertFalse(exists(obs.stdout_fp + '.3'))
+        self.assertLessEqual(len(self._read(obs.stdout_fp + '.1')), 100)
+
+    def test_run_command_progress(self):
+        lines = []
+        cmd = 'echo "Reading"; echo "10% done"; echo "55.5 % done" >&2'
+        obs = run_command(cmd, self.log_dir, limits=ResourceLimits(),
+                          progress=lines.append)
+        self.assertEqual(obs.return_value, 0)
+        self.assertEqual(sorted(lines), ['10% done', '55.5 % done'])
+
+        lines = []
+        run_command(cmd, self.log_dir, limits=ResourceLimits(),
+                    progress=lines.append, progress_re='^Reading')
+        self.assertEqual(lines, ['Reading'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from unittest import TestCase, main
+from os.path import isdir, exists, join
+from os import remove
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from biom import load_table
+
+from qp_target_gene.otu_table import build_otu_table
+from qp_target_gene.incremental import (
+    parameters_hash, compute_sample_checksums, write_checksums_file,
+    read_checksums_file, find_changed_samples, write_samples_fasta,
+    merge_otu_tables)
+
+
+class IncrementalTests(TestCase):
+    def setUp(self):
+        self._clean_up_files = []
+        self.out_dir = mkdtemp()
+        self._clean_up_files.append(self.out_dir)
+        self.parameters = {
+            'reference-seq': '/databases/gg/13_8/rep_set/97_otus.fasta',
+            'reference-tax': '/databases/gg/13_8/taxonomy/97_otu_taxonomy.txt',
+            "sortmerna_e_value": 1, "sortmerna_max_pos": 10000,
+            "similarity": 0.97, "sortmerna_coverage": 0.97, "threads": 1,
+            "previous_otu_table": "", "input_data": 2}
+
+    def tearDown(self):
+        for fp in self._clean_up_files:
+            if exists(fp):
+                if isdir(fp):
+                    rmtree(fp)
+                else:
+                    remove(fp)
+
+    def test_parameters_hash(self):
+        obs = parameters_hash(self.parameters)
+        # threads and the input data do not change the results
+        self.parameters['threads'] = 4
+        self.parameters['input_data'] = 3
+        self.assertEqual(parameters_hash(self.parameters), obs)
+
+        self.parameters['similarity'] = 0.99
+        self.assertNotEqual(parameters_hash(self.parameters), obs)
+
+    def test_compute_sample_checksums(self):
+        obs = compute_sample_checksums('support_files/filtered_5_seqs.demux')
+        self.assertEqual(sorted(obs), ['1.SKB7.640196', '1.SKB8.640193'])
+        self.assertEqual(
+            obs, compute_sample_checksums(
+                'support_files/filtered_5_seqs.demux', chunk_size=1000))
+
+        obs_50 = compute_sample_checksums(
+            'support_files/filtered_5_seqs_50bps.demux')
+        self.assertEqual(sorted(obs_50), sorted(obs))
+        self.assertNotEqual(obs_50['1.SKB7.640196'], obs['1.SKB7.640196'])
+
+    def test_checksums_file(self):
+        fp = join(self.out_dir, 'sample_checksums.json')
+        write_checksums_file(fp, 'abc', {'s1': 'x', 's2': 'y'})
+        self.assertEqual(read_checksums_file(fp),
+                         ('abc', {'s1': 'x', 's2': 'y'}))
+
+    def test_find_changed_samples(self):
+        previous = {'s1': 'x', 's2': 'y', 's3': 'z'}
+        current = {'s1': 'x', 's2': 'w', 's4': 'v'}
+        self.assertEqual(find_changed_samples(previous, current),
+                         (['s1'], ['s2', 's4']))
+
+    def test_write_samples_fasta(self):
+        fp = join(self.out_dir, 'seqs.fna')
+        write_samples_fasta('support_files/filtered_5_seqs.demux',
+                            ['1.SKB8.640193'], fp)
+        with open(fp) as f:
+            obs = f.readlines()
+        self.assertEqual(len(obs), 2 * 16235)
+        self.assertEqual(obs[0], '>1.SKB8.640193_0\n')
+
+    def test_merge_otu_tables(self):
+        tax_fp = join(self.out_dir, 'tax.txt')
+        with open(tax_fp, 'w') as f:
+            f.write(REF_TAX)
+        previous_fp = join(self.out_dir, 'previous.biom')
+        new_fp = join(self.out_dir, 'new.biom')
+        for otu_map, fp in ((PREVIOUS_OTU_MAP, previous_fp),
+                            (NEW_OTU_MAP, new_fp)):
+            map_fp = join(self.out_dir, 'otu_map.txt')
+            with open(map_fp, 'w') as f:
+                f.write(otu_map)
+            build_otu_table(map_fp, tax_fp, fp)
+
+        out_fp = join(self.out_dir, 'merged.biom')
+        merge_otu_tables(previous_fp, ['s1'], new_fp, out_fp)
+        obs = load_table(out_fp)
+        self.assertEqual(sorted(obs.ids()), ['s1', 's2'])
+        # 836974 was only present in the replaced s2
+        self.assertEqual(sorted(obs.ids('observation')), ['187144', '367523'])
+        self.assertEqual(obs.get_value_by_ids('187144', 's2'), 2)
+        self.assertEqual(obs.get_value_by_ids('367523', 's1'), 2)
+
+        merge_otu_tables(previous_fp, ['s1'], None, out_fp)
+        obs = load_table(out_fp)
+        self.assertEqual(obs.ids().tolist(), ['s1'])
+
+
+PREVIOUS_OTU_MAP = """367523\ts1_0\ts1_1
+836974\ts2_0
+"""
+
+NEW_OTU_MAP = """187144\ts2_0\ts2_1
+"""
+
+REF_TAX = """367523\tk__Bacteria; p__Bacteroidetes
+187144\tk__Bacteria; p__Firmicutes
+836974\tk__Bacteria; p__Cyanobacteria
+"""
+
+
+if __name__ == '__main__':
+    main()
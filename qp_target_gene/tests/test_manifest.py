@@ -0,0 +1,122 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from unittest import TestCase, main
+from os import remove, makedirs, utime
+from os.path import exists, isdir, join, getmtime
+from shutil import rmtree
+from tempfile import mkdtemp
+from json import load
+from zlib import crc32
+
+from qiita_client import ArtifactInfo
+
+from qp_target_gene.manifest import (
+    MANIFEST_FILENAME, ChecksumWriter, Manifest, write_manifests)
+
+
+class ManifestTests(TestCase):
+    def setUp(self):
+        self._clean_up_files = []
+        self.out_dir = mkdtemp()
+        self._clean_up_files.append(self.out_dir)
+        self.data = b'>read_1\nACGT\n' * 1000
+
+    def tearDown(self):
+        for fp in self._clean_up_files:
+            if exists(fp):
+                if isdir(fp):
+                    rmtree(fp)
+                else:
+                    remove(fp)
+
+    def test_checksum_writer(self):
+        fp = join(self.out_dir, 'seqs.fna')
+        closed = []
+        with ChecksumWriter(open(fp, 'wb'), closed.append) as f:
+            f.write(self.data[:100])
+            f.write(self.data[100:])
+        self.assertEqual(closed, [f])
+        self.assertEqual(f.checksum, crc32(self.data) & 0xFFFFFFFF)
+        self.assertEqual(f.size, len(self.data))
+        with open(fp, 'rb') as g:
+            self.assertEqual(g.read(), self.data)
+
+        # closing twice doesn't record the file twice
+        f.close()
+        self.assertEqual(len(closed), 1)
+
+    def test_manifest(self):
+        fp = join(self.out_dir, 'seqs.fna')
+        with Manifest(self.out_dir) as manifest:
+            with manifest.open(fp) as f:
+                f.write(self.data)
+        with open(join(self.out_dir, MANIFEST_FILENAME)) as f:
+            obs = load(f)
+        self.assertEqual(obs, {'files': {'seqs.fna': {
+            'checksum': crc32(self.data) & 0xFFFFFFFF,
+            'size': len(self.data), 'mtime': getmtime(fp)}}})
+
+        # the entries are loaded, and used while the file doesn't change
+        manifest = Manifest(self.out_dir)
+        self.assertEqual(manifest.get(fp),
+                         (crc32(self.data) & 0xFFFFFFFF, len(self.data)))
+        manifest.entries['seqs.fna']['checksum'] = 1
+        self.assertEqual(manifest.get(fp), (1, len(self.data)))
+
+        # files modified since, or not written through the manifest, are
+        # not read to checksum them
+        with open(fp, 'ab') as f:
+            f.write(b'>read_2\nTGCA\n')
+        utime(fp, (0, 0))
+        self.assertIsNone(manifest.get(fp))
+        other_fp = join(self.out_dir, 'seqs.fastq')
+        with open(other_fp, 'wb') as f:
+            f.write(self.data)
+        self.assertIsNone(manifest.get(other_fp))
+
+    def test_write_manifests(self):
+        sl_out = join(self.out_dir, 'sl_out')
+        makedirs(join(sl_out, 'sortmerna_picked_otus'))
+        fps = [join(sl_out, f) for f in ('seqs.fna', 'seqs.demux',
+                                         'intermediate.txt')]
+        with Manifest(sl_out) as manifest:
+            for fp in fps:
+                with manifest.open(fp) as f:
+                    f.write(self.data)
+        # a file written by an external tool
+        log_fp = join(self.out_dir, 'log.txt')
+        with open(log_fp, 'wb') as f:
+            f.write(b'log')
+
+        ainfo = [ArtifactInfo('demultiplexed', 'Demultiplexed',
+                              [(fps[0], 'preprocessed_fasta'),
+                               (fps[1], 'preprocessed_demux'),
+                               (join(sl_out, 'sortmerna_picked_otus'),
+                                'directory'),
+                               (log_fp, 'log')])]
+        obs = write_manifests(ainfo)
+        self.assertEqual(obs, [join(sl_out, MANIFEST_FILENAME)])
+
+        manifest = Manifest(sl_out)
+        self.assertEqual(list(manifest.entries), ['seqs.fna', 'seqs.demux'])
+        self.assertEqual(manifest.get(fps[1]),
+                         (crc32(self.data) & 0xFFFFFFFF, len(self.data)))
+        # the files written by external tools are not checksummed
+        self.assertFalse(exists(join(self.out_dir, MANIFEST_FILENAME)))
+
+        # nor the files modified since they were written
+        with open(fps[0], 'ab') as f:
+            f.write(b'>read_2\nTGCA\n')
+        utime(fps[0], (0, 0))
+        write_manifests(ainfo)
+        self.assertEqual(list(Manifest(sl_out).entries), ['seqs.demux'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from unittest import TestCase, main
+from os.path import isdir, exists, join
+from os import remove, listdir
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from qp_target_gene import metadata
+from qp_target_gene.metadata import (
+    get_artifact_info, get_artifact_filepaths, get_prep_info,
+    get_prep_file_derivative)
+
+
+class LocalQiitaServer(object):
+    """Stand-in for the Qiita server that records the requests"""
+    def __init__(self, prep_fp):
+        self.prep_fp = prep_fp
+        self.requests = []
+        self.fetched = []
+
+    def get(self, url, **kwargs):
+        self.requests.append(url)
+        if url.startswith('/qiita_db/artifacts/'):
+            return {'type': 'FASTQ', 'prep_information': [1],
+                    'files': {'raw_forward_seqs': [
+                        {'filepath': '/data/seqs.fastq.gz', 'size': 10}]}}
+        return {'prep-file': self.prep_fp}
+
+    def fetch_file_from_central(self, filepath):
+        self.fetched.append(filepath)
+        return filepath
+
+
+def generate(prep_fp, out_fp):
+    with open(prep_fp) as f, open(out_fp, 'w') as g:
+        g.write(f.read().upper())
+
+
+class MetadataTests(TestCase):
+    def setUp(self):
+        metadata._RESPONSES.clear()
+        self._clean_up_files = []
+        self.out_dir = mkdtemp()
+        self._clean_up_files.append(self.out_dir)
+        self.prep_fp = join(self.out_dir, '1_prep_1_20170101-120000.txt')
+        with open(self.prep_fp, 'w') as f:
+            f.write('sample_name\tbarcode\n')
+        self.qclient = LocalQiitaServer(self.prep_fp)
+
+    def tearDown(self):
+        metadata._RESPONSES.clear()
+        for fp in self._clean_up_files:
+            if exists(fp):
+                if isdir(fp):
+                    rmtree(fp)
+                else:
+                    remove(fp)
+
+    def test_get_artifact_info(self):
+        obs = get_artifact_info(self.qclient, 1)
+        self.assertEqual(obs['type'], 'FASTQ')
+        # the response is reused
+        self.assertEqual(get_artifact_info(self.qclient, 1), obs)
+        self.assertEqual(self.qclient.requests, ['/qiita_db/artifacts/1/'])
+
+        get_artifact_info(self.qclient, 2)
+        self.assertEqual(self.qclient.requests, ['/qiita_db/artifacts/1/',
+                                                 '/qiita_db/artifacts/2/'])
+
+    def test_get_artifact_info_expired(self):
+        get_artifact_info(self.qclient, 1)
+        metadata._RESPONSES['/qiita_db/artifacts/1/'] = (
+            0, metadata._RESPONSES['/qiita_db/artifacts/1/'][1])
+        get_artifact_info(self.qclient, 1)
+        self.assertEqual(self.qclient.requests, ['/qiita_db/artifacts/1/',
+                                                 '/qiita_db/artifacts/1/'])
+
+    def test_get_artifact_filepaths(self):
+        self.assertEqual(get_artifact_filepaths(self.qclient, 1),
+                         {'raw_forward_seqs': ['/data/seqs.fastq.gz']})
+
+    def test_get_prep_info(self):
+        self.assertEqual(get_prep_info(self.qclient, 1),
+                         {'prep-file': self.prep_fp})
+        self.assertEqual(self.qclient.requests,
+                         ['/qiita_db/prep_template/1/'])
+
+    def test_get_prep_file_derivative(self):
+        cache_dir = join(self.out_dir, 'cache')
+        out_fp = join(self.out_dir, 'mapping.txt')
+        obs = get_prep_file_derivative(self.qclient, 1, 'upper', generate,
+                                       out_fp, cache_dir=cache_dir)
+        self.assertEqual(obs, out_fp)
+        with open(out_fp) as f:
+            self.assertEqual(f.read(), 'SAMPLE_NAME\tBARCODE\n')
+        self.assertEqual(self.qclient.fetched, [self.prep_fp])
+        self.assertEqual(len(listdir(cache_dir)), 1)
+
+        # a second job reuses the generated file
+        out_fp_2 = join(self.out_dir, 'mapping_2.txt')
+        get_prep_file_derivative(self.qclient, 1, 'upper', generate,
+                                 out_fp_2, cache_dir=cache_dir)
+        with open(out_fp_2) as f:
+            self.assertEqual(f.read(), 'SAMPLE_NAME\tBARCODE\n')
+        self.assertEqual(self.qclient.fetched, [self.prep_fp])
+
+        # unless it is too old
+        get_prep_file_derivative(self.qclient, 1, 'upper', generate,
+                                 out_fp_2, cache_dir=cache_dir, max_age=0)
+        self.assertEqual(self.qclient.fetched, [self.prep_fp, self.prep_fp])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,171 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from unittest import TestCase, main
+from os import remove
+from os.path import exists, isdir, join, getsize, getmtime
+from shutil import rmtree
+from tempfile import mkdtemp
+from zlib import crc32
+from gzip import GzipFile
+from json import loads
+
+from qp_target_gene.migration import compress_file, migrate_to_gz
+
+
+class LocalFilepathStore(object):
+    """Stand-in for the Qiita filepath table
+
+    Parameters
+    ----------
+    fps : dict of {int: str}
+        The filepaths keyed by filepath id
+    fail_on : int, optional
+        The transaction that fails, simulating an interruption
+    """
+    def __init__(self, fps, fail_on=None):
+        self.records = {fp_id: {'filepath': fp, 'checksum': None,
+                                'fp_size': None}
+                        for fp_id, fp in fps.items()}
+        self.fail_on = fail_on
+        self.transactions = []
+
+    def pending(self):
+        return sorted((fp_id, r['filepath']) for fp_id, r in
+                      self.records.items()
+                      if not r['filepath'].endswith('.gz'))
+
+    def update(self, updates):
+        if len(self.transactions) + 1 == self.fail_on:
+            self.fail_on = None
+            raise RuntimeError('The connection was lost')
+        self.transactions.append(updates)
+        for fp_id, fp, checksum, size in updates:
+            self.records[fp_id] = {'filepath': fp, 'checksum': checksum,
+                                   'fp_size': size}
+
+
+class MigrationTests(TestCase):
+    def setUp(self):
+        self._clean_up_files = []
+        self.out_dir = mkdtemp()
+        self._clean_up_files.append(self.out_dir)
+        self.journal_fp = join(self.out_dir, 'journal.txt')
+
+    def tearDown(self):
+        for fp in self._clean_up_files:
+            if exists(fp):
+                if isdir(fp):
+                    rmtree(fp)
+                else:
+                    remove(fp)
+
+    def _write_files(self, n):
+        fps = {}
+        for i in range(1, n + 1):
+            fp = join(self.out_dir, 'seqs_%d.fastq' % i)
+            with open(fp, 'w') as f:
+                f.write('@seq_%d\nACGT\n+\nIIII\n' % i * 100)
+            fps[i] = fp
+        return fps
+
+    def _checksum(self, fp):
+        with open(fp, 'rb') as f:
+            return crc32(f.read()) & 0xFFFFFFFF
+
+    def test_compress_file(self):
+        fp = self._write_files(1)[1]
+        with open(fp, 'rb') as f:
+            contents = f.read()
+
+        gz_fp, checksum, size = compress_file(fp)
+        self.assertEqual(gz_fp, fp + '.gz')
+        self.assertEqual(checksum, self._checksum(gz_fp))
+        self.assertEqual(size, getsize(gz_fp))
+        self.assertFalse(exists(gz_fp + '.tmp'))
+        # the original is kept until the database is updated
+        self.assertTrue(exists(fp))
+        with GzipFile(gz_fp) as f:
+            self.assertEqual(f.read(), contents)
+
+    def test_compress_file_error(self):
+        fp = join(self.out_dir, 'missing.fastq')
+        with self.assertRaises(IOError):
+            compress_file(fp)
+        self.assertFalse(exists(fp + '.gz.tmp'))
+        self.assertFalse(exists(fp + '.gz'))
+
+    def test_migrate_to_gz(self):
+        fps = self._write_files(5)
+        store = LocalFilepathStore(fps)
+        messages = []
+        obs = migrate_to_gz(store, self.journal_fp, threads=3, batch_size=2,
+                            progress=messages.append)
+        self.assertEqual(obs, {'compressed': 5, 'reused': 0, 'committed': 5})
+        # batched transactions
+        self.assertEqual([len(t) for t in store.transactions], [2, 2, 1])
+        self.assertEqual(messages, ['2 files committed', '4 files committed',
+                                    '5 files committed'])
+        for fp_id, fp in fps.items():
+            record = store.records[fp_id]
+            self.assertEqual(record['filepath'], fp + '.gz')
+            self.assertEqual(record['checksum'], self._checksum(fp + '.gz'))
+            self.assertEqual(record['fp_size'], getsize(fp + '.gz'))
+            self.assertFalse(exists(fp))
+
+        # nothing left to do
+        obs = migrate_to_gz(store, self.journal_fp)
+        self.assertEqual(obs, {'compressed': 0, 'reused': 0, 'committed': 0})
+        self.assertEqual(len(store.transactions), 3)
+
+    def test_migrate_to_gz_resume(self):
+        fps = self._write_files(5)
+        store = LocalFilepathStore(fps, fail_on=2)
+        with self.assertRaises(RuntimeError):
+            migrate_to_gz(store, self.journal_fp, threads=1, batch_size=2)
+        self.assertEqual(len(store.transactions), 1)
+        committed = [fp_id for fp_id, _, _, _ in store.transactions[0]]
+        with open(self.journal_fp) as f:
+            journal = [loads(line) for line in f]
+        compressed = [e['filepath_id'] for e in journal
+                      if e['filepath_id'] not in committed]
+        self.assertTrue(compressed)
+        # the records not updated still point to existing files
+        for fp_id, fp in store.pending():
+            self.assertTrue(exists(fp))
+        mtimes = {fp_id: getmtime(fps[fp_id] + '.gz') for fp_id in compressed}
+
+        obs = migrate_to_gz(store, self.journal_fp, threads=1, batch_size=2)
+        self.assertEqual(obs['reused'], len(compressed))
+        self.assertEqual(obs['compressed'] + obs['reused'], 3)
+        self.assertEqual(obs['committed'], 3)
+        self.assertEqual(store.pending(), [])
+        # the files compressed before the interruption were not compressed
+        # again
+        for fp_id, mtime in mtimes.items():
+            self.assertEqual(getmtime(fps[fp_id] + '.gz'), mtime)
+        for fp_id, fp in fps.items():
+            self.assertEqual(store.records[fp_id]['checksum'],
+                             self._checksum(fp + '.gz'))
+            self.assertFalse(exists(fp))
+
+    def test_migrate_to_gz_error(self):
+        fps = self._write_files(3)
+        missing = fps[2]
+        remove(missing)
+        store = LocalFilepathStore(fps)
+        with self.assertRaisesRegexp(ValueError, 'Error compressing 1 files'):
+            migrate_to_gz(store, self.journal_fp)
+        # the other files are still migrated
+        self.assertEqual(store.pending(), [(2, missing)])
+        self.assertEqual(store.records[1]['filepath'], fps[1] + '.gz')
+        self.assertEqual(store.records[3]['filepath'], fps[3] + '.gz')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from unittest import TestCase, main
+from os.path import isdir, exists, join
+from os import remove
+from shutil import rmtree
+from tempfile import mkdtemp
+
+import numpy.testing as npt
+from biom import load_table
+
+from qp_target_gene.otu_table import (
+    sample_id_from_read_id, parse_otu_map, build_otu_table)
+
+
+class OTUTableTests(TestCase):
+    def setUp(self):
+        self._clean_up_files = []
+        self.out_dir = mkdtemp()
+        self._clean_up_files.append(self.out_dir)
+
+        self.otu_map_fp = join(self.out_dir, 'seqs_otus.txt')
+        with open(self.otu_map_fp, 'w') as f:
+            f.write(OTU_MAP)
+        self.tax_fp = join(self.out_dir, 'tax.txt')
+        with open(self.tax_fp, 'w') as f:
+            f.write(REF_TAX)
+
+    def tearDown(self):
+        for fp in self._clean_up_files:
+            if exists(fp):
+                if isdir(fp):
+                    rmtree(fp)
+                else:
+                    remove(fp)
+
+    def test_sample_id_from_read_id(self):
+        self.assertEqual(sample_id_from_read_id('1001.SKB1_0'), '1001.SKB1')
+        self.assertEqual(sample_id_from_read_id('1.sample_a_10'),
+                         '1.sample_a')
+
+    def test_parse_otu_map(self):
+        (data, rows, cols), otu_ids, sample_ids = parse_otu_map(
+            self.otu_map_fp)
+        self.assertEqual(otu_ids, ['367523', '187144'])
+        self.assertEqual(sorted(sample_ids), ['1001.SKB1', '1001.SKB2'])
+        self.assertEqual(len(data), 3)
+        obs = {(otu_ids[r], sample_ids[c]): d
+               for d, r, c in zip(data, rows, cols)}
+        exp = {('367523', '1001.SKB1'): 2, ('367523', '1001.SKB2'): 1,
+               ('187144', '1001.SKB1'): 1}
+        self.assertEqual(obs, exp)
+
+    def test_build_otu_table(self):
+        biom_fp = join(self.out_dir, 'otu_table.biom')
+        build_otu_table(self.otu_map_fp, self.tax_fp, biom_fp)
+
+        obs = load_table(biom_fp)
+        self.assertEqual(sorted(obs.ids('observation')), ['187144', '367523'])
+        self.assertEqual(sorted(obs.ids()), ['1001.SKB1', '1001.SKB2'])
+        npt.assert_equal(obs.data('1001.SKB1', 'sample', dense=True)
+                         [obs.index('367523', 'observation')], 2)
+        self.assertEqual(obs.metadata('187144', 'observation')['taxonomy'],
+                         ['k__Bacteria', 'p__Firmicutes'])
+
+
+OTU_MAP = """367523\t1001.SKB1_0\t1001.SKB1_3\t1001.SKB2_0
+187144\t1001.SKB1_1
+"""
+
+REF_TAX = """367523\tk__Bacteria; p__Bacteroidetes
+187144\tk__Bacteria; p__Firmicutes
+836974\tk__Bacteria; p__Cyanobacteria
+"""
+
+
+if __name__ == '__main__':
+    main()
@@ -7,21 +7,22 @@
 # -----------------------------------------------------------------------------
 
 from unittest import main
-from os.path import isdir, exists, join, basename, dirname
-from os import remove, close, mkdir, makedirs
+from os.path import isdir, exists, join, basename, dirname, getmtime
+from os import remove, mkdir, makedirs
 from shutil import rmtree
-from tempfile import mkstemp, mkdtemp
+from tempfile import mkdtemp
 from json import dumps
 from functools import partial
 from glob import glob
+import gzip
 
 from qiita_client import ArtifactInfo
 from qiita_client.testing import PluginTestCase
 
 from qp_target_gene.pick_otus import (
-    write_parameters_file, generate_artifact_info,
+    generate_parameters_string, generate_artifact_info,
     generate_pick_closed_reference_otus_cmd, generate_sortmerna_tgz,
-    pick_closed_reference_otus)
+    write_log_file, generate_otu_table, pick_closed_reference_otus)
 
 CLIENT_ID = '19ndkO3oMKsoChjVVWluF7QkxHRfYhTKSFbAVt8IhK7gZgDaO4'
 CLIENT_SECRET = ('J7FfQ7CQdOxuKhQAf1eoGgBAE81Ns8Gu3EKaWFm3IO2JKh'
@@ -36,7 +37,7 @@ class PickOTUsTests(PluginTestCase):
             'reference-tax': '/databases/gg/13_8/taxonomy/97_otu_taxonomy.txt',
             "sortmerna_e_value": 1, "sortmerna_max_pos": 10000,
             "similarity": 0.97, "sortmerna_coverage": 0.97, "threads": 1,
-            "input_data": 2}
+            "previous_otu_table": "", "input_data": 2}
 
     def tearDown(self):
         for fp in self._clean_up_files:
@@ -46,16 +47,10 @@ class PickOTUsTests(PluginTestCase):
                 else:
                     remove(fp)
 
-    def test_write_parameters_file(self):
-        fd, fp = mkstemp()
-        close(fd)
-        self._clean_up_files.append(fp)
-
-        write_parameters_file(fp, self.parameters)
-
-        with open(fp, 'U') as f:
-            obs = f.read()
-        exp = EXP_PARAMS
+    def test_generate_parameters_string(self):
+        obs = generate_parameters_string(self.parameters)
+        exp = ("--sortmerna_max_pos 10000 --similarity 0.97 "
+               "--sortmerna_coverage 0.97 --threads 1")
         self.assertEqual(obs, exp)
 
     def test_generate_pick_closed_reference_otus_cmd(self):
@@ -66,14 +61,68 @@ class PickOTUsTests(PluginTestCase):
 
         obs, obs_dir = generate_pick_closed_reference_otus_cmd(
             filepaths, output_dir, self.parameters, True)
-        exp = ("pick_closed_reference_otus.py -i /directory/seqs.fna "
-               "-r /databases/gg/13_8/rep_set/97_otus.fasta -o {0}/cr_otus "
-               "-p {0}/cr_params.txt -t "
-               "/databases/gg/13_8/taxonomy/97_otu_taxonomy.txt".format(
-                  output_dir))
+        exp = ("pick_otus.py -m sortmerna -i /directory/seqs.fna "
+               "-r /databases/gg/13_8/rep_set/97_otus.fasta "
+               "-o {0}/cr_otus/sortmerna_picked_otus --sortmerna_max_pos "
+               "10000 --similarity 0.97 --sortmerna_coverage 0.97 "
+               "--threads 1".format(output_dir))
 
         self.assertEqual(obs, exp)
         self.assertEqual(obs_dir, join(output_dir, 'cr_otus'))
+        self.assertTrue(isdir(obs_dir))
+
+    def test_generate_pick_closed_reference_otus_cmd_compressed(self):
+        output_dir = mkdtemp()
+        self._clean_up_files.append(output_dir)
+        seqs_fp = join(output_dir, 'seqs.fna.gz')
+        with gzip.open(seqs_fp, 'wb') as f:
+            f.write(b'>read_1\nACGT\n')
+        filepaths = {'preprocessed_fasta': [seqs_fp]}
+
+        obs, obs_dir = generate_pick_closed_reference_otus_cmd(
+            filepaths, output_dir, self.parameters)
+        exp = ("pick_otus.py -m sortmerna -i {0}/seqs.fna "
+               "-r /databases/gg/13_8/rep_set/97_otus.fasta "
+               "-o {0}/cr_otus/sortmerna_picked_otus --sortmerna_max_pos "
+               "10000 --similarity 0.97 --sortmerna_coverage 0.97 "
+               "--threads 1".format(output_dir))
+        self.assertEqual(obs, exp)
+        with open(join(output_dir, 'seqs.fna'), 'rb') as f:
+            self.assertEqual(f.read(), b'>read_1\nACGT\n')
+
+    def test_write_log_file(self):
+        outdir = mkdtemp()
+        self._clean_up_files.append(outdir)
+
+        obs = write_log_file(outdir, 'pick_otus.py', 'some out', 'some err')
+        self.assertEqual(dirname(obs), outdir)
+        self.assertTrue(basename(obs).startswith('log_'))
+        with open(obs) as f:
+            self.assertEqual(
+                f.read(), "Command:\npick_otus.py\n\nStdout:\nsome out\n\n"
+                          "Stderr:\nsome err\n")
+
+    def test_generate_otu_table(self):
+        outdir = mkdtemp()
+        self._clean_up_files.append(outdir)
+        mkdir(join(outdir, 'sortmerna_picked_otus'))
+        with open(join(outdir, 'sortmerna_picked_otus',
+                       'seqs_otus.txt'), 'w') as f:
+            f.write(OTU_MAP)
+        tax_fp = join(outdir, 'tax.txt')
+        with open(tax_fp, 'w') as f:
+            f.write(REF_TAX)
+
+        obs = generate_otu_table(outdir, tax_fp)
+        self.assertEqual(obs, join(outdir, 'otu_table.biom'))
+        self.assertTrue(exists(obs))
+
+    def test_generate_otu_table_no_map(self):
+        outdir = mkdtemp()
+        self._clean_up_files.append(outdir)
+        mkdir(join(outdir, 'sortmerna_picked_otus'))
+        with self.assertRaises(ValueError):
+            generate_otu_table(outdir, '/tmp/tax.txt')
 
     def test_generate_sortmerna_tgz(self):
         outdir = mkdtemp()
@@ -156,12 +205,21 @@ class PickOTUsTests(PluginTestCase):
         exp_ainfo = [ArtifactInfo('OTU table', 'BIOM', fps)]
         self.assertEqual(obs_ainfo, exp_ainfo)
 
+        # re-running the job only packages the results again
+        otu_map = glob(path_builder('sortmerna_picked_otus', '*_otus.txt'))[0]
+        exp_mtime = getmtime(otu_map)
+        remove(path_builder("sortmerna_picked_otus.tgz"))
+        obs_success, obs_ainfo, obs_msg = pick_closed_reference_otus(
+            self.qclient, job_id, self.parameters, out_dir)
+        self.assertEqual(obs_msg, "")
+        self.assertTrue(obs_success)
+        self.assertEqual(obs_ainfo, exp_ainfo)
+        self.assertEqual(getmtime(otu_map), exp_mtime)
+        self.assertTrue(exists(path_builder("sortmerna_picked_otus.tgz")))
+
 
-EXP_PARAMS = """pick_otus:otu_picking_method\tsortmerna
-pick_otus:sortmerna_max_pos\t10000
-pick_otus:similarity\t0.97
-pick_otus:sortmerna_coverage\t0.97
-pick_otus:threads\t1
+OTU_MAP = """367523\t1001.SKB1_0\t1001.SKB2_3
+187144\t1001.SKB1_1\t1001.SKB1_5
 """
 
 READS = """>1001.SKB1_0 orig_bc=TAACTTGCGGAC new_bc=TAACTTGCGGAC bc_diffs=0
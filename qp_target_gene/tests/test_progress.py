@@ -0,0 +1,84 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from unittest import TestCase, main
+from threading import Event
+from time import time, sleep
+
+from qp_target_gene.progress import ProgressReporter
+
+
+class LocalQiitaServer(object):
+    """Stand-in for the Qiita server that records the job steps"""
+    def __init__(self, delay=0, fail=False):
+        self.delay = delay
+        self.fail = fail
+        self.steps = []
+        self.received = Event()
+
+    def update_job_step(self, job_id, step):
+        sleep(self.delay)
+        if self.fail:
+            raise ValueError("Server error")
+        self.steps.append((job_id, step))
+        self.received.set()
+
+
+class ProgressReporterTests(TestCase):
+    def test_update(self):
+        server = LocalQiitaServer()
+        with ProgressReporter(server, 'job', min_interval=0) as progress:
+            progress.update('Step 1 of 2')
+            server.received.wait(5)
+        self.assertEqual(server.steps, [('job', 'Step 1 of 2')])
+
+    def test_update_slow_server(self):
+        server = LocalQiitaServer(delay=0.5)
+        start = time()
+        with ProgressReporter(server, 'job', min_interval=0) as progress:
+            for i in range(100):
+                progress.update('Step 1 of 2 (%d of 100)' % i)
+            # the pipeline is not stalled by the server
+            self.assertLess(time() - start, 0.5)
+            progress.update('Step 2 of 2')
+        # the intermediate steps are coalesced and the last one is sent
+        self.assertLess(len(server.steps), 3)
+        self.assertEqual(server.steps[-1], ('job', 'Step 2 of 2'))
+
+    def test_update_rate(self):
+        server = LocalQiitaServer()
+        with ProgressReporter(server, 'job', min_interval=10) as progress:
+            progress.update('Step 1 of 3')
+            server.received.wait(5)
+            progress.update('Step 2 of 3')
+            progress.update('Step 3 of 3')
+            sleep(0.2)
+            # the rest of the steps wait for the interval to pass
+            self.assertEqual(server.steps, [('job', 'Step 1 of 3')])
+        self.assertEqual(server.steps, [('job', 'Step 1 of 3'),
+                                        ('job', 'Step 3 of 3')])
+
+    def test_update_server_error(self):
+        server = LocalQiitaServer(fail=True)
+        with ProgressReporter(server, 'job', min_interval=0) as progress:
+            progress.update('Step 1 of 2')
+            progress.update('Step 2 of 2')
+        self.assertEqual(server.steps, [])
+
+    def test_close_timeout(self):
+        server = LocalQiitaServer(delay=5)
+        progress = ProgressReporter(server, 'job', min_interval=0,
+                                    close_timeout=0.1)
+        progress.update('Step 1 of 2')
+        start = time()
+        progress.close()
+        self.assertLess(time() - start, 1)
+
+
+if __name__ == '__main__':
+    main()
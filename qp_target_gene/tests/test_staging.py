@@ -0,0 +1,227 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from unittest import TestCase, main
+from os import environ, remove, makedirs, utime
+from os.path import exists, isdir, join
+from time import time
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from qiita_client import ArtifactInfo
+
+from qp_target_gene import metadata
+from qp_target_gene.manifest import (
+    MANIFEST_FILENAME, Manifest, write_manifests)
+from qp_target_gene.metadata import get_artifact_filepaths
+from qp_target_gene.staging import (
+    STAGED_INPUTS_DIR, HEARTBEAT_FILENAME, copy_atomically, Stage,
+    local_filepath, staged_command, sweep_scratch_dir)
+
+
+class LocalQiitaServer(object):
+    """Stand-in for the Qiita server, serving a single artifact"""
+    def __init__(self, seqs_fp):
+        self.seqs_fp = seqs_fp
+
+    def get(self, url, **kwargs):
+        return {'type': 'FASTQ', 'prep_information': [1],
+                'files': {'raw_forward_seqs': [
+                    {'filepath': self.seqs_fp, 'size': 10}]}}
+
+
+class StagingTests(TestCase):
+    def setUp(self):
+        metadata._RESPONSES.clear()
+        self._clean_up_files = []
+        self._environ = environ.get('QP_TARGET_GENE_CONFIG_FP')
+        self.base_dir = mkdtemp()
+        self._clean_up_files.append(self.base_dir)
+        self.nfs_dir = join(self.base_dir, 'nfs')
+        self.scratch_dir = join(self.base_dir, 'scratch')
+        self.out_dir = join(self.base_dir, 'nfs', 'job')
+        makedirs(self.out_dir)
+        self.seqs_fp = join(self.nfs_dir, 'seqs.fastq')
+        with open(self.seqs_fp, 'w') as f:
+            f.write('@read_1\nACGT\n+\nIIII\n')
+        self.qclient = LocalQiitaServer(self.seqs_fp)
+
+        self.config_fp = join(self.base_dir, 'config.cfg')
+        with open(self.config_fp, 'w') as f:
+            f.write('[staging]\nSCRATCH_DIR = %s\nCOPY_THREADS = 2\n'
+                    % self.scratch_dir)
+
+    def tearDown(self):
+        metadata._RESPONSES.clear()
+        if self._environ is None:
+            environ.pop('QP_TARGET_GENE_CONFIG_FP', None)
+        else:
+            environ['QP_TARGET_GENE_CONFIG_FP'] = self._environ
+        for fp in self._clean_up_files:
+            if exists(fp):
+                if isdir(fp):
+                    rmtree(fp)
+                else:
+                    remove(fp)
+
+    def test_copy_atomically(self):
+        dst = join(self.base_dir, 'a', 'b', 'seqs.fastq')
+        self.assertEqual(copy_atomically(self.seqs_fp, dst), dst)
+        with open(dst) as f:
+            self.assertEqual(f.read(), '@read_1\nACGT\n+\nIIII\n')
+        self.assertFalse(exists(dst + '.tmp'))
+
+        # up to date copies are not copied again
+        with open(dst, 'w') as f:
+            f.write('@read_2\nTGCA\n+\nIIII\n')
+        utime(dst, (0, 0))
+        utime(self.seqs_fp, (0, 0))
+        copy_atomically(self.seqs_fp, dst)
+        with open(dst) as f:
+            self.assertEqual(f.read(), '@read_2\nTGCA\n+\nIIII\n')
+
+        # directories replace the previous copy
+        dst = join(self.base_dir, 'copy')
+        makedirs(join(dst, 'old'))
+        copy_atomically(self.nfs_dir, dst)
+        self.assertTrue(exists(join(dst, 'seqs.fastq')))
+        self.assertFalse(exists(join(dst, 'old')))
+
+    def test_stage(self):
+        stage = Stage(join(self.scratch_dir, '1'), 2)
+        stage.prefetch({'raw_forward_seqs': [self.seqs_fp,
+                                             '/does/not/exist.fastq']})
+        exp = join(self.scratch_dir, '1', STAGED_INPUTS_DIR,
+                   'raw_forward_seqs', 'seqs.fastq')
+        self.assertEqual(stage.local_filepath(self.seqs_fp), exp)
+        self.assertTrue(exists(exp))
+        self.assertEqual(stage.local_filepath('/does/not/exist.fastq'),
+                         '/does/not/exist.fastq')
+
+        makedirs(join(stage.job_dir, 'sl_out'))
+        demux_fp = join(stage.job_dir, 'sl_out', 'seqs.demux')
+        with open(demux_fp, 'w') as f:
+            f.write('demux')
+        ainfo = [ArtifactInfo('demultiplexed', 'Demultiplexed',
+                              [(demux_fp, 'preprocessed_demux'),
+                               (self.seqs_fp, 'raw_forward_seqs')])]
+        obs = stage.publish_artifacts(ainfo, self.out_dir)
+        self.assertTrue(exists(join(stage.job_dir, HEARTBEAT_FILENAME)))
+        stage.close()
+        self.assertEqual(obs, [ArtifactInfo(
+            'demultiplexed', 'Demultiplexed',
+            [(join(self.out_dir, 'sl_out', 'seqs.demux'),
+              'preprocessed_demux'),
+             (self.seqs_fp, 'raw_forward_seqs')])])
+        self.assertTrue(exists(join(self.out_dir, 'sl_out', 'seqs.demux')))
+
+    def test_sweep_scratch_dir(self):
+        self.assertEqual(sweep_scratch_dir(self.scratch_dir, 1), [])
+
+        old = time() - 7200
+        old_dir = join(self.scratch_dir, 'old-job')
+        new_dir = join(self.scratch_dir, 'new-job')
+        running_dir = join(self.scratch_dir, 'running-job')
+        for job_dir in (old_dir, new_dir, running_dir):
+            makedirs(join(job_dir, 'sl_out'))
+            fp = join(job_dir, 'sl_out', 'seqs.fna')
+            with open(fp, 'w') as f:
+                f.write('>read_1\nACGT\n')
+            if job_dir != new_dir:
+                utime(fp, (old, old))
+                utime(join(job_dir, 'sl_out'), (old, old))
+                utime(job_dir, (old, old))
+        with open(join(self.scratch_dir, 'file.txt'), 'w') as f:
+            f.write('file')
+        # the running jobs touch their heartbeat file
+        with open(join(running_dir, HEARTBEAT_FILENAME), 'w') as f:
+            f.write('')
+        utime(running_dir, (old, old))
+
+        self.assertEqual(sweep_scratch_dir(self.scratch_dir, 1), [old_dir])
+        self.assertFalse(exists(old_dir))
+        self.assertTrue(exists(new_dir))
+        self.assertTrue(exists(running_dir))
+        self.assertTrue(exists(join(self.scratch_dir, 'file.txt')))
+
+    def test_staged_command(self):
+        calls = []
+
+        @staged_command
+        def command(qclient, job_id, parameters, out_dir):
+            fps = get_artifact_filepaths(qclient, parameters['input_data'])
+            calls.append((out_dir, fps['raw_forward_seqs']))
+            for d in ('logs', 'mappings'):
+                if not exists(join(out_dir, d)):
+                    makedirs(join(out_dir, d))
+            demux_fp = join(out_dir, 'seqs.demux')
+            with Manifest(out_dir) as manifest, \
+                    manifest.open(demux_fp) as f:
+                f.write(b'contents')
+            for fp in (join(out_dir, 'logs', 'stdout.log'),
+                       join(out_dir, 'mappings', 'map.txt')):
+                with open(fp, 'w') as f:
+                    f.write('contents')
+            if parameters['fail']:
+                return False, None, 'failed'
+            ainfo = [ArtifactInfo('demultiplexed', 'Demultiplexed',
+                                  [(demux_fp, 'preprocessed_demux')])]
+            write_manifests(ainfo)
+            return True, ainfo, ''
+
+        exp = (True, [ArtifactInfo(
+            'demultiplexed', 'Demultiplexed',
+            [(join(self.out_dir, 'seqs.demux'), 'preprocessed_demux')])], '')
+
+        # without scratch directory the command runs in the output directory
+        environ.pop('QP_TARGET_GENE_CONFIG_FP', None)
+        obs = command(self.qclient, 'job-id',
+                      {'input_data': 1, 'fail': False}, self.out_dir)
+        self.assertEqual(obs, exp)
+        self.assertEqual(calls, [(self.out_dir, [self.seqs_fp])])
+        rmtree(self.out_dir)
+        makedirs(self.out_dir)
+
+        environ['QP_TARGET_GENE_CONFIG_FP'] = self.config_fp
+        job_dir = join(self.scratch_dir, 'job-id')
+        obs = command(self.qclient, 'job-id',
+                      {'input_data': 1, 'fail': False}, self.out_dir)
+        self.assertEqual(obs, exp)
+        self.assertEqual(calls[1], (job_dir, [join(
+            job_dir, STAGED_INPUTS_DIR, 'raw_forward_seqs', 'seqs.fastq')]))
+        self.assertTrue(exists(join(self.out_dir, 'seqs.demux')))
+        self.assertTrue(exists(join(self.out_dir, MANIFEST_FILENAME)))
+        self.assertTrue(exists(join(self.out_dir, 'logs', 'stdout.log')))
+        # the intermediates are removed with the scratch directory
+        self.assertFalse(exists(join(self.out_dir, 'mappings')))
+        self.assertFalse(exists(job_dir))
+        self.assertEqual(local_filepath(self.seqs_fp), self.seqs_fp)
+
+        # failed jobs publish their logs and keep their scratch directory
+        rmtree(self.out_dir)
+        makedirs(self.out_dir)
+        obs = command(self.qclient, 'job-id',
+                      {'input_data': 1, 'fail': True}, self.out_dir)
+        self.assertEqual(obs, (False, None, 'failed'))
+        self.assertTrue(exists(join(self.out_dir, 'logs', 'stdout.log')))
+        self.assertFalse(exists(join(self.out_dir, 'seqs.demux')))
+        self.assertTrue(exists(join(job_dir, 'seqs.demux')))
+
+        # the directories left by killed jobs are removed, and re-running
+        # the failed job removes its directory once it succeeds
+        old_dir = join(self.scratch_dir, 'killed-job-id')
+        makedirs(old_dir)
+        utime(old_dir, (0, 0))
+        command(self.qclient, 'job-id', {'input_data': 1, 'fail': False},
+                self.out_dir)
+        self.assertFalse(exists(old_dir))
+        self.assertFalse(exists(job_dir))
+
+
+if __name__ == '__main__':
+    main()
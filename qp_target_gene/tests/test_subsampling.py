@@ -0,0 +1,166 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from unittest import main
+from os.path import isdir, exists, join
+from os import remove, close
+from shutil import rmtree, copyfile
+from tempfile import mkstemp, mkdtemp
+from json import dumps
+from functools import partial
+
+import numpy as np
+from qiita_client import ArtifactInfo
+from qiita_client.testing import PluginTestCase
+
+from qp_target_gene.subsampling import (
+    subsampling, generate_subsampling, sample_random_state,
+    hypergeometric_masks, reservoir_sample)
+from qp_target_gene import plugin
+
+
+class SubsamplingTest(PluginTestCase):
+    def setUp(self):
+        plugin("https://localhost:21174", 'register', 'ignored')
+        self._clean_up_files = []
+
+    def tearDown(self):
+        for fp in self._clean_up_files:
+            if exists(fp):
+                if isdir(fp):
+                    rmtree(fp)
+                else:
+                    remove(fp)
+
+    def _read_ids(self, fp):
+        with open(fp) as f:
+            return [line.split()[0][1:] for line in f
+                    if line.startswith('>')]
+
+    def test_sample_random_state(self):
+        obs = sample_random_state(0, '1.SKB7.640196').randint(0, 10 ** 6, 5)
+        exp = sample_random_state(0, '1.SKB7.640196').randint(0, 10 ** 6, 5)
+        np.testing.assert_equal(obs, exp)
+        other = sample_random_state(1, '1.SKB7.640196').randint(0, 10 ** 6, 5)
+        self.assertFalse(np.array_equal(obs, other))
+        other = sample_random_state(0, '1.SKB8.640193').randint(0, 10 ** 6, 5)
+        self.assertFalse(np.array_equal(obs, other))
+
+    def test_hypergeometric_masks(self):
+        rng = np.random.RandomState(0)
+        masks = list(hypergeometric_masks(rng, 1050, 100, chunk_size=100))
+        self.assertEqual([len(m) for m in masks], [100] * 10 + [50])
+        self.assertEqual(sum(m.sum() for m in masks), 100)
+
+        # all the reads
+        masks = list(hypergeometric_masks(rng, 30, 30, chunk_size=7))
+        self.assertTrue(all(m.all() for m in masks))
+
+    def test_reservoir_sample(self):
+        obs = reservoir_sample(np.random.RandomState(0), range(1000), 10)
+        self.assertEqual(len(obs), 10)
+        self.assertEqual(obs, sorted(obs))
+        self.assertEqual(
+            obs, reservoir_sample(np.random.RandomState(0), range(1000), 10))
+        self.assertEqual(
+            reservoir_sample(np.random.RandomState(0), range(5), 10),
+            [0, 1, 2, 3, 4])
+
+    def test_generate_subsampling(self):
+        fd, fp = mkstemp(suffix='_seqs.demux', prefix=self.base_data_dir)
+        close(fd)
+        self._clean_up_files.append(fp)
+        copyfile('support_files/filtered_5_seqs.demux', fp)
+        fp = self.qclient.push_file_to_central(fp)
+
+        for method in ('hypergeometric', 'reservoir'):
+            params = {'depth': 100, 'method': method, 'seed': 7}
+            out_dir = mkdtemp()
+            self._clean_up_files.append(out_dir)
+            self.assertEqual(generate_subsampling([fp], out_dir, params), 200)
+            obs = self._read_ids(join(out_dir, 'seqs.fna'))
+            self.assertEqual(len(obs), 200)
+            self.assertEqual(len(set(obs)), 200)
+            for sample in ('1.SKB7.640196', '1.SKB8.640193'):
+                idx = [int(i.rsplit('_', 1)[1]) for i in obs
+                       if i.startswith(sample)]
+                self.assertEqual(len(idx), 100)
+                # the original order is kept
+                self.assertEqual(idx, sorted(idx))
+            with open(join(out_dir, 'seqs.fastq')) as f:
+                self.assertEqual(len(f.readlines()), 800)
+
+            # the same seed keeps the same reads
+            out_dir_2 = mkdtemp()
+            self._clean_up_files.append(out_dir_2)
+            generate_subsampling([fp], out_dir_2, params)
+            self.assertEqual(self._read_ids(join(out_dir_2, 'seqs.fna')), obs)
+
+        # the samples with fewer reads are kept whole
+        params = {'depth': 16000, 'method': 'hypergeometric', 'seed': 7}
+        self.assertEqual(generate_subsampling([fp], out_dir, params),
+                         15213 + 16000)
+
+    def test_generate_subsampling_error(self):
+        out_dir = mkdtemp()
+        self._clean_up_files.append(out_dir)
+        with self.assertRaisesRegexp(ValueError, 'Unknown subsampling'):
+            generate_subsampling(
+                [], out_dir, {'depth': 10, 'method': 'rarefy', 'seed': 0})
+        with self.assertRaisesRegexp(ValueError, 'positive'):
+            generate_subsampling(
+                [], out_dir, {'depth': 0, 'method': 'reservoir', 'seed': 0})
+
+    def test_subsampling(self):
+        fd, fp = mkstemp(suffix='_seqs.demux')
+        close(fd)
+        self._clean_up_files.append(fp)
+        copyfile('support_files/filtered_5_seqs.demux', fp)
+
+        prep_info_dict = {
+            'SKB7.640196': {'description_for_test': 'SKB7'},
+            'SKB8.640193': {'description_for_test': 'SKB8'}
+        }
+        data = {'prep_info': dumps(prep_info_dict),
+                'study': 1,
+                'data_type': '16S'}
+        pid = self.qclient.post('/apitest/prep_template/', data=data)['prep']
+
+        data = {
+            'filepaths': dumps([(fp, 'preprocessed_demux')]),
+            'type': "Demultiplexed",
+            'name': "New demultiplexed artifact",
+            'prep': pid}
+        aid = self.qclient.post('/apitest/artifact/', data=data)['artifact']
+
+        params = {'input_data': aid, 'depth': 1000,
+                  'method': 'hypergeometric', 'seed': 0}
+        data = {'user': 'demo@microbio.me',
+                'command': dumps(['QIIMEq2', '1.9.2', 'Subsampling']),
+                'status': 'running', 'parameters': dumps(params)}
+        jid = self.qclient.post('/apitest/processing_job/', data=data)['job']
+
+        out_dir = mkdtemp()
+        self._clean_up_files.append(out_dir)
+
+        success, ainfo, msg = subsampling(self.qclient, jid, params, out_dir)
+        self.assertTrue(success)
+        pb = partial(join, out_dir)
+        exp_ainfo = [
+            ArtifactInfo(
+                'Subsampled Demultiplexed', 'Demultiplexed',
+                [(pb('seqs.fna'), 'preprocessed_fasta'),
+                 (pb('seqs.fastq'), 'preprocessed_fastq'),
+                 (pb('seqs.demux'), 'preprocessed_demux'),
+                 (pb('seqs.demux.index.json'), 'log')])]
+        self.assertEqual(ainfo, exp_ainfo)
+        self.assertEqual(msg, "")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from unittest import TestCase, main
+from os.path import isdir, exists, join
+from os import remove, listdir, stat
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from qp_target_gene.taxonomy import (
+    parse_taxonomy, split_lineage, build_taxonomy_index, TaxonomyIndex,
+    get_taxonomy_index)
+
+
+class TaxonomyTests(TestCase):
+    def setUp(self):
+        self._clean_up_files = []
+        self.out_dir = mkdtemp()
+        self._clean_up_files.append(self.out_dir)
+
+        self.tax_fp = join(self.out_dir, 'tax.txt')
+        with open(self.tax_fp, 'w') as f:
+            f.write(REF_TAX)
+
+    def tearDown(self):
+        for fp in self._clean_up_files:
+            if exists(fp):
+                if isdir(fp):
+                    rmtree(fp)
+                else:
+                    remove(fp)
+
+    def test_parse_taxonomy(self):
+        obs = list(parse_taxonomy(self.tax_fp))
+        exp = [('367523', 'k__Bacteria; p__Bacteroidetes'),
+               ('187144', 'k__Bacteria; p__Firmicutes'),
+               ('836974', 'k__Bacteria; p__Cyanobacteria'),
+               ('310669', 'k__Bacteria; p__Firmicutes')]
+        self.assertEqual(obs, exp)
+
+    def test_split_lineage(self):
+        self.assertEqual(split_lineage('k__Bacteria; p__Firmicutes'),
+                         ['k__Bacteria', 'p__Firmicutes'])
+
+    def test_build_taxonomy_index(self):
+        index_dir = join(self.out_dir, 'index')
+        build_taxonomy_index(self.tax_fp, index_dir)
+        self.assertEqual(sorted(listdir(index_dir)),
+                         ['ids.npy', 'lineage_idx.npy', 'lineages.npy',
+                          'offsets.npy'])
+
+        obs = TaxonomyIndex(index_dir)
+        self.assertEqual(len(obs), 4)
+        self.assertTrue('310669' in obs)
+        self.assertFalse('1' in obs)
+        self.assertEqual(obs['310669'], ['k__Bacteria', 'p__Firmicutes'])
+        self.assertEqual(obs['367523'], ['k__Bacteria', 'p__Bacteroidetes'])
+        self.assertIsNone(obs.get('1'))
+        self.assertEqual(obs.get('1', ['Unassigned']), ['Unassigned'])
+        with self.assertRaises(KeyError):
+            obs['1']
+        # shared lineages are only stored once
+        self.assertEqual(len(obs._offsets), 4)
+
+    def test_get_taxonomy_index(self):
+        cache_dir = join(self.out_dir, 'cache')
+        obs = get_taxonomy_index(self.tax_fp, cache_dir)
+        self.assertEqual(len(listdir(cache_dir)), 1)
+        self.assertEqual(obs['187144'], ['k__Bacteria', 'p__Firmicutes'])
+        # the index is only built once
+        self.assertIs(get_taxonomy_index(self.tax_fp, cache_dir), obs)
+        self.assertEqual(len(listdir(cache_dir)), 1)
+
+        # the index can be read, and the cache written, by every user
+        index_dir = join(cache_dir, listdir(cache_dir)[0])
+        self.assertEqual(stat(cache_dir).st_mode & 0o7777, 0o1777)
+        self.assertEqual(stat(index_dir).st_mode & 0o777, 0o755)
+        self.assertEqual(stat(join(index_dir, 'ids.npy')).st_mode & 0o777,
+                         0o644)
+
+    def test_get_taxonomy_index_error(self):
+        cache_dir = join(self.out_dir, 'cache')
+        with open(self.tax_fp, 'a') as f:
+            f.write('no lineage\n')
+        with self.assertRaises(ValueError):
+            get_taxonomy_index(self.tax_fp, cache_dir)
+        # the incomplete index is removed
+        self.assertEqual(listdir(cache_dir), [])
+
+
+REF_TAX = """367523\tk__Bacteria; p__Bacteroidetes
+187144\tk__Bacteria; p__Firmicutes
+836974\tk__Bacteria; p__Cyanobacteria
+310669\tk__Bacteria; p__Firmicutes
+"""
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from unittest import TestCase, main
+from os import environ, remove, close
+from os.path import exists, isdir, join
+from shutil import rmtree
+from tempfile import mkdtemp, mkstemp
+from json import load
+
+from qiita_client import ArtifactInfo
+
+from qp_target_gene.timing import Timings, count_demux_reads
+
+
+class TimingsTests(TestCase):
+    def setUp(self):
+        self._clean_up_files = []
+        self._environ = environ.get('QP_TARGET_GENE_CONFIG_FP')
+        self.out_dir = mkdtemp()
+        self._clean_up_files.append(self.out_dir)
+        self.fp = join(self.out_dir, 'timings.json')
+
+    def tearDown(self):
+        if self._environ is None:
+            environ.pop('QP_TARGET_GENE_CONFIG_FP', None)
+        else:
+            environ['QP_TARGET_GENE_CONFIG_FP'] = self._environ
+        for fp in self._clean_up_files:
+            if exists(fp):
+                if isdir(fp):
+                    rmtree(fp)
+                else:
+                    remove(fp)
+
+    def test_count_demux_reads(self):
+        self.assertEqual(
+            count_demux_reads('support_files/filtered_5_seqs.demux'), 31448)
+
+    def test_timings(self):
+        with Timings(self.fp) as timings:
+            timings.start('Step 1')
+            timings.add_reads(10)
+            timings.add_reads(5)
+            timings.start('Step 2')
+            obs = timings.run_command('echo test', self.out_dir)
+            self.assertEqual(obs.return_value, 0)
+
+        with open(self.fp) as f:
+            obs = load(f)
+        self.assertEqual([s['name'] for s in obs['stages']],
+                         ['Step 1', 'Step 2'])
+        step1, step2 = obs['stages']
+        self.assertEqual(step1['reads'], 15)
+        self.assertEqual(step1['subprocesses'], [])
+        self.assertIsNone(step2['reads'])
+        self.assertEqual(len(step2['subprocesses']), 1)
+        self.assertEqual(step2['subprocesses'][0]['command'], 'echo test')
+        self.assertEqual(step2['subprocesses'][0]['return_value'], 0)
+        self.assertGreater(step2['subprocesses'][0]['peak_rss'], 0)
+        for key in ['wall_time', 'cpu_time', 'children_cpu_time',
+                    'peak_rss', 'children_read_bytes',
+                    'children_write_bytes']:
+            self.assertGreaterEqual(step1[key], 0)
+            self.assertGreaterEqual(obs['total'][key], step1[key])
+        self.assertGreater(step1['peak_rss'], 0)
+
+    def test_timings_error(self):
+        with self.assertRaises(ValueError):
+            with Timings(self.fp) as timings:
+                timings.start('Step 1')
+                raise ValueError('Failed')
+
+        with open(self.fp) as f:
+            obs = load(f)
+        self.assertEqual([s['name'] for s in obs['stages']], ['Step 1'])
+
+    def test_attach(self):
+        artifacts_info = [ArtifactInfo('OTU table', 'BIOM',
+                                       [('/tmp/otu_table.biom', 'biom')])]
+        timings = Timings(self.fp)
+        environ.pop('QP_TARGET_GENE_CONFIG_FP', None)
+        timings.attach(artifacts_info)
+        self.assertEqual(artifacts_info[0].files,
+                         [('/tmp/otu_table.biom', 'biom')])
+
+        fd, fp = mkstemp(suffix='.cfg')
+        close(fd)
+        self._clean_up_files.append(fp)
+        with open(fp, 'w') as f:
+            f.write("[timings]\nATTACH_TO_LOG = True\n")
+        environ['QP_TARGET_GENE_CONFIG_FP'] = fp
+        timings.attach(artifacts_info)
+        self.assertEqual(artifacts_info[0].files,
+                         [('/tmp/otu_table.biom', 'biom'), (self.fp, 'log')])
+
+
+if __name__ == '__main__':
+    main()
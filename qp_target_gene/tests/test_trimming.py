@@ -14,10 +14,16 @@ from tempfile import mkstemp, mkdtemp
 from json import dumps
 from functools import partial
 
+import numpy as np
+import numpy.testing as npt
+
 from qiita_client import ArtifactInfo
 from qiita_client.testing import PluginTestCase
 
-from qp_target_gene.trimming import (trimming, generate_trimming)
+from qp_target_gene.trimming import (
+    trimming, generate_trimming, multi_length_trimming,
+    generate_multi_length_trimming, parse_lengths, quality_trimming,
+    generate_quality_trimming, quality_trim_lengths)
 from qp_target_gene import plugin
 
 
@@ -77,7 +83,8 @@ class TrimmingTest(PluginTestCase):
                 'Trimmed Demultiplexed', 'Demultiplexed',
                 [(pb('seqs.fna'), 'preprocessed_fasta'),
                  (pb('seqs.fastq'), 'preprocessed_fastq'),
-                 (pb('seqs.demux'), 'preprocessed_demux')])]
+                 (pb('seqs.demux'), 'preprocessed_demux'),
+                 (pb('seqs.demux.index.json'), 'log')])]
         self.assertEqual(ainfo, exp_ainfo)
         self.assertEqual(msg, "")
 
@@ -139,6 +146,247 @@ class TrimmingTest(PluginTestCase):
         self.assertEqual(fr, efr)
         self.assertEqual(qr, eqr)
 
+    def test_multi_length_trimming(self):
+        fd, fp = mkstemp(suffix='_seqs.demux')
+        close(fd)
+        self._clean_up_files.append(fp)
+        copyfile('support_files/filtered_5_seqs.demux', fp)
+
+        prep_info_dict = {
+            'SKB7.640196': {'description_for_test': 'SKB7'},
+            'SKB8.640193': {'description_for_test': 'SKB8'}
+        }
+        data = {'prep_info': dumps(prep_info_dict),
+                'study': 1,
+                'data_type': '16S'}
+        pid = self.qclient.post('/apitest/prep_template/', data=data)['prep']
+
+        data = {
+            'filepaths': dumps([(fp, 'preprocessed_demux')]),
+            'type': "Demultiplexed",
+            'name': "New demultiplexed artifact",
+            'prep': pid}
+        aid = self.qclient.post('/apitest/artifact/', data=data)['artifact']
+
+        params = {'input_data': aid, 'lengths': '150,90'}
+        data = {'user': 'demo@microbio.me',
+                'command': dumps(['QIIMEq2', '1.9.2',
+                                  'Multi-length trimming']),
+                'status': 'running', 'parameters': dumps(params)}
+        jid = self.qclient.post('/apitest/processing_job/', data=data)['job']
+
+        out_dir = mkdtemp()
+        self._clean_up_files.append(out_dir)
+
+        success, ainfo, msg = multi_length_trimming(
+            self.qclient, jid, params, out_dir)
+        self.assertTrue(success)
+        exp_ainfo = []
+        for length in (90, 150):
+            pb = partial(join, out_dir, '%dbp' % length)
+            exp_ainfo.append(ArtifactInfo(
+                'Trimmed Demultiplexed %dbp' % length, 'Demultiplexed',
+                [(pb('seqs.fna'), 'preprocessed_fasta'),
+                 (pb('seqs.fastq'), 'preprocessed_fastq'),
+                 (pb('seqs.demux'), 'preprocessed_demux'),
+                 (pb('seqs.demux.index.json'), 'log')]))
+        self.assertEqual(ainfo, exp_ainfo)
+        self.assertEqual(msg, "")
+
+        params['lengths'] = '75'
+        success, ainfo, msg = multi_length_trimming(
+            self.qclient, jid, params, out_dir)
+        self.assertFalse(success)
+        self.assertIsNone(ainfo)
+        self.assertEqual(msg, "Not supported lengths: 75. Please, choose "
+                              "from 90, 100, 150")
+
+    def test_generate_multi_length_trimming(self):
+        fd, fp = mkstemp(suffix='_seqs.demux', prefix=self.base_data_dir)
+        close(fd)
+        self._clean_up_files.append(fp)
+        # this file has all its seqs at 50bps, except 1
+        copyfile('support_files/filtered_5_seqs_50bps.demux', fp)
+        fp = self.qclient.push_file_to_central(fp)
+
+        out_dirs = {}
+        for length in (10, 51):
+            out_dirs[length] = mkdtemp()
+            self._clean_up_files.append(out_dirs[length])
+        generate_multi_length_trimming([fp], out_dirs)
+
+        # each output matches the one of its own trimming
+        for length, out_dir in out_dirs.items():
+            exp_dir = mkdtemp()
+            self._clean_up_files.append(exp_dir)
+            generate_trimming([fp], exp_dir, {'length': length})
+            for fname in ('seqs.fna', 'seqs.fastq'):
+                with open(join(out_dir, fname)) as f:
+                    obs = f.read()
+                with open(join(exp_dir, fname)) as f:
+                    self.assertEqual(obs, f.read())
+
+        with open(join(out_dirs[51], 'seqs.fna')) as f:
+            self.assertEqual(len(f.readlines()), 2)
+
+    def test_parse_lengths(self):
+        self.assertEqual(parse_lengths('150, 90,100,90'), [90, 100, 150])
+        self.assertEqual(parse_lengths(100), [100])
+        with self.assertRaisesRegexp(ValueError, 'comma-separated'):
+            parse_lengths('90,long')
+        with self.assertRaisesRegexp(ValueError, 'No length'):
+            parse_lengths(' ')
+        with self.assertRaisesRegexp(ValueError, 'Not supported lengths: 75'):
+            parse_lengths('75,90')
+
+    def test_quality_trim_lengths_sliding_window(self):
+        quals = np.array([[30, 30, 30, 30, 30, 30, 30, 30],
+                          [30, 30, 30, 10, 10, 30, 30, 30],
+                          [30, 30, 30, 30, 30, 2, 0, 0],
+                          [10, 30, 30, 0, 0, 0, 0, 0],
+                          [5, 5, 5, 5, 5, 5, 5, 5]])
+        lengths = np.array([8, 8, 6, 3, 8])
+        obs = quality_trim_lengths(quals, lengths, 20, window=3)
+        # the 3rd read's last window is 30, 30, 2, the padding is ignored
+        npt.assert_equal(obs, [8, 2, 6, 3, 0])
+
+        # a window wider than the reads
+        npt.assert_equal(quality_trim_lengths(quals, lengths, 20, window=9),
+                         lengths)
+
+    def test_quality_trim_lengths_first_low_quality(self):
+        quals = np.array([[30, 30, 30, 30],
+                          [30, 2, 30, 30],
+                          [30, 30, 30, 0]])
+        lengths = np.array([4, 4, 3])
+        obs = quality_trim_lengths(quals, lengths, 3,
+                                   method='first_low_quality')
+        npt.assert_equal(obs, [4, 1, 3])
+
+    def test_quality_trim_lengths_matches_loop(self):
+        rng = np.random.RandomState(0)
+        quals = rng.randint(0, 41, (200, 50))
+        lengths = rng.randint(0, 51, 200)
+
+        def loop(qual, length, q, w):
+            for i in range(0, length - w + 1):
+                if np.mean(qual[i:i + w]) < q:
+                    return i
+            return length
+
+        exp = [loop(qual, length, 20, 5)
+               for qual, length in zip(quals, lengths)]
+        npt.assert_equal(quality_trim_lengths(quals, lengths, 20, window=5),
+                         exp)
+
+    def test_quality_trim_lengths_error(self):
+        with self.assertRaisesRegexp(ValueError, 'Unknown quality trimming'):
+            quality_trim_lengths(np.zeros((1, 1)), np.ones(1), 20,
+                                 method='maxinfo')
+
+    def test_generate_quality_trimming(self):
+        fd, fp = mkstemp(suffix='_seqs.demux', prefix=self.base_data_dir)
+        close(fd)
+        self._clean_up_files.append(fp)
+        copyfile('support_files/filtered_5_seqs.demux', fp)
+        fp = self.qclient.push_file_to_central(fp)
+
+        out_dir = mkdtemp()
+        self._clean_up_files.append(out_dir)
+        params = {'method': 'sliding_window', 'min_quality': 30, 'window': 4,
+                  'min_length': 100, 'max_ambig': 6, 'max_homopolymer': 6,
+                  'truncate_ambi_bases': False}
+        generate_quality_trimming([fp], out_dir, params)
+
+        pd = partial(join, out_dir)
+        with open(pd('seqs.fastq')) as qfh:
+            qr = qfh.readlines()
+        self.assertTrue(qr)
+        # checking the first reads, the loop is slow
+        for i in range(0, min(len(qr), 4000), 4):
+            seq = qr[i + 1].strip()
+            qual = np.array([ord(c) - 33 for c in qr[i + 3].strip()])
+            self.assertGreaterEqual(len(seq), 100)
+            self.assertEqual(len(seq), len(qual))
+            windows = [qual[j:j + 4].mean() for j in range(len(qual) - 3)]
+            self.assertGreaterEqual(min(windows), 30)
+
+    def test_generate_quality_trimming_filters(self):
+        fd, fp = mkstemp(suffix='_seqs.demux')
+        close(fd)
+        self._clean_up_files.append(fp)
+        copyfile('support_files/filtered_5_seqs.demux', fp)
+
+        params = {'method': 'first_low_quality', 'min_quality': 0,
+                  'window': 4, 'min_length': 1, 'max_ambig': 6,
+                  'max_homopolymer': 100, 'truncate_ambi_bases': False}
+        out_dir = mkdtemp()
+        self._clean_up_files.append(out_dir)
+        generate_quality_trimming([fp], out_dir, params)
+        with open(join(out_dir, 'seqs.fna')) as f:
+            seqs = f.readlines()[1::2]
+        self.assertEqual(len(seqs), 31448)
+
+        # the reads with homopolymers longer than 6 bases are discarded
+        params['max_homopolymer'] = 6
+        out_dir = mkdtemp()
+        self._clean_up_files.append(out_dir)
+        generate_quality_trimming([fp], out_dir, params)
+        with open(join(out_dir, 'seqs.fna')) as f:
+            obs = f.readlines()[1::2]
+        exp = [s for s in seqs
+               if not any(b * 7 in s for b in 'ACGT')]
+        self.assertEqual(len(obs), 31169)
+        self.assertEqual(obs, exp)
+
+    def test_quality_trimming(self):
+        fd, fp = mkstemp(suffix='_seqs.demux')
+        close(fd)
+        self._clean_up_files.append(fp)
+        copyfile('support_files/filtered_5_seqs.demux', fp)
+
+        prep_info_dict = {
+            'SKB7.640196': {'description_for_test': 'SKB7'},
+            'SKB8.640193': {'description_for_test': 'SKB8'}
+        }
+        data = {'prep_info': dumps(prep_info_dict),
+                'study': 1,
+                'data_type': '16S'}
+        pid = self.qclient.post('/apitest/prep_template/', data=data)['prep']
+
+        data = {
+            'filepaths': dumps([(fp, 'preprocessed_demux')]),
+            'type': "Demultiplexed",
+            'name': "New demultiplexed artifact",
+            'prep': pid}
+        aid = self.qclient.post('/apitest/artifact/', data=data)['artifact']
+
+        params = {'input_data': aid, 'method': 'sliding_window',
+                  'min_quality': 20, 'window': 4, 'min_length': 75,
+                  'max_ambig': 6, 'max_homopolymer': 6,
+                  'truncate_ambi_bases': False}
+        data = {'user': 'demo@microbio.me',
+                'command': dumps(['QIIMEq2', '1.9.2', 'Quality trimming']),
+                'status': 'running', 'parameters': dumps(params)}
+        jid = self.qclient.post('/apitest/processing_job/', data=data)['job']
+
+        out_dir = mkdtemp()
+        self._clean_up_files.append(out_dir)
+
+        success, ainfo, msg = quality_trimming(
+            self.qclient, jid, params, out_dir)
+        self.assertTrue(success)
+        pb = partial(join, out_dir)
+        exp_ainfo = [
+            ArtifactInfo(
+                'Trimmed Demultiplexed', 'Demultiplexed',
+                [(pb('seqs.fna'), 'preprocessed_fasta'),
+                 (pb('seqs.fastq'), 'preprocessed_fastq'),
+                 (pb('seqs.demux'), 'preprocessed_demux'),
+                 (pb('seqs.demux.index.json'), 'log')])]
+        self.assertEqual(ainfo, exp_ainfo)
+        self.assertEqual(msg, "")
+
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,216 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from os.path import exists
+from json import dump
+from time import time
+import resource
+
+from qp_target_gene.config import get_config_value
+from qp_target_gene.execution import run_command, MAXRSS_UNIT, BLOCK_SIZE
+from qp_target_gene.demux_index import DemuxIndex
+
+
+TIMINGS_FILENAME = 'timings.json'
+
+
+def _read_io_counters():
+    """Returns the bytes read and written by this process
+
+    Returns
+    -------
+    int or None, int or None
+        The bytes read and written, None if the system doesn't report them
+    """
+    fp = '/proc/self/io'
+    if not exists(fp):
+        return None, None
+    counters = {}
+    with open(fp) as f:
+        for line in f:
+            name, value = line.split(':')
+            counters[name] = int(value)
+    return counters.get('rchar'), counters.get('wchar')
+
+
+def _snapshot():
+    """Returns the resources used so far by this process and its children"""
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    read_bytes, write_bytes = _read_io_counters()
+    return {'time': time(),
+            'cpu': self_usage.ru_utime + self_usage.ru_stime,
+            'children_cpu': children_usage.ru_utime + children_usage.ru_stime,
+            'rss': self_usage.ru_maxrss * MAXRSS_UNIT,
+            'children_rss': children_usage.ru_maxrss * MAXRSS_UNIT,
+            'read_bytes': read_bytes,
+            'write_bytes': write_bytes,
+            'children_read_bytes': children_usage.ru_inblock * BLOCK_SIZE,
+            'children_write_bytes': children_usage.ru_oublock * BLOCK_SIZE}
+
+
+def _delta(start, end, key):
+    if start[key] is None or end[key] is None:
+        return None
+    return end[key] - start[key]
+
+
+def count_demux_reads(demux_fp):
+    """Returns the number of reads in a demux file
+
+    Parameters
+    ----------
+    demux_fp : str
+        The demux filepath
+
+    Returns
+    -------
+    int
+        The number of reads
+    """
+    return DemuxIndex.load(demux_fp).total
+
+
+class Timings(object):
+    """Records the resources used by each stage of a command
+
+    Parameters
+    ----------
+    fp : str
+        The filepath where the timings are written, usually `timings.json`
+        in the job's output directory
+
+    Notes
+    -----
+    For each stage it records the wall time, the CPU time of the plugin and
+    of its subprocesses, the peak resident memory, the bytes read and
+    written by the plugin (where the system reports them), the bytes its
+    subprocesses read from and wrote to disk and, if given, the number of
+    reads processed. Each command run with `run_command` is also recorded
+    on its own.
+
+    The peak resident memory is the peak of the job so far, as that is the
+    only value reported by the system. The timings are written when the
+    context is exited, even if the command fails.
+    """
+    def __init__(self, fp):
+        self.fp = fp
+        self.stages = []
+        self._current = None
+        self._start = None
+        self._job_start = _snapshot()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+        self.write()
+
+    def start(self, name):
+        """Starts a new stage, stopping the current one
+
+        Parameters
+        ----------
+        name : str
+            The stage name
+        """
+        self.stop()
+        self._current = {'name': name, 'reads': None, 'subprocesses': []}
+        self._start = _snapshot()
+
+    def stop(self):
+        """Stops the current stage"""
+        if self._current is None:
+            return
+        self._current.update(self._usage(self._start, _snapshot()))
+        self.stages.append(self._current)
+        self._current = None
+
+    def add_reads(self, reads):
+        """Adds to the number of reads processed by the current stage
+
+        Parameters
+        ----------
+        reads : int
+            The number of reads
+        """
+        if self._current is not None:
+            self._current['reads'] = (self._current['reads'] or 0) + reads
+
+    def run_command(self, cmd, log_dir, **kwargs):
+        """Runs a command, recording its resources in the current stage
+
+        Parameters
+        ----------
+        cmd : str
+            The shell command
+        log_dir : str
+            The directory where the standard output and error are written
+        kwargs : dict
+            The other arguments of `qp_target_gene.execution.run_command`
+
+        Returns
+        -------
+        CommandResult
+            The command result, as returned by `run_command`
+        """
+        result = run_command(cmd, log_dir, **kwargs)
+        if self._current is not None:
+            subprocess = {'command': cmd, 'return_value': result.return_value}
+            subprocess.update(result.usage)
+            self._current['subprocesses'].append(subprocess)
+        return result
+
+    @staticmethod
+    def _usage(start, end):
+        return {'wall_time': end['time'] - start['time'],
+                'cpu_time': end['cpu'] - start['cpu'],
+                'children_cpu_time': end['children_cpu'] -
+                start['children_cpu'],
+                'peak_rss': max(end['rss'], end['children_rss']),
+                'read_bytes': _delta(start, end, 'read_bytes'),
+                'write_bytes': _delta(start, end, 'write_bytes'),
+                'children_read_bytes': _delta(start, end,
+                                              'children_read_bytes'),
+                'children_write_bytes': _delta(start, end,
+                                               'children_write_bytes')}
+
+    def to_dict(self):
+        """Returns the recorded timings
+
+        Returns
+        -------
+        dict
+            The totals of the job, under 'total', and the list of stages,
+            under 'stages'
+        """
+        return {'total': self._usage(self._job_start, _snapshot()),
+                'stages': self.stages}
+
+    def write(self):
+        """Writes the recorded timings as JSON"""
+        with open(self.fp, 'w') as f:
+            dump(self.to_dict(), f, indent=4)
+
+    def attach(self, artifacts_info):
+        """Adds the timings file to the log of the first artifact
+
+        Parameters
+        ----------
+        artifacts_info : list of ArtifactInfo
+            The artifacts generated by the command
+
+        Notes
+        -----
+        The file is only added if ATTACH_TO_LOG is set in the plugin
+        configuration file.
+        """
+        attach = get_config_value('timings', 'ATTACH_TO_LOG', 'False')
+        if artifacts_info and attach.lower() in ('true', 'yes', '1'):
+            artifacts_info[0].files.append((self.fp, 'log'))
@@ -6,18 +6,40 @@
 # The full license is in the file LICENSE, distributed with this software.
 # -----------------------------------------------------------------------------
 
-from os.path import join
+from os.path import join, exists
+from os import makedirs
 from functools import partial
+
+import numpy as np
 from h5py import File
 
 from qiita_client import ArtifactInfo
 
+from qp_target_gene.cache import cached_command
+from qp_target_gene.manifest import Manifest, write_manifests
+from qp_target_gene.metadata import get_artifact_filepaths
+from qp_target_gene.progress import ProgressReporter
+from qp_target_gene.staging import staged_command
+from qp_target_gene.timing import (
+    TIMINGS_FILENAME, Timings, count_demux_reads)
+from qp_target_gene.demux_index import DemuxIndex, index_fp
+from qp_target_gene.split_libraries.filters import apply_sequence_filters
+from qp_target_gene.split_libraries.primers import encode_reads
 from qp_target_gene.split_libraries.util import generate_demux_file
-from qiita_files.demux import fetch
 from qiita_files.format.fasta import format_fasta_record
 from qiita_files.format.fastq import format_fastq_record
 
 
+# the lengths of the trimming presets, which are the lengths the multi-length
+# trimming command can generate, as each needs its own command output
+TRIMMING_LENGTHS = (90, 100, 150)
+
+QUALITY_TRIMMING_METHODS = ('sliding_window', 'first_low_quality')
+
+ID_FMT = (b"%(sample)s_%(idx)d orig_bc=%(bc_ori)s new_bc=%(bc_cor)s "
+          b"bc_diffs=%(bc_diff)d")
+
+
 def generate_trimming(filepaths, out_dir, parameters):
     """Generate the trimming of the filepaths
 
@@ -31,28 +53,288 @@ def generate_trimming(filepaths, out_dir, parameters):
         The command's parameters, keyed by parameter name
     """
     length = int(parameters['length'])
+    generate_multi_length_trimming(filepaths, {length: out_dir})
+
+
+def generate_multi_length_trimming(filepaths, out_dirs):
+    """Trims the filepaths to several lengths, reading them once
+
+    Parameters
+    ----------
+    filepaths : list of str
+        The demux filepaths
+    out_dirs : dict of {int: str}
+        The output directory of each length
+
+    Notes
+    -----
+    Each read is read and its id formatted once, and then written, trimmed,
+    to the output of each length it is long enough for. The outputs are
+    checksummed as they are written, in the manifest of each directory.
+    """
+    lengths = sorted(out_dirs)
+    manifests = []
+    fhs = []
+    try:
+        for length in lengths:
+            pd = partial(join, out_dirs[length])
+            manifests.append(Manifest(out_dirs[length]))
+            fhs.append((length, manifests[-1].open(pd('seqs.fna')),
+                        manifests[-1].open(pd('seqs.fastq'))))
+        for f in filepaths:
+            index = DemuxIndex.load(f)
+            with File(f, 'r') as fh:
+                for samp, idx, seq, qual, bc_ori, bc_cor, bc_err in \
+                        index.fetch(fh):
+                    # only one of these comparisons should suffice but
+                    # better safe than sorry
+                    read_length = min(len(seq), len(qual))
+                    if read_length < lengths[0]:
+                        continue
+                    seq_id = ID_FMT % {b'sample': samp, b'idx': idx,
+                                       b'bc_ori': bc_ori, b'bc_cor': bc_cor,
+                                       b'bc_diff': bc_err}
+                    for length, ffh, qfh in fhs:
+                        if read_length < length:
+                            # the lengths are sorted
+                            break
+                        ffh.write(format_fasta_record(
+                            seq_id, seq[:length], qual[:length]))
+                        qfh.write(format_fastq_record(
+                            seq_id, seq[:length], qual[:length]))
+    finally:
+        for _, ffh, qfh in fhs:
+            ffh.close()
+            qfh.close()
+        for manifest in manifests:
+            manifest.save()
+
+
+def quality_trim_lengths(quals, lengths, min_quality,
+                         method='sliding_window', window=4):
+    """Computes the length of a batch of reads after quality trimming
+
+    Parameters
+    ----------
+    quals : np.array of int
+        The quality scores of the reads, one row per read, padded to the
+        longest read
+    lengths : np.array of int
+        The length of each read
+    min_quality : int
+        The minimum quality score kept
+    method : {'sliding_window', 'first_low_quality'}, optional
+        Whether the reads are cut at the start of the first window whose mean
+        quality is below `min_quality`, or at the first base below it
+    window : int, optional
+        The length of the sliding window
+
+    Returns
+    -------
+    np.array of int
+        The length of each read after trimming
+
+    Raises
+    ------
+    ValueError
+        If the method is not known
+
+    Notes
+    -----
+    The window means are computed for the whole batch at once, from the
+    cumulative sums of the quality scores. Only the windows inside each read
+    are considered, so the reads shorter than the window are not trimmed by
+    the sliding window.
+    """
+    if method not in QUALITY_TRIMMING_METHODS:
+        raise ValueError("Unknown quality trimming method: %s. Please, "
+                         "choose from %s" % (
+                             method, ', '.join(QUALITY_TRIMMING_METHODS)))
+    quals = np.asarray(quals, dtype=np.int64)
+    lengths = np.asarray(lengths, dtype=np.int64)
+    n, width = quals.shape
+    if method == 'first_low_quality':
+        positions = np.arange(width)
+        low = (quals < min_quality) & (positions < lengths[:, None])
+    else:
+        if width < window:
+            return lengths
+        csum = np.zeros((n, width + 1), dtype=np.int64)
+        np.cumsum(quals, axis=1, out=csum[:, 1:])
+        # sums[:, i] is the sum of the qualities of the window starting at i
+        sums = csum[:, window:] - csum[:, :-window]
+        positions = np.arange(sums.shape[1])
+        # comparing the sums avoids the division
+        low = (sums < min_quality * window) & (
+            positions <= (lengths - window)[:, None])
+    return np.where(low.any(axis=1), low.argmax(axis=1), lengths)
+
+
+def generate_quality_trimming(filepaths, out_dir, parameters):
+    """Generate the quality trimming of the filepaths
+
+    Parameters
+    ----------
+    filepaths : list of str
+        The demux filepaths
+    out_dir : str
+        The job output directory
+    parameters : dict
+        The command's parameters, keyed by parameter name
+
+    Raises
+    ------
+    ValueError
+        If the method is not known, or a demux file doesn't have quality
+        scores
+
+    Notes
+    -----
+    The reads with more than `max_ambig` ambiguous bases (unless they are
+    truncated at their first N, if `truncate_ambi_bases`) or homopolymers
+    longer than `max_homopolymer` are discarded, as in split libraries.
+    The remaining reads are quality trimmed, and the reads shorter than
+    `min_length` after trimming are discarded.
+    """
+    method = parameters['method']
+    min_quality = int(parameters['min_quality'])
+    window = int(parameters['window'])
+    min_length = max(int(parameters['min_length']), 1)
+    max_ambig = int(parameters['max_ambig'])
+    max_homopolymer = int(parameters['max_homopolymer'])
+    truncate_ambi_bases = parameters['truncate_ambi_bases']
+    if method not in QUALITY_TRIMMING_METHODS:
+        raise ValueError("Unknown quality trimming method: %s. Please, "
+                         "choose from %s" % (
+                             method, ', '.join(QUALITY_TRIMMING_METHODS)))
 
-    id_fmt = (b"%(sample)s_%(idx)d orig_bc=%(bc_ori)s new_bc=%(bc_cor)s "
-              b"bc_diffs=%(bc_diff)d")
     pd = partial(join, out_dir)
-    ffp = pd('seqs.fna')
-    qfp = pd('seqs.fastq')
-    for f in filepaths:
-        with open(ffp, 'w') as ffh, open(qfp, 'w') as qfh, File(f) as fh:
-            for samp, idx, seq, qual, bc_ori, bc_cor, bc_err in fetch(fh):
-                # only one of these comparisons should suffice but better
-                # safe than sorry
-                if len(seq) < length or len(qual) < length:
-                    continue
-                seq_id = id_fmt % {b'sample': samp, b'idx': idx,
-                                   b'bc_ori': bc_ori, b'bc_cor': bc_cor,
-                                   b'bc_diff': bc_err}
-                ffh.write(
-                    format_fasta_record(seq_id, seq[:length], qual[:length]))
-                qfh.write(
-                    format_fastq_record(seq_id, seq[:length], qual[:length]))
+    with Manifest(out_dir) as manifest, \
+            manifest.open(pd('seqs.fna')) as ffh, \
+            manifest.open(pd('seqs.fastq')) as qfh:
+        for f in filepaths:
+            index = DemuxIndex.load(f)
+            if not index.has_qual:
+                raise ValueError("The demux file doesn't have quality "
+                                 "scores: %s" % f)
+            with File(f, 'r') as fh:
+                for batch in index.fetch_batches(fh):
+                    codes, lengths = encode_reads(batch.sequence)
+                    keep, lengths = apply_sequence_filters(
+                        codes, lengths, max_ambig, max_homopolymer,
+                        truncate_ambi_bases)
+                    trimmed = quality_trim_lengths(
+                        batch.qual, lengths, min_quality, method, window)
+                    for i in np.flatnonzero(keep & (trimmed >= min_length)):
+                        length = trimmed[i]
+                        seq = batch.sequence[i][:length]
+                        qual = batch.qual[i][:length]
+                        seq_id = ID_FMT % {
+                            b'sample': batch.sample, b'idx': batch.start + i,
+                            b'bc_ori': batch.bc_original[i],
+                            b'bc_cor': batch.bc_corrected[i],
+                            b'bc_diff': batch.bc_error[i]}
+                        ffh.write(format_fasta_record(seq_id, seq, qual))
+                        qfh.write(format_fastq_record(seq_id, seq, qual))
+
+
+def parse_lengths(lengths):
+    """Parses the lengths of the multi-length trimming command
+
+    Parameters
+    ----------
+    lengths : str
+        The comma-separated lengths
+
+    Returns
+    -------
+    list of int
+        The sorted, unique, lengths
+
+    Raises
+    ------
+    ValueError
+        If a length is not a number or not one of TRIMMING_LENGTHS
+    """
+    try:
+        values = sorted(set(int(v) for v in str(lengths).split(',')
+                            if v.strip()))
+    except ValueError:
+        raise ValueError("The lengths should be a comma-separated list of "
+                         "integers: %s" % lengths)
+    if not values:
+        raise ValueError("No length to trim to")
+    unsupported = [str(v) for v in values if v not in TRIMMING_LENGTHS]
+    if unsupported:
+        raise ValueError("Not supported lengths: %s. Please, choose from %s"
+                         % (', '.join(unsupported),
+                            ', '.join(map(str, TRIMMING_LENGTHS))))
+    return values
 
 
+def _run_trimming(qclient, job_id, parameters, out_dir, generate):
+    """Runs a trimming function, generating a trimmed demultiplexed artifact
+
+    Parameters
+    ----------
+    qclient : tgp.qiita_client.QiitaClient
+        The Qiita server client
+    job_id : str
+        The job id
+    parameters : dict
+        The parameter values to run the trimming
+    out_dir : str
+        The path to the job's output directory
+    generate : function
+        Writes the trimmed reads of the demux filepaths, as
+        `generate_trimming`
+
+    Returns
+    -------
+    bool, list, str
+        The results of the job.
+            bool: if the job was successful
+            list: artifacts created, can be None
+            str: error message, "" if no error was generated
+    """
+    with ProgressReporter(qclient, job_id) as progress, \
+            Timings(join(out_dir, TIMINGS_FILENAME)) as timings:
+        progress.update("Step 1 of 3: Collecting information")
+        timings.start("Collecting information")
+        fps = get_artifact_filepaths(qclient, parameters['input_data'])
+        if 'preprocessed_demux' not in fps:
+            error_msg = "Artifact doesn't contain a preprocessed demux"
+            return False, None, error_msg
+
+        progress.update("Step 2 of 3: Executing Trimming")
+        timings.start("Trimming")
+        timings.add_reads(count_demux_reads(fps['preprocessed_demux'][0]))
+        try:
+            generate(fps['preprocessed_demux'], out_dir, parameters)
+        except ValueError as e:
+            return False, None, str(e)
+
+        progress.update("Step 3 of 3: Generating new Demuxed")
+        timings.start("Generating demux file")
+        generate_demux_file(out_dir)
+        timings.add_reads(count_demux_reads(join(out_dir, 'seqs.demux')))
+
+        pb = partial(join, out_dir)
+        ainfo = [
+            ArtifactInfo(
+                'Trimmed Demultiplexed', 'Demultiplexed',
+                [(pb('seqs.fna'), 'preprocessed_fasta'),
+                 (pb('seqs.fastq'), 'preprocessed_fastq'),
+                 (pb('seqs.demux'), 'preprocessed_demux'),
+                 (index_fp(pb('seqs.demux')), 'log')])]
+        write_manifests(ainfo)
+        timings.attach(ainfo)
+
+        return True, ainfo, ""
+
+
+@cached_command('trimming')
+@staged_command
 def trimming(qclient, job_id, parameters, out_dir):
     """Run trimming over the given parameters
 
@@ -75,26 +357,100 @@ def trimming(qclient, job_id, parameters, out_dir):
             list: artifacts created, can be None
             str: error message, "" if no error was generated
     """
-    qclient.update_job_step(job_id, "Step 1 of 3: Collecting information")
-    artifact_id = parameters['input_data']
-    a_info = qclient.get("/qiita_db/artifacts/%s/" % artifact_id)
-    fps = {k: [vv['filepath'] for vv in v] for k, v in a_info['files'].items()}
-    if 'preprocessed_demux' not in fps:
-        error_msg = "Artifact doesn't contain a preprocessed demux"
-        return False, None, error_msg
-
-    qclient.update_job_step(job_id, "Step 2 of 3: Executing Trimming")
-    generate_trimming(fps['preprocessed_demux'], out_dir, parameters)
-
-    qclient.update_job_step(job_id, "Step 3 of 3: Generating new Demuxed")
-    generate_demux_file(out_dir)
-
-    pb = partial(join, out_dir)
-    ainfo = [
-        ArtifactInfo(
-            'Trimmed Demultiplexed', 'Demultiplexed',
-            [(pb('seqs.fna'), 'preprocessed_fasta'),
-             (pb('seqs.fastq'), 'preprocessed_fastq'),
-             (pb('seqs.demux'), 'preprocessed_demux')])]
-
-    return True, ainfo, ""
+    return _run_trimming(qclient, job_id, parameters, out_dir,
+                         generate_trimming)
+
+
+@cached_command('quality_trimming')
+@staged_command
+def quality_trimming(qclient, job_id, parameters, out_dir):
+    """Run quality trimming over the given parameters
+
+    Parameters
+    ----------
+    qclient : tgp.qiita_client.QiitaClient
+        The Qiita server client
+    job_id : str
+        The job id
+    parameters : dict
+        The parameter values to run the quality trimming
+    out_dir : str
+        The path to the job's output directory
+
+    Returns
+    -------
+    bool, list, str
+        The results of the job.
+            bool: if the job was successful
+            list: artifacts created, can be None
+            str: error message, "" if no error was generated
+    """
+    return _run_trimming(qclient, job_id, parameters, out_dir,
+                         generate_quality_trimming)
+
+
+@cached_command('multi_length_trimming')
+@staged_command
+def multi_length_trimming(qclient, job_id, parameters, out_dir):
+    """Run trimming to several lengths over the given parameters
+
+    Parameters
+    ----------
+    qclient : tgp.qiita_client.QiitaClient
+        The Qiita server client
+    job_id : str
+        The job id
+    parameters : dict
+        The parameter values to run the multi-length trimming
+    out_dir : str
+        The path to the job's output directory
+
+    Returns
+    -------
+    bool, list, str
+        The results of the job.
+            bool: if the job was successful
+            list: artifacts created, can be None
+            str: error message, "" if no error was generated
+    """
+    with ProgressReporter(qclient, job_id) as progress, \
+            Timings(join(out_dir, TIMINGS_FILENAME)) as timings:
+        progress.update("Step 1 of 3: Collecting information")
+        timings.start("Collecting information")
+        try:
+            lengths = parse_lengths(parameters['lengths'])
+        except ValueError as e:
+            return False, None, str(e)
+        fps = get_artifact_filepaths(qclient, parameters['input_data'])
+        if 'preprocessed_demux' not in fps:
+            error_msg = "Artifact doesn't contain a preprocessed demux"
+            return False, None, error_msg
+
+        progress.update("Step 2 of 3: Executing Trimming")
+        timings.start("Trimming")
+        timings.add_reads(count_demux_reads(fps['preprocessed_demux'][0]))
+        out_dirs = {}
+        for length in lengths:
+            out_dirs[length] = join(out_dir, '%dbp' % length)
+            if not exists(out_dirs[length]):
+                makedirs(out_dirs[length])
+        generate_multi_length_trimming(fps['preprocessed_demux'], out_dirs)
+
+        progress.update("Step 3 of 3: Generating new Demuxed")
+        timings.start("Generating demux files")
+        ainfo = []
+        for length in lengths:
+            generate_demux_file(out_dirs[length])
+            timings.add_reads(count_demux_reads(
+                join(out_dirs[length], 'seqs.demux')))
+            pb = partial(join, out_dirs[length])
+            ainfo.append(ArtifactInfo(
+                'Trimmed Demultiplexed %dbp' % length, 'Demultiplexed',
+                [(pb('seqs.fna'), 'preprocessed_fasta'),
+                 (pb('seqs.fastq'), 'preprocessed_fastq'),
+                 (pb('seqs.demux'), 'preprocessed_demux'),
+                 (index_fp(pb('seqs.demux')), 'log')]))
+        write_manifests(ainfo)
+        timings.attach(ainfo)
+
+        return True, ainfo, ""
@@ -39,7 +39,8 @@ setup(name='qp-target-gene',
       author_email="qiita.help@gmail.com",
       url='https://github.com/qiita-spots/qp-target-gene',
       test_suite='nose.collector',
-      packages=['qp_target_gene', 'qp_target_gene/split_libraries'],
+      packages=['qp_target_gene', 'qp_target_gene/split_libraries',
+                'qp_target_gene/benchmarks'],
       package_data={'qp_target_gene': ['support_files/config_file.cfg']},
       scripts=glob('scripts/*'),
       extras_require={'test': ["nose >= 0.10.1", "pep8"]},